@@ -21,7 +21,10 @@ from PyQt5 import QtCore, QtGui, QtWidgets
 from valves.valveChain import ValveChain
 from pumps.pumpControl import PumpControl
 from kilroyProtocols import KilroyProtocols
+from kilroyStatusBoard import StatusBoardWriter
 from storm_control.sc_library.tcpServer import TCPServer   # get these from storm control
+from storm_control.sc_library.tcpMessage import TCPMessage
+from storm_control.sc_library.tcpReplayCache import TCPReplayCache
 import storm_control.sc_library.parameters as params
 
 # ----------------------------------------------------------------------------------------
@@ -77,9 +80,51 @@ class Kilroy(QtWidgets.QMainWindow):
             self.plate_layout = parameters.get("plate_layout")
         else:
             self.plate_layout = './valves/XYZ_layout.json'
+
+        # "tcp" (default) or "local", a local socket can only be used when the
+        #   acquisition software runs on the same computer
+        if "tcp_transport" in parameters.parameters:
+            self.tcp_transport = parameters.get("tcp_transport")
+        else:
+            self.tcp_transport = "tcp"
+
+        if "local_socket_name" in parameters.parameters:
+            self.local_socket_name = parameters.get("local_socket_name")
+        else:
+            self.local_socket_name = "kilroy"
+
+        # Memory mapped status board for other programs on this computer (off by default)
+        if "status_board_path" in parameters.parameters:
+            self.status_board_path = parameters.get("status_board_path")
+        else:
+            self.status_board_path = None
+
+        if "status_board_interval" in parameters.parameters:
+            self.status_board_interval = parameters.get("status_board_interval")
+        else:
+            self.status_board_interval = 200 # milliseconds
+
+        # Heartbeats and dead client detection on the TCP link in seconds, 0 is off
+        if "tcp_heartbeat_interval" in parameters.parameters:
+            self.tcp_heartbeat_interval = parameters.get("tcp_heartbeat_interval")
+        else:
+            self.tcp_heartbeat_interval = 0
+
+        if "tcp_idle_timeout" in parameters.parameters:
+            self.tcp_idle_timeout = parameters.get("tcp_idle_timeout")
+        else:
+            self.tcp_idle_timeout = 0
+
+        if "replay_cache_size" in parameters.parameters:
+            self.replay_cache_size = parameters.get("replay_cache_size")
+        else:
+            self.replay_cache_size = 256
             
         # Define additional internal attributes
         self.received_message = None
+        self.batch_queue = [] # Protocols remaining in a batch started via TCP
+        self.send_events = False # Has the TCP client subscribed to progress events?
+        self.replay_cache = TCPReplayCache(max_size = self.replay_cache_size) # Recent TCP requests and their replies
         
         # Create ValveChain instance
         print(self.valve_com_port)
@@ -96,18 +141,38 @@ class Kilroy(QtWidgets.QMainWindow):
         # Create KilroyProtocols instance and connect signals
         self.kilroyProtocols = KilroyProtocols(protocol_xml_path = self.protocols_file,
                                                command_xml_path = self.commands_file,
+                                               default_pump_ID = self.pumpControl.pumps[0].pump_ID,
                                                verbose = self.verbose)
 
         self.kilroyProtocols.command_ready_signal.connect(self.sendCommand)
         self.kilroyProtocols.status_change_signal.connect(self.handleProtocolStatusChange)
         self.kilroyProtocols.completed_protocol_signal.connect(self.handleProtocolComplete)
+        self.kilroyProtocols.progress_signal.connect(self.sendEvent)
+        self.valveChain.move_complete_signal.connect(self.handleMoveComplete)
 
         # Create Kilroy TCP Server and connect signals
-        self.tcpServer = TCPServer(port = self.tcp_port,
+        if self.tcp_transport == "local":
+            local_name = self.local_socket_name
+        else:
+            local_name = None
+        self.tcpServer = TCPServer(heartbeat_interval = self.tcp_heartbeat_interval,
+                                   idle_timeout = self.tcp_idle_timeout,
+                                   local_name = local_name,
+                                   port = self.tcp_port,
                                    server_name = "Kilroy",
                                    verbose = self.verbose)
         
         self.tcpServer.messageReceived.connect(self.handleTCPData)
+        self.tcpServer.comLostConnection.connect(self.handleLostConnection)
+
+        # Create the status board and update it periodically
+        self.status_board = None
+        if self.status_board_path:
+            self.status_board = StatusBoardWriter(path = self.status_board_path)
+            self.status_board_timer = QtCore.QTimer(self)
+            self.status_board_timer.setInterval(self.status_board_interval)
+            self.status_board_timer.timeout.connect(self.publishStatus)
+            self.status_board_timer.start()
 
         # Create GUI
         self.createGUI()
@@ -120,6 +185,9 @@ class Kilroy(QtWidgets.QMainWindow):
         self.tcpServer.close()
         self.valveChain.close()
         self.pumpControl.close()
+        if self.status_board is not None:
+            self.status_board_timer.stop()
+            self.status_board.close()
         print("\nKilroy was here!")
 
     # ----------------------------------------------------------------------------------------
@@ -134,10 +202,47 @@ class Kilroy(QtWidgets.QMainWindow):
         self.mainLayout.addWidget(self.pumpControl.mainWidget, 0, 4, 2, 1)
         #self.mainLayout.addWidget(self.tcpServer.mainWidget, 2, 2, 1, 4)
 
+    # ----------------------------------------------------------------------------------------
+    # Collect the cached state of the protocols, valves and pump
+    # ----------------------------------------------------------------------------------------
+    def getStatusSnapshot(self):
+        snapshot = {"protocol": self.kilroyProtocols.getCachedStatus(),
+                    "pump": self.pumpControl.getCachedStatus()}
+        snapshot.update(self.valveChain.getCachedStatus())
+        return snapshot
+
+    # ----------------------------------------------------------------------------------------
+    # Stop sending events when the TCP client goes away
+    # ----------------------------------------------------------------------------------------
+    def handleLostConnection(self):
+        self.send_events = False
+
+    # ----------------------------------------------------------------------------------------
+    # Pass valve and CNC move complete events on to the TCP client, a protocol
+    #   waiting for the CNC continues once its last move is done
+    # ----------------------------------------------------------------------------------------
+    def handleMoveComplete(self, move):
+        event = {"event": "move_complete", "time": time.time()}
+        event.update(move)
+        if self.kilroyProtocols.isRunningProtocol():
+            event["protocol_ID"], event["command_ID"] = self.kilroyProtocols.getStatus()
+        self.sendEvent(event)
+        if (move["device"] == "cnc") and not self.valveChain.isCNCMoving():
+            self.kilroyProtocols.handleMoveComplete()
+
+    # ----------------------------------------------------------------------------------------
+    # Subscribe or unsubscribe the TCP client to progress events
+    # ----------------------------------------------------------------------------------------
+    def handleSubscribeRequest(self, message):
+        self.send_events = bool(message.getData("events", True))
+        message.addResponse("events", self.send_events)
+        self.tcpServer.sendMessage(message)
+
     # ----------------------------------------------------------------------------------------
     # Redirect protocol status change from kilroyProtocols to valveChain
     # ----------------------------------------------------------------------------------------
     def handleProtocolStatusChange(self):
+        self.publishStatus()
         status = self.kilroyProtocols.getStatus()
         if status[0] >= 0: # Protocol is running
             self.valveChain.setEnabled(False)
@@ -152,20 +257,101 @@ class Kilroy(QtWidgets.QMainWindow):
     def handleProtocolComplete(self, message):
         # If the protocol was sent by TCP pass on the complete signal
         if (self.received_message is not None) and self.received_message.getID() == message.getID():
-            self.tcpServer.sendMessage(message)
+            if message.isType("Kilroy Protocol Batch"):
+                message.addResponse("completed_protocols", len(message.getData("names")) - len(self.batch_queue))
+                if (len(self.batch_queue) > 0) and not message.getResponse("aborted"):
+                    # Wait until kilroyProtocols has finished stopping this protocol
+                    QtCore.QTimer.singleShot(0, lambda: self.startNextBatchProtocol(message))
+                    return
+                self.batch_queue = []
+            self.sendReply(message)
             self.received_message = None # Reset the received_message
+        else:
+            # A protocol that was superseded by a newer request, remember how it ended
+            self.replay_cache.complete(message)
+
+    # ----------------------------------------------------------------------------------------
+    # Handle a batch of protocols sent via TCP server
+    # ----------------------------------------------------------------------------------------
+    def handleBatchRequest(self, message):
+        protocol_names = message.getData("names")
+
+        # Validate the whole batch before running any of it
+        errors = []
+        if not isinstance(protocol_names, list) or (len(protocol_names) == 0):
+            errors.append("names must be a non-empty list of protocol names")
+        else:
+            for [index, protocol_name] in enumerate(protocol_names):
+                if not isinstance(protocol_name, str) or not self.kilroyProtocols.isValidProtocol(protocol_name):
+                    errors.append(str(index) + ": " + str(protocol_name) + " is not a valid protocol")
+        if (len(errors) > 0):
+            message.setError(True, "Invalid Kilroy Protocol Batch: " + "; ".join(errors))
+            message.addResponse("errors", errors)
+            self.sendReply(message)
+            return
+
+        # Per protocol and cumulative durations
+        durations = [self.kilroyProtocols.requiredTime(name) for name in protocol_names]
+        cumulative_durations = []
+        total_time = 0.0
+        for duration in durations:
+            total_time += duration
+            cumulative_durations.append(total_time)
+        message.addResponse("durations", durations)
+        message.addResponse("cumulative_durations", cumulative_durations)
+        message.addResponse("duration", total_time)
+
+        if message.isTest():
+            self.sendReply(message)
+        else:
+            # Keep track of valid messages issued via TCP and start the first protocol
+            self.received_message = message
+            self.batch_queue = list(protocol_names)
+            self.startNextBatchProtocol(message)
+
+    # ----------------------------------------------------------------------------------------
+    # Start the next protocol of a batch, unless a newer request replaced the batch
+    #   between its protocols
+    # ----------------------------------------------------------------------------------------
+    def startNextBatchProtocol(self, message):
+        if (self.received_message is not message) or (len(self.batch_queue) == 0):
+            # A superseded request, remember how it ended
+            message.addResponse("aborted", True)
+            self.replay_cache.complete(message)
+            return
+        protocol_name = self.batch_queue.pop(0)
+        self.kilroyProtocols.startProtocolRemotely(message, protocol_name)
+
+    # ----------------------------------------------------------------------------------------
+    # Answer a status request from the cached state (no serial traffic)
+    # ----------------------------------------------------------------------------------------
+    def handleStatusRequest(self, message):
+        for [key, value] in self.getStatusSnapshot().items():
+            message.addResponse(key, value)
+        self.tcpServer.sendMessage(message)
 
     # ----------------------------------------------------------------------------------------
     # Handle protocol request sent via TCP server
     # ----------------------------------------------------------------------------------------
     def handleTCPData(self, message):        
+        # Retried requests are answered from the replay cache instead of running again
+        if self.isDuplicateRequest(message):
+            return
+
+        # Status requests are answered immediately from the cached state
+        if message.isType("Kilroy Status"):
+            self.handleStatusRequest(message)
+        elif message.isType("Kilroy Protocol Batch"):
+            self.handleBatchRequest(message)
+        elif message.isType("Kilroy Subscribe"):
+            self.handleSubscribeRequest(message)
         # Confirm that message is a protocol message
-        if not message.getType() == "Kilroy Protocol":
+        elif not message.getType() == "Kilroy Protocol":
             message.setError(True, "Wrong message type sent to Kilroy: " + message.getType())
             self.tcpServer.sendMessage(message)
         elif not self.kilroyProtocols.isValidProtocol(message.getData("name")):
             message.setError(True, "Invalid Kilroy Protocol")
-            self.tcpServer.sendMessage(message)
+            self.sendReply(message)
         elif message.isTest():
             required_time = self.kilroyProtocols.requiredTime(message.getData("name"))
             message.addResponse("duration", required_time)
@@ -173,9 +359,54 @@ class Kilroy(QtWidgets.QMainWindow):
         else: # Valid, non-test message                                    
             # Keep track of valid messages issued via TCP 
             self.received_message = message
+            self.batch_queue = []
             # Start the protocol
             self.kilroyProtocols.startProtocolRemotely(message)
             
+    # ----------------------------------------------------------------------------------------
+    # Check whether a protocol request has already been received
+    # ----------------------------------------------------------------------------------------
+    def isDuplicateRequest(self, message):
+        if message.isTest() or not message.getType() in ["Kilroy Protocol", "Kilroy Protocol Batch"]:
+            return False
+        # Only IDs that are unique across client restarts can identify a retry
+        if not TCPMessage.isUniqueID(message.getID()):
+            return False
+        [state, reply] = self.replay_cache.get(message)
+        if state is None:
+            self.replay_cache.add(message)
+            return False
+        if state == TCPReplayCache.COMPLETE:
+            print("Kilroy resending the reply to request " + str(message.getID()))
+            self.tcpServer.sendMessage(reply)
+        else:
+            # The reply will be sent when the original request completes
+            print("Kilroy ignoring repeated request " + str(message.getID()) + ", it is still running")
+        return True
+
+    # ----------------------------------------------------------------------------------------
+    # Reply to a protocol request and remember the reply in case the request is retried
+    # ----------------------------------------------------------------------------------------
+    def sendReply(self, message):
+        self.replay_cache.complete(message)
+        self.tcpServer.sendMessage(message)
+
+    # ----------------------------------------------------------------------------------------
+    # Copy the cached state to the status board
+    # ----------------------------------------------------------------------------------------
+    def publishStatus(self):
+        if self.status_board is not None:
+            self.status_board.publish(self.getStatusSnapshot())
+
+    # ----------------------------------------------------------------------------------------
+    # Push a progress event to a subscribed TCP client
+    # ----------------------------------------------------------------------------------------
+    def sendEvent(self, event):
+        if self.send_events and self.tcpServer.isConnected():
+            self.tcpServer.sendMessage(TCPMessage(message_type = "Kilroy Event",
+                                                  message_data = event,
+                                                  copy_data = False))
+
     # ----------------------------------------------------------------------------------------
     # Redirect commands from kilroy protocol class to valves or pump
     # ----------------------------------------------------------------------------------------
@@ -183,6 +414,8 @@ class Kilroy(QtWidgets.QMainWindow):
         command_data = self.kilroyProtocols.getCurrentCommand()
         if command_data[0] == "valve":
             self.valveChain.receiveCommand(command_data[1])
+            if self.valveChain.isCNCMoving():
+                self.kilroyProtocols.waitForMove()
         elif command_data[0] == "pump":
             self.pumpControl.receiveCommand(command_data[1])
         else:
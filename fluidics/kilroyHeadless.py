@@ -0,0 +1,243 @@
+#!/usr/bin/python
+# ----------------------------------------------------------------------------------------
+# Kilroy without Qt. The protocols of a configuration file are run on an
+# asyncio event loop and remote requests arrive through an AsyncTCPServer,
+# so a headless process can be driven by the acquisition software with
+# the same messages as the Kilroy GUI:
+#
+#   "Kilroy Status"   - answered with the state of the protocol engine
+#   "Kilroy Protocol" - test requests are answered with the duration,
+#                       other requests run the protocol and are answered
+#                       when it ends ("aborted" if a newer request
+#                       replaced it)
+#
+# Each protocol command is passed to command_handler(command) as
+# [instrument type, command name], e.g. ["valve", "Flow Buffer"]. The
+# default handler only prints the command, the valve and pump drivers
+# still need the Qt GUI.
+#
+# Usage:
+#   python kilroyHeadless.py [config xml] [port]
+# ----------------------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------------------
+# Import
+# ----------------------------------------------------------------------------------------
+import imp
+imp.load_source("setPath", "../sc_library/setPath.py")
+
+import asyncio
+import sys
+import time
+import xml.etree.ElementTree as elementTree
+from pumps.flowCalibration import FlowCalibrations, parseDuration
+from storm_control.sc_library.tcpAsyncServer import AsyncTCPServer
+
+# ----------------------------------------------------------------------------------------
+# HeadlessProtocols Class Definition
+# ----------------------------------------------------------------------------------------
+class HeadlessProtocols(object):
+    def __init__(self, xml_file_path = "default_config.xml", default_pump_ID = 30, verbose = False):
+        self.verbose = verbose
+        self.xml_file_path = xml_file_path
+        self.flow_calibrations = FlowCalibrations(default_pump_ID = default_pump_ID)
+        self.pump_durations = {} # pump command name : time to dispense its volumes
+        self.rejected_commands = {} # pump command name : why it cannot be run
+        self.protocol_names = []
+        self.protocol_commands = [] # [Instrument Type, Command Name]
+        self.protocol_durations = []
+
+        self.parseXML()
+
+    # ------------------------------------------------------------------------------------
+    # Check to see if protocol name is in the list of protocols
+    # ------------------------------------------------------------------------------------
+    def isValidProtocol(self, protocol_name):
+        return protocol_name in self.protocol_names
+
+    # ------------------------------------------------------------------------------------
+    # Return the duration of a protocol command, as in KilroyProtocols.parseDuration
+    # ------------------------------------------------------------------------------------
+    def parseDuration(self, command):
+        dispense_time = self.pump_durations.get(command.text) if (command.tag == "pump") else None
+        return parseDuration(command, dispense_time)
+
+    # ------------------------------------------------------------------------------------
+    # Parse the pump command volumes and the protocols of the configuration file
+    # ------------------------------------------------------------------------------------
+    def parseXML(self):
+        print("Parsing for protocols: " + self.xml_file_path)
+        kilroy_configuration = elementTree.parse(self.xml_file_path).getroot()
+
+        # Time needed by the pump commands that dispense a volume
+        self.flow_calibrations.parseXML(kilroy_configuration)
+        for pump_commands in kilroy_configuration.findall("pump_commands"):
+            for command in pump_commands.findall("pump_cmd"):
+                dispense_times = []
+                for pump_config in command.findall("pump_config"):
+                    if pump_config.get("volume") is not None:
+                        pump_ID = pump_config.get("pump")
+                        if pump_ID is not None:
+                            pump_ID = int(pump_ID)
+                        try:
+                            dispense_times.append(self.flow_calibrations.parseVolume(pump_config, pump_ID)[2])
+                        except ValueError as error:
+                            print("Invalid pump command " + command.get("name") + ": " + str(error))
+                            self.rejected_commands[command.get("name")] = str(error)
+                self.pump_durations[command.get("name")] = max(dispense_times) if dispense_times else None
+
+        # Protocols, as in KilroyProtocols those with a pump command that cannot be run are not loaded
+        for kilroy_protocols in kilroy_configuration.findall("kilroy_protocols"):
+            for protocol in kilroy_protocols.findall("protocol"):
+                rejected = [command.text for command in protocol
+                            if (command.tag == "pump") and (command.text in self.rejected_commands)]
+                if (len(rejected) > 0):
+                    print("Invalid protocol " + str(protocol.get("name")) + ", invalid pump commands: " + ", ".join(rejected))
+                    continue
+                self.protocol_names.append(protocol.get("name"))
+                self.protocol_commands.append([[command.tag, command.text] for command in protocol])
+                self.protocol_durations.append([self.parseDuration(command) for command in protocol])
+
+    # ------------------------------------------------------------------------------------
+    # Return the total duration of a protocol
+    # ------------------------------------------------------------------------------------
+    def requiredTime(self, protocol_name):
+        return float(sum(self.protocol_durations[self.protocol_names.index(protocol_name)]))
+
+# ----------------------------------------------------------------------------------------
+# HeadlessKilroy Class Definition
+# ----------------------------------------------------------------------------------------
+class HeadlessKilroy(object):
+    def __init__(self,
+                 command_handler = None,
+                 port = 9500,
+                 protocols_file = "default_config.xml",
+                 unix_path = None,
+                 verbose = False):
+
+        # Define attributes
+        self.command_handler = command_handler
+        self.protocols = HeadlessProtocols(xml_file_path = protocols_file, verbose = verbose)
+        self.verbose = verbose
+
+        # Protocol state
+        self.command_start_time = None
+        self.protocol_task = None
+        self.received_message = None
+        self.reply_connection = None
+        self.status = [-1, -1] # Protocol ID, command ID within protocol
+
+        # Create the server
+        self.tcpServer = AsyncTCPServer(message_handler = self.handleTCPData,
+                                        port = port,
+                                        server_name = "Kilroy",
+                                        unix_path = unix_path,
+                                        verbose = verbose)
+
+    # ------------------------------------------------------------------------------------
+    # Return the state of the protocol engine, as in KilroyProtocols.getCachedStatus
+    # ------------------------------------------------------------------------------------
+    def getCachedStatus(self):
+        protocol_ID, command_ID = self.status
+        snapshot = {"running": protocol_ID >= 0,
+                    "protocol_ID": protocol_ID,
+                    "command_ID": command_ID,
+                    "protocol": None,
+                    "command": None,
+                    "command_duration": None,
+                    "elapsed_time": None}
+        if protocol_ID >= 0:
+            snapshot["protocol"] = self.protocols.protocol_names[protocol_ID]
+            snapshot["command"] = self.protocols.protocol_commands[protocol_ID][command_ID]
+            snapshot["command_duration"] = self.protocols.protocol_durations[protocol_ID][command_ID]
+            snapshot["elapsed_time"] = time.time() - self.command_start_time
+        return snapshot
+
+    # ------------------------------------------------------------------------------------
+    # Handle a message from a client
+    # ------------------------------------------------------------------------------------
+    def handleTCPData(self, message, connection):
+        if message.isType("Kilroy Status"):
+            message.addResponse("protocol", self.getCachedStatus())
+            connection.sendMessage(message)
+        elif not message.isType("Kilroy Protocol"):
+            message.setError(True, "Wrong message type sent to Kilroy: " + str(message.getType()))
+            connection.sendMessage(message)
+        elif not self.protocols.isValidProtocol(message.getData("name")):
+            message.setError(True, "Invalid Kilroy Protocol")
+            connection.sendMessage(message)
+        elif message.isTest():
+            message.addResponse("duration", self.protocols.requiredTime(message.getData("name")))
+            connection.sendMessage(message)
+        else:
+            self.startProtocol(message, connection)
+
+    # ------------------------------------------------------------------------------------
+    # Pass a command to the command handler
+    # ------------------------------------------------------------------------------------
+    def issueCommand(self, command):
+        if self.command_handler is not None:
+            self.command_handler(command)
+        elif self.verbose:
+            print("Issued " + command[0] + ": " + command[1])
+
+    # ------------------------------------------------------------------------------------
+    # Issue the commands of a protocol, waiting the duration of each one
+    # ------------------------------------------------------------------------------------
+    async def runProtocol(self, protocol_ID):
+        commands = self.protocols.protocol_commands[protocol_ID]
+        durations = self.protocols.protocol_durations[protocol_ID]
+        for command_ID in range(len(commands)):
+            self.status = [protocol_ID, command_ID]
+            self.command_start_time = time.time()
+            self.issueCommand(commands[command_ID])
+            await asyncio.sleep(durations[command_ID])
+        self.stopProtocol(completed = True)
+
+    # ------------------------------------------------------------------------------------
+    # Run a protocol requested by a client, a running protocol is aborted
+    # ------------------------------------------------------------------------------------
+    def startProtocol(self, message, connection):
+        if (self.status[0] >= 0):
+            if self.verbose:
+                print("Stopped In Progress: " + self.protocols.protocol_names[self.status[0]])
+            self.stopProtocol()
+        self.received_message = message
+        self.reply_connection = connection
+        protocol_ID = self.protocols.protocol_names.index(message.getData("name"))
+        self.protocol_task = asyncio.get_running_loop().create_task(self.runProtocol(protocol_ID))
+
+    # ------------------------------------------------------------------------------------
+    # Stop a running protocol either on completion or early and reply to its request
+    # ------------------------------------------------------------------------------------
+    def stopProtocol(self, completed = False):
+        if not completed and (self.protocol_task is not None):
+            self.protocol_task.cancel()
+            self.received_message.addResponse("aborted", True)
+        if self.received_message is not None:
+            self.reply_connection.sendMessage(self.received_message)
+        self.protocol_task = None
+        self.received_message = None
+        self.reply_connection = None
+        self.status = [-1, -1]
+
+    # ------------------------------------------------------------------------------------
+    # Serve requests until cancelled
+    # ------------------------------------------------------------------------------------
+    async def serveForever(self):
+        try:
+            await self.tcpServer.serveForever()
+        finally:
+            self.tcpServer.close()
+
+# ----------------------------------------------------------------------------------------
+# Runtime code: serve the protocols of a configuration file
+# ----------------------------------------------------------------------------------------
+if (__name__ == "__main__"):
+    protocols_file = sys.argv[1] if (len(sys.argv) > 1) else "default_config.xml"
+    port = int(sys.argv[2]) if (len(sys.argv) > 2) else 9500
+    kilroy = HeadlessKilroy(port = port, protocols_file = protocols_file, verbose = True)
+    try:
+        asyncio.run(kilroy.serveForever())
+    except KeyboardInterrupt:
+        print("\nKilroy was here!")
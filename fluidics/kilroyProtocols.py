@@ -15,10 +15,12 @@
 # ----------------------------------------------------------------------------------------
 import sys
 import os
+import time
 import xml.etree.ElementTree as elementTree
 from PyQt5 import QtCore, QtGui, QtWidgets
 from valves.valveCommands import ValveCommands  # storm_control.fluidics.
 from pumps.pumpCommands import PumpCommands  #  storm_control.fluidics.
+from pumps.flowCalibration import parseDuration
 
 # ----------------------------------------------------------------------------------------
 # KilroyProtocols Class Definition
@@ -29,10 +31,12 @@ class KilroyProtocols(QtWidgets.QMainWindow):
     command_ready_signal = QtCore.pyqtSignal() # A command is ready to be issued
     status_change_signal = QtCore.pyqtSignal() # A protocol status change occured
     completed_protocol_signal = QtCore.pyqtSignal(object) # Name of completed protocol
+    progress_signal = QtCore.pyqtSignal(object) # Dictionary describing protocol progress
         
     def __init__(self,
                  protocol_xml_path = "default_config.xml",
                  command_xml_path = "default_config.xml",
+                 default_pump_ID = 30,
                  verbose = False):
         super(KilroyProtocols, self).__init__()
 
@@ -47,6 +51,9 @@ class KilroyProtocols(QtWidgets.QMainWindow):
         self.status = [-1, -1] # Protocol ID, command ID within protocol
         self.issued_command = []
         self.received_message = None
+        self.protocol_completed = False # Did the protocol run to its last command?
+        self.move_pending = False # Is a CNC move issued by the protocol still running?
+        self.advance_pending = False # Did the command time run out during that move?
 
         print("----------------------------------------------------------------------")
         
@@ -61,6 +68,7 @@ class KilroyProtocols(QtWidgets.QMainWindow):
 
         # Create instance of PumpCommands class
         self.pumpCommands = PumpCommands(xml_file_path = self.command_xml_path,
+                                         default_pump_ID = default_pump_ID,
                                          verbose = self.verbose)
 
         # Connect pump commands issue signal
@@ -87,19 +95,26 @@ class KilroyProtocols(QtWidgets.QMainWindow):
     # Advance the protocol to the next command and issue it
     # ------------------------------------------------------------------------------------       
     def advanceProtocol(self):
+        if self.move_pending:
+            # Wait for the CNC to arrive before issuing the next command
+            self.advance_pending = True
+            return
         status = self.status
         protocol_ID = self.status[0]
         command_ID = self.status[1] + 1
+        self.emitProgress("step_finished", elapsed_time = self.elapsed_timer.elapsed()/1000.0)
         if command_ID < len(self.protocol_commands[protocol_ID]):
             command_name = self.protocol_commands[protocol_ID][command_ID]
             command_duration = self.protocol_durations[protocol_ID][command_ID]
             self.status = [protocol_ID, command_ID]
+            self.emitProgress("step_started", elapsed_time = 0.0)
             self.issueCommand(command_name, command_duration)
 
             self.elapsed_timer.start()
 
             self.protocolDetailsList.setCurrentRow(command_ID)
         else:
+            self.protocol_completed = True
             self.stopProtocol()
 
     # ------------------------------------------------------------------------------------
@@ -167,6 +182,26 @@ class KilroyProtocols(QtWidgets.QMainWindow):
         self.skipCommandButton.setEnabled(False)
         self.stopProtocolButton.setEnabled(False)
 
+    # ------------------------------------------------------------------------------------
+    # Emit a progress event for the running protocol
+    # ------------------------------------------------------------------------------------                                    
+    def emitProgress(self, event, elapsed_time = None, **kwds):
+        protocol_ID, command_ID = self.status
+        if elapsed_time is None:
+            elapsed_time = self.elapsed_timer.elapsed()/1000.0
+        progress = {"event": event,
+                    "time": time.time(),
+                    "protocol": self.protocol_names[protocol_ID],
+                    "command_ID": command_ID,
+                    "command": self.protocol_commands[protocol_ID][command_ID],
+                    "duration": self.protocol_durations[protocol_ID][command_ID],
+                    "elapsed_time": elapsed_time,
+                    "remaining_time": self.remainingTime(elapsed_time)}
+        if self.received_message is not None:
+            progress["request_ID"] = self.received_message.getID()
+        progress.update(kwds)
+        self.progress_signal.emit(progress)
+
     # ------------------------------------------------------------------------------------
     # Return current command
     # ------------------------------------------------------------------------------------                                    
@@ -185,6 +220,26 @@ class KilroyProtocols(QtWidgets.QMainWindow):
     def getStatus(self):
         return self.status # [protocol_ID, command_ID] -1 = no active protocol
 
+    # ------------------------------------------------------------------------------------
+    # Return a snapshot of the protocol state without touching any hardware
+    # ------------------------------------------------------------------------------------                                        
+    def getCachedStatus(self):
+        protocol_ID, command_ID = self.status
+        snapshot = {"running": protocol_ID >= 0,
+                    "protocol_ID": protocol_ID,
+                    "command_ID": command_ID,
+                    "protocol": None,
+                    "command": None,
+                    "command_duration": None,
+                    "elapsed_time": None}
+        if protocol_ID >= 0:
+            snapshot["protocol"] = self.protocol_names[protocol_ID]
+            snapshot["command"] = self.protocol_commands[protocol_ID][command_ID]
+            snapshot["command_duration"] = self.protocol_durations[protocol_ID][command_ID]
+            if self.elapsed_timer.isValid():
+                snapshot["elapsed_time"] = self.elapsed_timer.elapsed()/1000.0
+        return snapshot
+
     # ------------------------------------------------------------------------------------
     # Return a protocol index by name
     # ------------------------------------------------------------------------------------                                        
@@ -202,6 +257,15 @@ class KilroyProtocols(QtWidgets.QMainWindow):
     def getProtocolNames(self):
         return self.protocol_names
 
+    # ------------------------------------------------------------------------------------
+    # Advance a protocol that was waiting for its CNC move to finish
+    # ------------------------------------------------------------------------------------
+    def handleMoveComplete(self):
+        self.move_pending = False
+        if self.advance_pending:
+            self.advance_pending = False
+            self.advanceProtocol()
+
     # ------------------------------------------------------------------------------------
     # Issue a command: load current command, send command ready signal
     # ------------------------------------------------------------------------------------                       
@@ -329,11 +393,17 @@ class KilroyProtocols(QtWidgets.QMainWindow):
         for kilroy_protocols in self.kilroy_configuration.findall("kilroy_protocols"):
             protocol_list = kilroy_protocols.findall("protocol")
             for protocol in protocol_list:
+                # A protocol with a pump command that was not loaded cannot run
+                rejected = [command.text for command in protocol
+                            if (command.tag == "pump") and (self.pumpCommands.getRejection(command.text) is not None)]
+                if (len(rejected) > 0):
+                    print("Invalid protocol " + str(protocol.get("name")) + ", invalid pump commands: " + ", ".join(rejected))
+                    continue
                 self.protocol_names.append(protocol.get("name"))
                 new_protocol_commands = []
                 new_protocol_durations = []
                 for command in protocol: # Get all children
-                    new_protocol_durations.append(int(command.get("duration")))
+                    new_protocol_durations.append(self.parseDuration(command))
                     new_protocol_commands.append([command.tag,command.text]) # [Instrument Type, Command Name]
                     if (not (command.tag == "pump")) and (not (command.tag == "valve")):
                         print("Unknown command tag: " + command.tag)
@@ -343,6 +413,16 @@ class KilroyProtocols(QtWidgets.QMainWindow):
         # Record number of configs
         self.num_protocols = len(self.protocol_names)
 
+    # ------------------------------------------------------------------------------------
+    # Return the duration of a protocol command, "auto" is the time a pump command
+    #   needs to dispense its volume
+    # ------------------------------------------------------------------------------------                                                
+    def parseDuration(self, command):
+        dispense_time = None
+        if (command.tag == "pump"):
+            dispense_time = self.pumpCommands.getCommandDuration(command.text)
+        return parseDuration(command, dispense_time)
+
     # ------------------------------------------------------------------------------------
     # Display loaded protocols
     # ------------------------------------------------------------------------------------                                                
@@ -361,11 +441,22 @@ class KilroyProtocols(QtWidgets.QMainWindow):
     def requiredTime(self, protocol_name):
         protocol_ID = self.protocol_names.index(protocol_name)
         total_time = 0.0
-        for time in self.protocol_durations[protocol_ID]:
-            total_time += time
+        for command_time in self.protocol_durations[protocol_ID]:
+            total_time += command_time
 
         return total_time
         
+    # ------------------------------------------------------------------------------------
+    # Time left in the running protocol given the time spent on the current command
+    # ------------------------------------------------------------------------------------
+    def remainingTime(self, elapsed_time = 0.0):
+        protocol_ID, command_ID = self.status
+        if protocol_ID < 0:
+            return 0.0
+        durations = self.protocol_durations[protocol_ID]
+        current_remaining = max(durations[command_ID] - elapsed_time, 0.0)
+        return current_remaining + sum(durations[(command_ID + 1):])
+
     # ------------------------------------------------------------------------------------
     # Initialize and start a protocol and issue first command
     # ------------------------------------------------------------------------------------
@@ -389,6 +480,7 @@ class KilroyProtocols(QtWidgets.QMainWindow):
         
         if self.verbose:
             print("Starting " + self.protocol_names[protocol_ID])
+        self.emitProgress("step_started", elapsed_time = 0.0)
 
         # Issue command signal
         self.issueCommand(command_data, command_duration)
@@ -434,8 +526,9 @@ class KilroyProtocols(QtWidgets.QMainWindow):
     # ------------------------------------------------------------------------------------
     # Initialize and start a protocol specified by a TCP message
     # ------------------------------------------------------------------------------------
-    def startProtocolRemotely(self, message):
-        protocol_name = message.getData("name")
+    def startProtocolRemotely(self, message, protocol_name = None):
+        if protocol_name is None:
+            protocol_name = message.getData("name")
         if self.isValidProtocol(protocol_name):
             if self.isRunningProtocol():
                 if self.verbose:
@@ -457,9 +550,15 @@ class KilroyProtocols(QtWidgets.QMainWindow):
         # Get name of current protocol
         if self.status[0] >= 0:
             if self.verbose: print("Stopped Protocol")
+            if (self.received_message is not None) and not self.protocol_completed:
+                self.received_message.addResponse("aborted", True)
+            self.emitProgress("protocol_finished", aborted = not self.protocol_completed)
             self.completed_protocol_signal.emit(self.received_message)
         
         # Reset status and emit status change signal
+        self.protocol_completed = False
+        self.move_pending = False
+        self.advance_pending = False
         self.status = [-1,-1]
         self.status_change_signal.emit()
         self.received_message = None
@@ -486,6 +585,12 @@ class KilroyProtocols(QtWidgets.QMainWindow):
         self.poll_elapsed_time_timer.stop()
         self.elapsedTimeLabel.setText("Elapsed Time:")
 
+    # ------------------------------------------------------------------------------------
+    # Hold the next command until handleMoveComplete() is called
+    # ------------------------------------------------------------------------------------
+    def waitForMove(self):
+        self.move_pending = self.isRunningProtocol()
+
     # ------------------------------------------------------------------------------------
     # Display time elapsed since previous command was issued
     # ------------------------------------------------------------------------------------                       
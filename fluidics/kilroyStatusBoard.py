@@ -0,0 +1,268 @@
+#!/usr/bin/python
+# ----------------------------------------------------------------------------------------
+# A fixed layout, memory mapped file that Kilroy updates with its live
+# state (protocol, valves, pump and CNC). Other programs on the same
+# computer can read a consistent snapshot of this state without a TCP
+# round trip and without any work on the Kilroy GUI thread.
+#
+# Consistency is provided by a sequence lock. The writer makes the
+# sequence number odd before it changes the record and even again when
+# it is done. A reader copies the record and only keeps the copy if the
+# sequence number was even and did not change while it was copying.
+#
+# Usage from another process:
+#   reader = StatusBoardReader("/dev/shm/kilroy_status")
+#   status = reader.read()
+# ----------------------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------------------
+# Import
+# ----------------------------------------------------------------------------------------
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+
+# ----------------------------------------------------------------------------------------
+# Record layout (little endian)
+# ----------------------------------------------------------------------------------------
+MAGIC = b"KLRY"
+VERSION = 1
+MAX_VALVES = 16
+STRING_LENGTH = 32
+
+# magic, version, max valves, sequence number
+HEADER = struct.Struct("<4sHHQ")
+
+# update time, protocol (running, protocol ID, command ID, elapsed time, command duration,
+# protocol name, command name), pump (flow status, speed, direction), cnc (present,
+# moving, port, x, y, z), number of valves
+BODY = struct.Struct("<d?iidd" + str(STRING_LENGTH) + "s" + str(STRING_LENGTH) + "s" +
+                     str(STRING_LENGTH) + "sd" + str(STRING_LENGTH) + "s" +
+                     "??" + str(STRING_LENGTH) + "sdddH")
+
+# port, moving
+VALVE = struct.Struct("<" + str(STRING_LENGTH) + "s?")
+
+SEQUENCE_OFFSET = 8
+BODY_OFFSET = HEADER.size
+VALVES_OFFSET = BODY_OFFSET + BODY.size
+RECORD_SIZE = VALVES_OFFSET + MAX_VALVES * VALVE.size
+
+# ----------------------------------------------------------------------------------------
+# Helper functions
+# ----------------------------------------------------------------------------------------
+def toBytes(value):
+    if value is None:
+        return b""
+    return str(value).encode("utf-8")[:STRING_LENGTH]
+
+def toFloat(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+def toString(value):
+    return value.rstrip(b"\x00").decode("utf-8", "replace")
+
+def toOptional(value):
+    return None if math.isnan(value) else value
+
+# ----------------------------------------------------------------------------------------
+# StatusBoardWriter Class Definition
+# ----------------------------------------------------------------------------------------
+class StatusBoardWriter(object):
+    def __init__(self, path = "/dev/shm/kilroy_status"):
+        self.path = path
+        self.sequence = 0
+
+        # Create the file with the full record size and map it
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(self.fd, RECORD_SIZE)
+        self.board = mmap.mmap(self.fd, RECORD_SIZE)
+        HEADER.pack_into(self.board, 0, MAGIC, VERSION, MAX_VALVES, self.sequence)
+
+    # ------------------------------------------------------------------------------------
+    # Close the board and remove the file
+    # ------------------------------------------------------------------------------------
+    def close(self):
+        if self.board is not None:
+            self.board.close()
+            os.close(self.fd)
+            os.remove(self.path)
+            self.board = None
+
+    # ------------------------------------------------------------------------------------
+    # Write a snapshot as returned by Kilroy.getStatusSnapshot()
+    # ------------------------------------------------------------------------------------
+    def publish(self, snapshot):
+        protocol = snapshot.get("protocol", {})
+        pump = snapshot.get("pump", {})
+        cnc = snapshot.get("cnc")
+        valves = snapshot.get("valves", [])[:MAX_VALVES]
+
+        # The protocol command is [instrument type, command name], only the name is stored
+        command = protocol.get("command")
+        if isinstance(command, (list, tuple)):
+            command = command[1]
+
+        if cnc is not None and cnc["position"] is not None:
+            [x, y, z] = [toFloat(value) for value in cnc["position"]]
+        else:
+            [x, y, z] = [math.nan] * 3
+
+        body = BODY.pack(time.time(),
+                         bool(protocol.get("running", False)),
+                         protocol.get("protocol_ID", -1),
+                         protocol.get("command_ID", -1),
+                         toFloat(protocol.get("elapsed_time")),
+                         toFloat(protocol.get("command_duration")),
+                         toBytes(protocol.get("protocol")),
+                         toBytes(command),
+                         toBytes(pump.get("flow_status")),
+                         toFloat(pump.get("speed")),
+                         toBytes(pump.get("direction")),
+                         cnc is not None,
+                         cnc is not None and cnc["moving"],
+                         toBytes(cnc["port"] if cnc is not None else None),
+                         x, y, z,
+                         len(valves))
+        valve_records = b"".join([VALVE.pack(toBytes(valve["port"]), valve["moving"]) for valve in valves])
+
+        # Odd sequence number while the record is being changed
+        self.sequence += 1
+        struct.pack_into("<Q", self.board, SEQUENCE_OFFSET, self.sequence)
+        self.board[BODY_OFFSET:BODY_OFFSET + len(body)] = body
+        self.board[VALVES_OFFSET:VALVES_OFFSET + len(valve_records)] = valve_records
+        self.sequence += 1
+        struct.pack_into("<Q", self.board, SEQUENCE_OFFSET, self.sequence)
+
+# ----------------------------------------------------------------------------------------
+# StatusBoardReader Class Definition
+# ----------------------------------------------------------------------------------------
+class StatusBoardReader(object):
+    def __init__(self, path = "/dev/shm/kilroy_status"):
+        self.path = path
+        with open(self.path, "rb") as fp:
+            self.board = mmap.mmap(fp.fileno(), RECORD_SIZE, access = mmap.ACCESS_READ)
+        [magic, version, max_valves, sequence] = HEADER.unpack_from(self.board, 0)
+        if (magic != MAGIC) or (version != VERSION) or (max_valves != MAX_VALVES):
+            self.board.close()
+            raise ValueError(self.path + " is not a version " + str(VERSION) + " Kilroy status board")
+
+    # ------------------------------------------------------------------------------------
+    # Close the board
+    # ------------------------------------------------------------------------------------
+    def close(self):
+        self.board.close()
+
+    # ------------------------------------------------------------------------------------
+    # Return a consistent snapshot, or None if the writer was always busy
+    # ------------------------------------------------------------------------------------
+    def read(self, retries = 100):
+        for i in range(retries):
+            [start] = struct.unpack_from("<Q", self.board, SEQUENCE_OFFSET)
+            if (start % 2) == 1:
+                continue
+            record = self.board[BODY_OFFSET:RECORD_SIZE]
+            [end] = struct.unpack_from("<Q", self.board, SEQUENCE_OFFSET)
+            if (start == end):
+                return self.unpack(record, start)
+        return None
+
+    # ------------------------------------------------------------------------------------
+    # Convert a copy of the record to the same dictionary as Kilroy.getStatusSnapshot()
+    # ------------------------------------------------------------------------------------
+    def unpack(self, record, sequence):
+        values = BODY.unpack_from(record, 0)
+        snapshot = {"sequence": sequence,
+                    "time": values[0],
+                    "protocol": {"running": values[1],
+                                 "protocol_ID": values[2],
+                                 "command_ID": values[3],
+                                 "elapsed_time": toOptional(values[4]),
+                                 "command_duration": toOptional(values[5]),
+                                 "protocol": toString(values[6]) or None,
+                                 "command": toString(values[7]) or None},
+                    "pump": {"flow_status": toString(values[8]),
+                             "speed": toOptional(values[9]),
+                             "direction": toString(values[10])},
+                    "valves": []}
+        if values[11]:
+            position = [toOptional(value) for value in values[14:17]]
+            snapshot["cnc"] = {"port": toString(values[13]),
+                               "moving": values[12],
+                               "position": None if position[0] is None else position}
+        for i in range(values[17]):
+            [port, moving] = VALVE.unpack_from(record, BODY.size + i * VALVE.size)
+            snapshot["valves"].append({"port": toString(port), "moving": moving})
+        return snapshot
+
+# ----------------------------------------------------------------------------------------
+# Self checks of the sequence lock, a reader never sees a half written record
+# ----------------------------------------------------------------------------------------
+def selfCheck():
+    import tempfile
+    import threading
+
+    path = os.path.join(tempfile.mkdtemp(), "kilroy_status")
+    writer = StatusBoardWriter(path)
+    reader = StatusBoardReader(path)
+
+    def snapshot(i):
+        return {"protocol": {"running": True, "protocol_ID": i, "command_ID": i,
+                             "command": ["valve", "Command " + str(i)]},
+                "pump": {"flow_status": "Flowing", "speed": float(i), "direction": "Forward"},
+                "cnc": {"port": "Well " + str(i), "moving": False, "position": [i, i, i]},
+                "valves": [{"port": "Port " + str(i), "moving": False}] * (1 + i % MAX_VALVES)}
+
+    writer.publish(snapshot(3))
+    status = reader.read()
+    assert (status["sequence"] == 2)
+    assert (status["protocol"]["command"] == "Command 3")
+    assert (status["cnc"]["position"] == [3.0, 3.0, 3.0])
+    assert (status["valves"] == [{"port": "Port 3", "moving": False}] * 4)
+
+    # A writer that is busy, i.e. an odd sequence number
+    struct.pack_into("<Q", writer.board, SEQUENCE_OFFSET, 3)
+    assert reader.read(retries = 10) is None
+    struct.pack_into("<Q", writer.board, SEQUENCE_OFFSET, 2)
+
+    # Every snapshot read while the writer is busy belongs to a single publish()
+    def publish():
+        for i in range(20000):
+            writer.publish(snapshot(i))
+    thread = threading.Thread(target = publish)
+    thread.start()
+    while thread.is_alive():
+        status = reader.read()
+        if status is not None:
+            i = status["protocol"]["protocol_ID"]
+            assert (status["sequence"] % 2 == 0)
+            assert (status["protocol"]["command_ID"] == i) and (status["pump"]["speed"] == i)
+            assert (status["cnc"]["port"] == "Well " + str(i))
+            assert (status["valves"] == [{"port": "Port " + str(i), "moving": False}] * (1 + i % MAX_VALVES))
+    thread.join()
+
+    reader.close()
+    writer.close()
+    os.rmdir(os.path.dirname(path))
+    print("Status board self checks passed")
+
+# ----------------------------------------------------------------------------------------
+# Print the status board of a running Kilroy, or run the self checks
+# ----------------------------------------------------------------------------------------
+if (__name__ == "__main__"):
+    if (len(sys.argv) == 1):
+        selfCheck()
+        sys.exit()
+    if (len(sys.argv) != 2):
+        print("usage: kilroyStatusBoard.py [status_board_path]")
+        sys.exit()
+    reader = StatusBoardReader(sys.argv[1])
+    print(reader.read())
+    reader.close()
+
@@ -0,0 +1,176 @@
+#!/usr/bin/python
+# ----------------------------------------------------------------------------------------
+# Flow rate calibration curves for the pumps, i.e. the measured flow rate
+# (uL/min) at several speeds (rpm) for each pump and tubing. These are
+# used to convert a volume to dispense into a time at a given speed.
+#
+# Calibrations are read from the commands xml file, e.g.
+#
+#  <pump_calibrations>
+#    <pump_calibration pump = "30" tubing = "orange/yellow" max_speed = "40.0">
+#      <point rpm = "0.0" flow = "0.0"></point>
+#      <point rpm = "20.0" flow = "300.0"></point>
+#      <point rpm = "40.0" flow = "600.0"></point>
+#    </pump_calibration>
+#  </pump_calibrations>
+#
+# pump and tubing are optional, a calibration without them applies to
+# all pumps (or tubing) that do not have their own. A pump_config without
+# a pump attribute is for the default pump (the first pump of Kilroy).
+# ----------------------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------------------
+# Import
+# ----------------------------------------------------------------------------------------
+import math
+
+# ----------------------------------------------------------------------------------------
+# FlowCalibration Class Definition
+# ----------------------------------------------------------------------------------------
+class FlowCalibration(object):
+    def __init__(self, points, max_speed = 48.0):
+        # Calibration points sorted by speed, [[rpm, uL/min], ..]
+        self.points = sorted(points)
+        self.max_speed = max_speed
+        if (len(self.points) == 0):
+            raise ValueError("A flow calibration needs at least one point")
+        if (len(self.points) == 1):
+            self.points = [[0.0, 0.0]] + self.points
+
+    # ------------------------------------------------------------------------------------
+    # Return the time in seconds to dispense volume (uL) at speed (rpm)
+    # ------------------------------------------------------------------------------------
+    def dispenseTime(self, volume, speed = None):
+        if speed is None:
+            speed = self.max_speed
+        flow_rate = self.flowRate(speed)
+        if (flow_rate <= 0.0):
+            raise ValueError("No flow at " + str(speed) + " rpm")
+        return 60.0 * volume/flow_rate
+
+    # ------------------------------------------------------------------------------------
+    # Return the flow rate (uL/min) at speed (rpm), linear between (and beyond) the points
+    # ------------------------------------------------------------------------------------
+    def flowRate(self, speed):
+        index = 1
+        while (index < len(self.points) - 1) and (speed > self.points[index][0]):
+            index += 1
+        [[rpm_0, flow_0], [rpm_1, flow_1]] = self.points[index - 1:index + 1]
+        if (rpm_1 == rpm_0):
+            return flow_1
+        return flow_0 + (flow_1 - flow_0) * (speed - rpm_0)/(rpm_1 - rpm_0)
+
+# ----------------------------------------------------------------------------------------
+# FlowCalibrations Class Definition
+# ----------------------------------------------------------------------------------------
+class FlowCalibrations(object):
+    def __init__(self, default_pump_ID = 30):
+        self.calibrations = {} # (pump ID, tubing) : FlowCalibration
+        self.default_pump_ID = default_pump_ID # The pump of a pump_config without a pump ID
+
+    # ------------------------------------------------------------------------------------
+    # Return the calibration of a pump and tubing, or None if there is none
+    # ------------------------------------------------------------------------------------
+    def getCalibration(self, pump_ID = None, tubing = None):
+        if pump_ID is None:
+            pump_ID = self.default_pump_ID
+        for key in [(pump_ID, tubing), (pump_ID, None), (None, tubing), (None, None)]:
+            if key in self.calibrations:
+                return self.calibrations[key]
+        return None
+
+    # ------------------------------------------------------------------------------------
+    # Parse the pump_calibration elements of a kilroy configuration
+    # ------------------------------------------------------------------------------------
+    def parseXML(self, kilroy_configuration):
+        self.calibrations = {}
+        for pump_calibrations in kilroy_configuration.findall("pump_calibrations"):
+            for calibration in pump_calibrations.findall("pump_calibration"):
+                pump_ID = calibration.get("pump")
+                if pump_ID is not None:
+                    pump_ID = int(pump_ID)
+                points = [[float(point.get("rpm")), float(point.get("flow"))]
+                          for point in calibration.findall("point")]
+                try:
+                    self.calibrations[(pump_ID, calibration.get("tubing"))] = \
+                        FlowCalibration(points, max_speed = float(calibration.get("max_speed", 48.0)))
+                except ValueError as error:
+                    print("Invalid pump calibration: " + str(error))
+
+    # ------------------------------------------------------------------------------------
+    # Parse a volume (uL) pump config into [direction, speed, dispense time], raises
+    #   ValueError if the volume cannot be dispensed
+    # ------------------------------------------------------------------------------------
+    def parseVolume(self, pump_config, pump_ID):
+        direction = pump_config.get("direction", "Forward")
+        if pump_ID is None:
+            pump_ID = self.default_pump_ID
+        calibration = self.getCalibration(pump_ID, pump_config.get("tubing"))
+        if calibration is None:
+            raise ValueError("No flow calibration for pump " + str(pump_ID) + ", cannot dispense a volume")
+
+        # Use the fastest safe speed unless a speed is given
+        speed = calibration.max_speed
+        if pump_config.get("speed") is not None:
+            speed = min(float(pump_config.get("speed")), calibration.max_speed)
+        dispense_time = calibration.dispenseTime(float(pump_config.get("volume")), speed)
+        return [direction, speed, dispense_time]
+
+# ----------------------------------------------------------------------------------------
+# Return the duration (s) of a protocol command, "auto" is the time its pump command
+#   needs to dispense its volume (dispense_time, None if it has no volume)
+# ----------------------------------------------------------------------------------------
+def parseDuration(command, dispense_time = None):
+    duration = command.get("duration")
+    if (duration == "auto"):
+        if dispense_time is None:
+            print("No dispense volume for " + str(command.text) + ", auto duration set to 0 s")
+            return 0
+        return int(math.ceil(dispense_time))
+    duration = int(duration)
+    if (dispense_time is not None) and (duration < dispense_time):
+        print("Warning: " + str(command.text) + " needs " + str(int(math.ceil(dispense_time))) + " s to dispense its volume")
+    return duration
+
+# ----------------------------------------------------------------------------------------
+# Test/Demo of Class
+# ----------------------------------------------------------------------------------------
+if (__name__ == "__main__"):
+    calibration = FlowCalibration([[0.0, 0.0], [20.0, 300.0], [40.0, 600.0]], max_speed = 40.0)
+    print("Flow at 30 rpm: " + str(calibration.flowRate(30.0)) + " uL/min")
+    print("500 uL at the maximum speed takes " + str(calibration.dispenseTime(500.0)) + " s")
+
+    # Self checks
+    import xml.etree.ElementTree as elementTree
+    assert math.isclose(calibration.flowRate(30.0), 450.0)
+    assert math.isclose(calibration.flowRate(50.0), 750.0) # Extrapolated
+    assert math.isclose(calibration.dispenseTime(600.0), 60.0)
+    assert math.isclose(calibration.dispenseTime(150.0, 10.0), 60.0)
+    assert math.isclose(FlowCalibration([[20.0, 300.0]]).dispenseTime(300.0, 20.0), 60.0)
+    for [points, speed] in [[[], None], [[[0.0, 0.0], [20.0, 300.0]], 0.0]]:
+        try:
+            FlowCalibration(points).dispenseTime(100.0, speed)
+        except ValueError:
+            pass
+        else:
+            assert False, "No flow at " + str(speed) + " rpm was accepted"
+
+    calibrations = FlowCalibrations(default_pump_ID = 30)
+    calibrations.calibrations[(30, None)] = calibration
+    assert calibrations.getCalibration() is calibration
+    assert calibrations.getCalibration(30, "orange/yellow") is calibration
+    assert calibrations.getCalibration(31) is None
+    config = elementTree.fromstring('<pump_config volume = "300" speed = "80"></pump_config>')
+    assert calibrations.parseVolume(config, None) == ["Forward", 40.0, 30.0] # Limited to max_speed
+    try:
+        calibrations.parseVolume(config, 31)
+    except ValueError:
+        pass
+    else:
+        assert False, "A volume without a calibration was accepted"
+
+    command = elementTree.fromstring('<valve_command duration = "auto">Flush</valve_command>')
+    assert (parseDuration(command, 29.2) == 30)
+    command.set("duration", "10")
+    assert (parseDuration(command, 29.2) == 10)
+    print("Flow calibration self checks passed")
@@ -10,28 +10,86 @@
 # ----------------------------------------------------------------------------------------
 # Import
 # ----------------------------------------------------------------------------------------
+import collections
+import contextlib
+import os
 import serial
+import sys
+import threading
 import time
 
+from pumps.pumpTransaction import PumpTimeoutError, TransactionStats
+
 acknowledge = '\x06'
 start = '\x0A'
 stop = '\x0D'
 
+# Open buses by serial port so that several pumps can share one port
+buses = {}
+
+def getBus(parameters):
+    """
+    Return the bus for the pump serial port, creating it if needed.
+    """
+    com_port = parameters.get("pump_com_port", "COM3")
+    if not com_port in buses:
+        buses[com_port] = GSIOCBus(parameters = parameters)
+    buses[com_port].users += 1
+    return buses[com_port]
+
 # ----------------------------------------------------------------------------------------
-# GlisonMP3 Class Definition
+# GSIOCBus Class Definition
 # ----------------------------------------------------------------------------------------
-class APump():
+class GSIOCBus():
+    """
+    A Gilson GSIOC serial line shared by one or more pumps. Buffered
+    commands can be queued inside batch() and are then sent together,
+    which selects each unit once for all of its queued commands and
+    takes turns between the units.
+
+    A unit stays selected between commands (see session()), so a burst
+    of commands to one pump only selects it once.
+
+    Every transaction runs under a deadline with a retry budget and
+    raises PumpTimeoutError if a unit stops answering.
+    """
     def __init__(self,
                  parameters = False):
 
-        # Define attributes
         self.com_port = parameters.get("pump_com_port", "COM3")
-        self.pump_ID = parameters.get("pump_ID", 30)
-        self.verbose = parameters.get("verbose", True)
-        self.simulate = parameters.get("simulate_pump", True)
-        self.serial_verbose = parameters.get("serial_verbose", False)
-        self.flip_flow_direction = parameters.get("flip_flow_direction", False)
-        
+        self.max_batch = 8 # Most commands sent to one unit before moving to the next
+        self.queues = collections.OrderedDict() # unit number : [commands]
+        self.batching = False
+        self.users = 0
+
+        # Unit selection sessions
+        self.lock = threading.RLock()
+        self.release_timer = None
+        self.selected_unit = None
+        self.session_depth = 0
+        self.session_timeout = parameters.get("pump_session_timeout", 0.5) # seconds, 0 deselects after every command
+
+        # Traffic statistics
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.round_trips = 0
+        self.transactions = TransactionStats(retries = parameters.get("pump_retries", 1),
+                                             timeout = parameters.get("pump_transaction_timeout", 1.0),
+                                             recover = self.clearInput,
+                                             verbose = parameters.get("verbose", True))
+
+        # Serve simulated pumps on a pseudo terminal
+        self.simulator = None
+        if parameters.get("simulate_pump", True):
+            if (os.name != "posix"):
+                raise Exception("The Gilson pump simulator needs a pseudo terminal, which is not available on " + sys.platform + ". Set simulate_pump to False to use the pump on " + str(self.com_port))
+            from pumps.gsioc_simulator import GSIOCSimulator
+            pump_IDs = parsePumpIDs(parameters)
+            self.simulator = GSIOCSimulator(unit_IDs = pump_IDs,
+                                            verbose = parameters.get("verbose", True))
+            self.com_port = self.simulator.getPortName()
+            print("Simulating Gilson pumps " + str(pump_IDs) + " on " + self.com_port)
+
         # Create serial port
         self.serial = serial.Serial(port = self.com_port, 
                                     baudrate = 19200, 
@@ -40,15 +98,253 @@ class APump():
                                     stopbits=serial.STOPBITS_TWO, 
                                     timeout=0.1)
 
+    def close(self):
+        self.users -= 1
+        if (self.users > 0):
+            return
+        for [com_port, bus] in list(buses.items()):
+            if bus is self:
+                del buses[com_port]
+        with self.lock:
+            self.cancelRelease()
+            if self.selected_unit is not None:
+                self.disconnect()
+        self.serial.close()
+        if self.simulator is not None:
+            self.simulator.close()
+
+    def clearInput(self):
+        """
+        Discard unread characters, e.g. a late reply to a transaction that timed out.
+        """
+        self.serial.reset_input_buffer()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Queue buffered commands and send them with flush() at the end.
+        If the block raises the queued commands are dropped, batching
+        stops either way.
+        """
+        self.startBatch()
+        try:
+            yield
+        except BaseException:
+            self.batching = False
+            self.queues.clear()
+            raise
+        self.flush()
+
+    def cancelRelease(self):
+        if self.release_timer is not None:
+            self.release_timer.cancel()
+            self.release_timer = None
+
+    def flush(self):
+        """
+        Send the queued buffered commands and stop batching.
+        """
+        self.batching = False
+        while (len(self.queues) > 0):
+            [unitNumber, commands] = self.queues.popitem(last = False)
+            try:
+                with self.session(unitNumber):
+                    for command in commands[:self.max_batch]:
+                        self.transaction("buffered " + command[:1], self.bufferedCommand, command)
+            except PumpTimeoutError:
+                # Do not leave the other commands to be sent with the next batch
+                self.queues.clear()
+                raise
+
+            # Go to the back of the line if there are more commands for this unit
+            if (len(commands) > self.max_batch):
+                self.queues[unitNumber] = commands[self.max_batch:]
+
+    def getStats(self):
+        """
+        Return the byte and round trip counts, failures, retries and times
+        of each kind of command.
+        """
+        with self.lock:
+            stats = self.transactions.getStats()
+            for counts in stats.values():
+                if (counts["count"] > 0):
+                    for key in ["bytes_sent", "bytes_received", "round_trips"]:
+                        counts["mean_" + key] = counts[key]/counts["count"]
+            return stats
+
+    def release(self):
+        """
+        Deselect the unit after the session timeout.
+        """
+        with self.lock:
+            self.release_timer = None
+            if (self.selected_unit is not None) and (self.session_depth == 0):
+                self.transaction("disconnect", self.disconnect)
+
+    @contextlib.contextmanager
+    def session(self, unitNumber):
+        """
+        Keep a unit selected for a series of commands. The unit stays
+        selected afterwards until a different unit is needed or nothing
+        has been sent for session_timeout seconds.
+        """
+        with self.lock:
+            self.cancelRelease()
+            if (self.selected_unit != unitNumber):
+                if self.selected_unit is not None:
+                    self.transaction("disconnect", self.disconnect)
+                self.transaction("select", self.selectUnit, unitNumber)
+            self.session_depth += 1
+            try:
+                yield
+            finally:
+                self.session_depth -= 1
+                if (self.session_depth == 0):
+                    if (self.session_timeout > 0):
+                        self.release_timer = threading.Timer(self.session_timeout, self.release)
+                        self.release_timer.daemon = True
+                        self.release_timer.start()
+                    else:
+                        self.transaction("disconnect", self.disconnect)
+
+    def startBatch(self):
+        """
+        Queue buffered commands until flush() is called.
+        """
+        self.batching = True
+
+    def transaction(self, name, function, *args):
+        """
+        Call function(deadline, *args) with retries and record its bytes,
+        round trips and time under name.
+        """
+        [sent, received, round_trips] = [self.bytes_sent, self.bytes_received, self.round_trips]
+        try:
+            return self.transactions.run(name, function, *args)
+        except PumpTimeoutError:
+            # The unit may have gone away, select it again next time
+            self.selected_unit = None
+            raise
+        finally:
+            counts = self.transactions.stats[name]
+            counts["bytes_sent"] = counts.get("bytes_sent", 0) + self.bytes_sent - sent
+            counts["bytes_received"] = counts.get("bytes_received", 0) + self.bytes_received - received
+            counts["round_trips"] = counts.get("round_trips", 0) + self.round_trips - round_trips
+
+    def sendImmediate(self, unitNumber, command):
+        with self.session(unitNumber):
+            return self.transaction("immediate " + command[:1], self.immediateCommand, command)
+
+    def immediateCommand(self, deadline, command):
+        self.sendString(command[0])
+        newCharacter = self.getResponse()
+        response = ""
+        while (len(newCharacter) < 1) or not (ord(newCharacter) & 0x80):
+            if len(newCharacter) < 1:
+                raise PumpTimeoutError("No reply from unit " + str(self.selected_unit) + " to " + command[0])
+            deadline.check("Immediate command " + command[0])
+            response += newCharacter
+            self.sendString(acknowledge)
+            newCharacter = self.getResponse()
+
+        response += chr(ord(newCharacter) & ~0x80)
+        return response
+
+    def sendBuffered(self, unitNumber, command):
+        if self.batching:
+            self.queues.setdefault(unitNumber, []).append(command)
+            return
+        with self.session(unitNumber):
+            self.transaction("buffered " + command[:1], self.bufferedCommand, command)
+
+    def bufferedCommand(self, deadline, command):
+        """
+        Send a buffered command, every character must be echoed.
+        """
+        for character in start + command + stop:
+            self.sendString(character)
+            if (self.getResponse() != character):
+                raise PumpTimeoutError("No echo from unit " + str(self.selected_unit) + " of " + command)
+            deadline.check("Buffered command " + command)
+
+    def disconnect(self, deadline = None):
+        with self.lock:
+            # No unit answers a disconnect
+            self.sendAndAcknowledge('\xff')
+            self.selected_unit = None
+
+    def selectUnit(self, deadline, unitNumber):
+        devSelect = chr(0x80 | unitNumber)
+        self.sendString(devSelect) 
+        if (self.getResponse() != devSelect):
+            raise PumpTimeoutError("Unit " + str(unitNumber) + " did not answer")
+        self.selected_unit = unitNumber
+        return True
+
+    def sendAndAcknowledge(self, string):
+        for i in range(0, len(string)):
+            self.sendString(string[i])
+            self.getResponse()
+
+    def sendString(self, string):
+        # latin-1 maps characters 0-255 to single bytes, e.g. the 0xFF disconnect
+        self.serial.write(string.encode("latin-1"))
+        self.bytes_sent += len(string)
+
+    def getResponse(self):
+        response = self.serial.read().decode("latin-1")
+        self.bytes_received += len(response)
+        self.round_trips += 1
+        return response
+
+def parsePumpIDs(parameters):
+    """
+    Return the IDs of the pumps on the bus, pump_IDs is a comma
+    separated list, e.g. "30,31", the default is pump_ID.
+    """
+    pump_IDs = parameters.get("pump_IDs", "")
+    if pump_IDs:
+        return [int(pump_ID) for pump_ID in str(pump_IDs).split(",")]
+    return [parameters.get("pump_ID", 30)]
+
+# ----------------------------------------------------------------------------------------
+# GlisonMP3 Class Definition
+# ----------------------------------------------------------------------------------------
+class APump():
+    def __init__(self,
+                 parameters = False,
+                 pump_ID = None):
+
+        # Define attributes
+        self.com_port = parameters.get("pump_com_port", "COM3")
+        self.pump_ID = parameters.get("pump_ID", 30) if pump_ID is None else pump_ID
+        self.verbose = parameters.get("verbose", True)
+        self.simulate = parameters.get("simulate_pump", True)
+        self.serial_verbose = parameters.get("serial_verbose", False)
+        self.flip_flow_direction = parameters.get("flip_flow_direction", False)
+        
+        # Share the serial port with the other pumps on it
+        self.bus = getBus(parameters)
+
         # Define initial pump status
         self.flow_status = "Stopped"
         self.speed = 0.0
         self.direction = "Forward"
+        self.control_status = "Unknown"
         
-        self.disconnect()
-        self.enableRemoteControl(1)
-        self.startFlow(self.speed, self.direction)
-        self.identification = self.getIdentification()
+        # Release the bus if the pump does not answer
+        try:
+            self.disconnect()
+            self.enableRemoteControl(1)
+            self.startFlow(self.speed, self.direction)
+            self.identification = self.getIdentification()
+        except Exception:
+            self.bus.close()
+            raise
+
+    def getCommandStats(self):
+        return self.bus.getStats()
 
     def getIdentification(self):
         return self.sendImmediate(self.pump_ID, "%")
@@ -62,7 +358,10 @@ class APump():
     def readDisplay(self):
         return self.sendImmediate(self.pump_ID, "R")
 
-    def getStatus(self):
+    def getStatus(self, refresh = True):
+        if not refresh:
+            return (self.flow_status, self.speed, self.direction, self.control_status, "Disabled", "No Error")
+
         message = self.readDisplay()
 
         if self.flip_flow_direction:
@@ -80,10 +379,18 @@ class APump():
 
         speed = float(message[1:len(message) - 1])
 
+        # Update the cached status
+        self.flow_status = status
+        self.speed = speed
+        if direction in ["Forward", "Reverse"]:
+            self.direction = direction
+        self.control_status = control
+
         return (status, speed, direction, control, auto_start, "No Error")
 
     def close(self):
         self.enableRemoteControl(0)
+        self.bus.close()
 
     def setFlowDirection(self, forward):
         if self.flip_flow_direction:
@@ -96,11 +403,14 @@ class APump():
                 self.sendBuffered(self.pump_ID, "K>")
             else:
                 self.sendBuffered(self.pump_ID, "K<")
+        self.direction = "Forward" if forward else "Reverse"
     
     def setSpeed(self, rotation_speed):
         if rotation_speed >= 0 and rotation_speed <= 48:
             rotation_int = int(rotation_speed*100)
             self.sendBuffered(self.pump_ID, "R" + ("%04d" % rotation_int))
+            self.speed = float(rotation_speed)
+            self.flow_status = "Flowing" if (self.speed > 0.0) else "Stopped"
 
     def startFlow(self, speed, direction = "Forward"):
         self.setSpeed(speed)
@@ -111,47 +421,10 @@ class APump():
         return True
 
     def sendImmediate(self, unitNumber, command):
-        self.selectUnit(unitNumber)
-        self.sendString(command[0])
-        newCharacter = self.getResponse()
-        if len(newCharacter) < 1:
-            print('error connecting to pump!')
-        response = ""
-        while not (ord(newCharacter) & 0x80):
-            response += newCharacter.decode()
-            self.sendString(acknowledge)
-            newCharacter = self.getResponse()
-
-        response += chr(ord(newCharacter) & ~0x80)
-        self.disconnect()
-
-        return response
+        return self.bus.sendImmediate(unitNumber, command)
 
     def sendBuffered(self, unitNumber, command):
-        self.selectUnit(unitNumber)
-        self.sendAndAcknowledge(start + command + stop)
-        self.disconnect()
+        self.bus.sendBuffered(unitNumber, command)
 
     def disconnect(self):
-        self.sendAndAcknowledge('\xff')
-
-    def selectUnit(self, unitNumber):
-        devSelect = chr(0x80 | unitNumber)
-        self.sendString(devSelect) 
-
-        return self.getResponse() == devSelect
-
-    def sendAndAcknowledge(self, string):
-        for i in range(0, len(string)):
-            self.sendString(string[i])
-            self.getResponse()
-
-    def sendString(self, string):
-        self.serial.write(string.encode())
-
-    def getResponse(self):
-        return self.serial.read()
-        #return self.serial.read().decode()
-
-
-
+        self.bus.disconnect()
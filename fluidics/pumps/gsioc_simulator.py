@@ -0,0 +1,288 @@
+#!/usr/bin/python
+# ----------------------------------------------------------------------------------------
+# A simulated Gilson Minipuls 3 pump that speaks the GSIOC serial protocol
+# on a pseudo terminal. The real gilson_mp3.APump can open the pseudo
+# terminal like a serial port, so the driver code can be exercised and
+# timed without a pump.
+#
+# GSIOC protocol summary:
+#   0xFF            - disconnect all units, no reply
+#   0x80 | unit ID  - select a unit, the selected unit echoes the byte
+#   one character   - immediate command, the unit replies one character
+#                     at a time, the host acknowledges (0x06) each one
+#                     and the last character has the high bit set
+#   LF command CR   - buffered command, the unit echoes every character
+#
+# Several pumps with different unit IDs can share the simulated bus. The
+# speed of each pump ramps towards the requested speed at a fixed rate
+# and the dispensed volume is the integral of the speed.
+#
+# Pseudo terminals are only available on Linux and macOS. Run the timing
+# demo from the fluidics directory with:
+#   python -m pumps.gsioc_simulator
+# ----------------------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------------------
+# Import
+# ----------------------------------------------------------------------------------------
+import os
+import select
+import threading
+import time
+import tty
+
+acknowledge = 0x06
+start = 0x0A
+stop = 0x0D
+disconnect = 0xFF
+
+# ----------------------------------------------------------------------------------------
+# SimulatedPump Class Definition
+# ----------------------------------------------------------------------------------------
+class SimulatedPump(object):
+    def __init__(self,
+                 acceleration = 24.0,
+                 identification = "MINIPULS3 SIM",
+                 ml_per_revolution = 0.01,
+                 verbose = False):
+
+        # Define attributes
+        self.acceleration = acceleration           # rpm per second
+        self.identification = identification
+        self.ml_per_revolution = ml_per_revolution
+        self.verbose = verbose
+
+        # Pump state
+        self.control_status = "K"
+        self.direction = 1     # 1 forward, -1 reverse
+        self.running = False
+        self.set_speed = 0.0   # rpm
+        self.speed = 0.0       # rpm, the actual speed
+        self.volume = 0.0      # mL
+        self.last_update = time.perf_counter()
+        self.lock = threading.Lock()
+
+    # ------------------------------------------------------------------------------------
+    # Execute a buffered command
+    # ------------------------------------------------------------------------------------
+    def executeBuffered(self, command):
+        self.updateModel()
+        if (command == "SR"):
+            self.control_status = "R"
+        elif (command == "SK"):
+            self.control_status = "K"
+        elif (command == "K>"):
+            self.direction = 1
+            self.running = True
+        elif (command == "K<"):
+            self.direction = -1
+            self.running = True
+        elif (command == "KH"):
+            self.running = False
+        elif (command[:1] == "R") and command[1:].isdigit():
+            self.set_speed = int(command[1:])/100.0
+        elif self.verbose:
+            print("GSIOC simulator: unknown buffered command " + command)
+
+    # ------------------------------------------------------------------------------------
+    # Return the reply to an immediate command
+    # ------------------------------------------------------------------------------------
+    def executeImmediate(self, command):
+        self.updateModel()
+        if (command == "%"):
+            return self.identification
+        elif (command == "R"):
+            if (self.speed > 0.0):
+                sign = "+" if (self.direction == 1) else "-"
+            else:
+                sign = " "
+            return sign + "{0:5.2f}".format(self.speed) + self.control_status
+        else:
+            if self.verbose:
+                print("GSIOC simulator: unknown immediate command " + command)
+            return "?"
+
+    # ------------------------------------------------------------------------------------
+    # Return the dispensed volume in mL, reverse flow counts as negative
+    # ------------------------------------------------------------------------------------
+    def getDispensedVolume(self):
+        self.updateModel()
+        return self.volume
+
+    # ------------------------------------------------------------------------------------
+    # Ramp the speed and integrate the volume up to now
+    # ------------------------------------------------------------------------------------
+    def updateModel(self):
+        with self.lock:
+            now = time.perf_counter()
+            dt = now - self.last_update
+            self.last_update = now
+
+            target = self.set_speed if self.running else 0.0
+            start_speed = self.speed
+            ramp_time = abs(target - start_speed)/self.acceleration if self.acceleration > 0 else 0.0
+            if (ramp_time >= dt):
+                step = self.acceleration * dt
+                self.speed = start_speed + step if (target > start_speed) else start_speed - step
+                revolutions = 0.5 * (start_speed + self.speed) * dt/60.0
+            else:
+                self.speed = target
+                revolutions = (0.5 * (start_speed + target) * ramp_time + target * (dt - ramp_time))/60.0
+            self.volume += self.direction * revolutions * self.ml_per_revolution
+
+# ----------------------------------------------------------------------------------------
+# GSIOCSimulator Class Definition
+# ----------------------------------------------------------------------------------------
+class GSIOCSimulator(object):
+    def __init__(self,
+                 unit_IDs = [30],
+                 baudrate = 19200,
+                 verbose = False,
+                 **kwds):
+
+        # Define attributes, the remaining keywords configure the pumps
+        self.byte_time = 11.0/baudrate if baudrate else 0.0 # start + 8 data + parity + stop bits
+        self.pumps = {}
+        for unit_ID in unit_IDs:
+            self.pumps[unit_ID] = SimulatedPump(verbose = verbose, **kwds)
+        self.verbose = verbose
+
+        # Protocol state
+        self.buffer = None     # Buffered command being received
+        self.reply = None      # Immediate command reply being sent
+        self.selected = None   # The selected pump
+
+        # Traffic
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+        # Create the pseudo terminal
+        [self.master, self.slave] = os.openpty()
+        tty.setraw(self.slave)
+        self.port_name = os.ttyname(self.slave)
+
+        self.running_thread = True
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    # ------------------------------------------------------------------------------------
+    # Stop the simulator
+    # ------------------------------------------------------------------------------------
+    def close(self):
+        self.running_thread = False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+        if self.verbose:
+            for [unit_ID, pump] in sorted(self.pumps.items()):
+                print("Closed GSIOC simulator " + str(unit_ID) + ", dispensed " + "{0:.3f}".format(pump.getDispensedVolume()) + " mL")
+
+    # ------------------------------------------------------------------------------------
+    # Return the dispensed volume in mL of a pump
+    # ------------------------------------------------------------------------------------
+    def getDispensedVolume(self, unit_ID):
+        return self.pumps[unit_ID].getDispensedVolume()
+
+    # ------------------------------------------------------------------------------------
+    # Return the name of the serial port to open
+    # ------------------------------------------------------------------------------------
+    def getPortName(self):
+        return self.port_name
+
+    # ------------------------------------------------------------------------------------
+    # Handle a byte from the host
+    # ------------------------------------------------------------------------------------
+    def handleByte(self, byte):
+        self.bytes_received += 1
+
+        if (byte == disconnect):
+            self.selected = None
+            self.buffer = None
+            self.reply = None
+        elif (byte & 0x80):
+            self.selected = self.pumps.get(byte & 0x7F)
+            self.buffer = None
+            self.reply = None
+            if self.selected is not None:
+                self.write(bytes([byte]))
+        elif self.selected is None:
+            pass
+        elif self.buffer is not None:
+            self.write(bytes([byte]))
+            if (byte == stop):
+                self.selected.executeBuffered(self.buffer)
+                self.buffer = None
+            else:
+                self.buffer += chr(byte)
+        elif (byte == start):
+            self.write(bytes([byte]))
+            self.buffer = ""
+        elif (byte == acknowledge) and (self.reply is not None):
+            self.sendReplyCharacter()
+        else:
+            self.reply = [self.selected.executeImmediate(chr(byte)), 0]
+            self.sendReplyCharacter()
+
+    # ------------------------------------------------------------------------------------
+    # Serve the pseudo terminal until closed
+    # ------------------------------------------------------------------------------------
+    def run(self):
+        while self.running_thread:
+            [readable, writable, errors] = select.select([self.master], [], [], 0.05)
+            if readable:
+                for byte in os.read(self.master, 1024):
+                    self.handleByte(byte)
+
+    # ------------------------------------------------------------------------------------
+    # Send the next character of an immediate reply
+    # ------------------------------------------------------------------------------------
+    def sendReplyCharacter(self):
+        [reply, index] = self.reply
+        character = ord(reply[index])
+        if (index == len(reply) - 1):
+            character |= 0x80
+            self.reply = None
+        else:
+            self.reply[1] += 1
+        self.write(bytes([character]))
+
+    # ------------------------------------------------------------------------------------
+    # Write to the host at the simulated baud rate
+    # ------------------------------------------------------------------------------------
+    def write(self, data):
+        if (self.byte_time > 0.0):
+            time.sleep(self.byte_time * len(data))
+        os.write(self.master, data)
+        self.bytes_sent += len(data)
+
+# ----------------------------------------------------------------------------------------
+# Time the Gilson driver against the simulator
+# ----------------------------------------------------------------------------------------
+if (__name__ == "__main__"):
+    from pumps.gilson_mp3 import APump
+
+    simulator = GSIOCSimulator(verbose = True)
+    pump = APump(parameters = {"pump_com_port" : simulator.getPortName(),
+                               "pump_ID" : 30,
+                               "simulate_pump" : False,
+                               "verbose" : False})
+    print("Identification: " + pump.identification)
+
+    start_time = time.perf_counter()
+    pump.startFlow(20.0, "Forward")
+    print("startFlow took {0:.1f} ms".format(1000.0 * (time.perf_counter() - start_time)))
+    time.sleep(2.0)
+
+    start_time = time.perf_counter()
+    status = pump.getStatus()
+    print("getStatus took {0:.1f} ms".format(1000.0 * (time.perf_counter() - start_time)))
+    print(status)
+
+    pump.stopFlow()
+    time.sleep(1.0)
+    print("Dispensed {0:.4f} mL, {1:d} bytes in, {2:d} bytes out".format(simulator.getDispensedVolume(30),
+                                                                         simulator.bytes_received,
+                                                                         simulator.bytes_sent))
+    pump.close()
+    simulator.close()
+
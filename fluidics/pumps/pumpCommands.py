@@ -14,6 +14,7 @@ import sys
 import os
 import xml.etree.ElementTree as elementTree
 from PyQt5 import QtCore, QtGui, QtWidgets
+from pumps.flowCalibration import FlowCalibrations
 
 # ----------------------------------------------------------------------------------------
 # PumpCommands Class Definition
@@ -25,6 +26,7 @@ class PumpCommands(QtWidgets.QMainWindow):
     
     def __init__(self,
                  xml_file_path="default_config.xml",
+                 default_pump_ID = 30,
                  verbose = False):
         super(PumpCommands, self).__init__()
 
@@ -33,6 +35,9 @@ class PumpCommands(QtWidgets.QMainWindow):
         self.file_name = xml_file_path
         self.command_names = []
         self.commands = []
+        self.command_durations = [] # Time needed to dispense the volumes (None if no volume)
+        self.rejected_commands = {} # name : why the command cannot be run
+        self.flow_calibrations = FlowCalibrations(default_pump_ID = default_pump_ID)
         self.num_commands = 0
         self.num_pumps = 0
         
@@ -59,6 +64,11 @@ class PumpCommands(QtWidgets.QMainWindow):
         self.fileLabel = QtWidgets.QLabel()
         self.fileLabel.setText("")
 
+        self.errorLabel = QtWidgets.QLabel()
+        self.errorLabel.setStyleSheet("QLabel { color: red}")
+        self.errorLabel.setWordWrap(True)
+        self.errorLabel.setVisible(False)
+
         self.commandListWidget = QtWidgets.QListWidget()
         self.commandListWidget.currentItemChanged.connect(self.updateCommandDisplay)
         
@@ -74,6 +84,7 @@ class PumpCommands(QtWidgets.QMainWindow):
         self.currentCommandGroupBoxLayout.addWidget(self.currentCommandLabel)
 
         self.mainWidgetLayout.addWidget(self.fileLabel)
+        self.mainWidgetLayout.addWidget(self.errorLabel)
         self.mainWidgetLayout.addWidget(self.commandListWidget)
         self.mainWidgetLayout.addWidget(self.sendCommandButton)
         self.mainWidgetLayout.addWidget(self.currentCommandGroupBox)
@@ -110,6 +121,34 @@ class PumpCommands(QtWidgets.QMainWindow):
             print("Did not find " + command_name)
             return [-1]*self.num_valves # Return no change command
 
+    # ------------------------------------------------------------------------------------
+    # Return a description of a command
+    # ------------------------------------------------------------------------------------        
+    def getCommandText(self, command, indent):
+        text_string = ""
+        for [pump_ID, direction, speed, dispense_time] in command[2]:
+            if pump_ID is not None:
+                text_string += indent + "Pump: " + str(pump_ID) + "\n"
+            text_string += indent + "Flow Direction: " + direction + "\n"
+            text_string += indent + "Flow Speed: " + str(speed) + "\n"
+            if dispense_time is not None:
+                text_string += indent + "Dispense Time: " + "{0:.1f}".format(dispense_time) + " s\n"
+        return text_string
+
+    # ------------------------------------------------------------------------------------
+    # Return the time needed to dispense the volumes of a command (None if no volume)
+    # ------------------------------------------------------------------------------------        
+    def getCommandDuration(self, command_name):
+        if command_name in self.command_names:
+            return self.command_durations[self.command_names.index(command_name)]
+        return None
+
+    # ------------------------------------------------------------------------------------
+    # Return why a command was not loaded, or None
+    # ------------------------------------------------------------------------------------        
+    def getRejection(self, command_name):
+        return self.rejected_commands.get(command_name)
+
     # ------------------------------------------------------------------------------------
     # Return the names of the current defined commands
     # ------------------------------------------------------------------------------------        
@@ -160,8 +199,13 @@ class PumpCommands(QtWidgets.QMainWindow):
         # Clear previous commands
         self.command_names = []
         self.commands = []
+        self.command_durations = []
+        self.rejected_commands = {}
         self.num_commands = 0
 
+        # Load flow rate calibrations
+        self.flow_calibrations.parseXML(self.kilroy_configuration)
+
         # Load number of valves
         self.num_pumps = int(self.kilroy_configuration.get("num_pumps"))
         if not (self.num_pumps>0):
@@ -171,16 +215,37 @@ class PumpCommands(QtWidgets.QMainWindow):
         for pump_command in self.kilroy_configuration.findall("pump_commands"):
             command_list = pump_command.findall("pump_cmd")
             for command in command_list:
+                pump_configs = [] # [pump ID (None is the default pump), direction, speed, dispense time]
+                command_duration = None
                 for pump_config in command.findall("pump_config"):
-                    speed = float(pump_config.get("speed"))
-                    direction = pump_config.get("direction")
+                    pump_ID = pump_config.get("pump")
+                    if pump_ID is not None:
+                        pump_ID = int(pump_ID)
+                    dispense_time = None
+                    if pump_config.get("volume") is not None:
+                        try:
+                            [direction, speed, dispense_time] = self.flow_calibrations.parseVolume(pump_config, pump_ID)
+                        except ValueError as error:
+                            self.rejected_commands[command.get("name")] = str(error)
+                            break
+                        command_duration = max(dispense_time, command_duration or 0.0)
+                    else:
+                        speed = float(pump_config.get("speed"))
+                        direction = pump_config.get("direction")
                     if speed < 0.00 or speed > 48.0:
                         speed = 0.0
                         direction = "Stopped" # Flag for stopped flow
                     direction = {"Forward": "Forward", "Reverse": "Reverse"}.get(direction, "Stopped")
+                    pump_configs.append([pump_ID, direction, speed, dispense_time])
+
+                # A volume that cannot be dispensed must not turn into a stop command
+                if command.get("name") in self.rejected_commands:
+                    print("Invalid pump command " + command.get("name") + ": " + self.rejected_commands[command.get("name")])
+                    continue
                     
                 # Add command
-                self.commands.append([direction, speed])
+                self.commands.append([direction, speed, pump_configs])
+                self.command_durations.append(command_duration)
                 self.command_names.append(command.get("name"))
 
         # Record number of configs
@@ -193,11 +258,7 @@ class PumpCommands(QtWidgets.QMainWindow):
         print("Current commands:")
         for command_ID in range(self.num_commands):
             print(self.command_names[command_ID])
-            direction = self.commands[command_ID][0]
-            speed = self.commands[command_ID][1]
-            text_string = "    " + "Flow Direction: " + direction + "\n"
-            text_string += "    " + "Speed: " + str(speed) +"\n"
-            print(text_string)
+            print(self.getCommandText(self.commands[command_ID], "    "))
 
     # ------------------------------------------------------------------------------------
     # Update active command on GUI
@@ -229,8 +290,7 @@ class PumpCommands(QtWidgets.QMainWindow):
         current_command = self.commands[current_ID]
 
         text_string = current_command_name + "\n"
-        text_string += "Flow Direction: " + current_command[0] + "\n"
-        text_string += "Flow Speed: " + str(current_command[1]) + "\n"
+        text_string += self.getCommandText(current_command, "")
         self.currentCommandLabel.setText(text_string)
 
     # ------------------------------------------------------------------------------------
@@ -249,6 +309,11 @@ class PumpCommands(QtWidgets.QMainWindow):
         self.fileLabel.setText(file_name)
         self.fileLabel.setToolTip(self.file_name) 
 
+        # Commands that were not loaded
+        errors = [name + ": " + error for [name, error] in self.rejected_commands.items()]
+        self.errorLabel.setText("Invalid commands not loaded\n" + "\n".join(errors))
+        self.errorLabel.setVisible(len(errors) > 0)
+
 # ----------------------------------------------------------------------------------------
 # Stand Alone Test Class
 # ----------------------------------------------------------------------------------------
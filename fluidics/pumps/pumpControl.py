@@ -10,11 +10,40 @@
 # ----------------------------------------------------------------------------------------
 # Import
 # ----------------------------------------------------------------------------------------
+import contextlib
 import importlib
 import sys
-import time
 from PyQt5 import QtCore, QtGui, QtWidgets
 
+from pumps.pumpTransaction import PumpTimeoutError
+
+# Status of a pump that did not answer
+disconnected_status = ("Disconnected", 0.0, "Unknown", "Unknown", "Unknown", "No Reply")
+
+# ----------------------------------------------------------------------------------------
+# DisconnectedPump Class Definition, stands in for a pump that did not answer
+#   when Kilroy started so that it is shown as disconnected
+# ----------------------------------------------------------------------------------------
+class DisconnectedPump(object):
+    def __init__(self, pump_ID, error):
+        self.pump_ID = pump_ID
+        self.error = error
+        self.identification = "No Reply"
+
+    def getStatus(self, refresh = True):
+        if refresh:
+            raise PumpTimeoutError("Not connected, " + str(self.error))
+        return disconnected_status
+
+    def startFlow(self, speed, direction = "Forward"):
+        raise PumpTimeoutError("Not connected, " + str(self.error))
+
+    def stopFlow(self):
+        raise PumpTimeoutError("Not connected, " + str(self.error))
+
+    def close(self):
+        pass
+
 # ----------------------------------------------------------------------------------------
 # PumpControl Class Definition
 # ----------------------------------------------------------------------------------------
@@ -32,22 +61,45 @@ class PumpControl(QtWidgets.QWidget):
         self.simulate = parameters.get("simulate_pump", True)
         self.verbose = parameters.get("verbose", True)
         self.status_repeat_time = 2000
+        self.refresh_delay = 100 # Time to let the pump settle before checking a command
         self.speed_units = "rpm"
+        self.pump_status = None # Last status read from the selected pump
 
         # Dynamic import of pump class
         pump_module = importlib.import_module(parameters.get("pump_class", "storm_control.fluidics.pumps.rainin_rp1"))
 
-        # Create Instance of Pump
-        self.pump = pump_module.APump(parameters = parameters)
+        # Create Instance of Pump, several pumps (pump_IDs = "30,31") can share a Gilson bus
+        pump_IDs = parameters.get("pump_IDs", "")
+        if pump_IDs:
+            self.pumps = [self.createPump(pump_module, parameters, int(pump_ID))
+                          for pump_ID in str(pump_IDs).split(",")]
+        else:
+            self.pumps = [self.createPump(pump_module, parameters)]
+        self.pump_statuses = [None] * len(self.pumps)
+        self.pump = self.pumps[0] # The pump shown in the GUI
+
+        # Timers that stop a pump once it has dispensed a volume
+        self.stop_timers = []
+        for pump in self.pumps:
+            stop_timer = QtCore.QTimer()
+            stop_timer.setSingleShot(True)
+            stop_timer.timeout.connect(lambda pump = pump: self.handleDispenseComplete(pump))
+            self.stop_timers.append(stop_timer)
 
-        # Create GUI Elements
-        self.createGUI()
-        self.pollPumpStatus()
-        
         # Define timer for periodic polling of pump status
         self.status_timer = QtCore.QTimer()        
         self.status_timer.setInterval(self.status_repeat_time)
         self.status_timer.timeout.connect(self.pollPumpStatus)
+
+        # Define timer for refreshing the status after a command, overlapping
+        #   requests are merged into a single read
+        self.refresh_timer = QtCore.QTimer()
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.timeout.connect(self.pollPumpStatus)
+
+        # Create GUI Elements
+        self.createGUI()
+        self.pollPumpStatus()
         self.status_timer.start()
 
     # ------------------------------------------------------------------------------------
@@ -55,7 +107,22 @@ class PumpControl(QtWidgets.QWidget):
     # ------------------------------------------------------------------------------------
     def close(self):
         if self.verbose: "Print closing pump"
-        self.pump.close()
+        for pump in self.pumps:
+            self.sendPumpCommand(pump, pump.close)
+
+    # ------------------------------------------------------------------------------------
+    # Create a pump, a pump that does not answer is shown as disconnected
+    # ------------------------------------------------------------------------------------
+    def createPump(self, pump_module, parameters, pump_ID = None):
+        try:
+            if pump_ID is None:
+                return pump_module.APump(parameters = parameters)
+            return pump_module.APump(parameters = parameters, pump_ID = pump_ID)
+        except PumpTimeoutError as error:
+            if pump_ID is None:
+                pump_ID = parameters.get("pump_ID", 30)
+            print("Pump " + str(pump_ID) + " is not answering: " + str(error))
+            return DisconnectedPump(pump_ID, error)
 
     # ------------------------------------------------------------------------------------
     # Coerce Speed Entry to Acceptable Range
@@ -83,6 +150,12 @@ class PumpControl(QtWidgets.QWidget):
         self.mainWidgetLayout = QtWidgets.QVBoxLayout(self.mainWidget)
         
         # Add individual widgets
+        self.pump_selector = QtWidgets.QComboBox()
+        for pump in self.pumps:
+            self.pump_selector.addItem("Pump " + str(pump.pump_ID))
+        self.pump_selector.currentIndexChanged.connect(self.handleSelectPump)
+        self.pump_selector.setVisible(len(self.pumps) > 1)
+
         self.pump_identification_label = QtWidgets.QLabel()
         self.pump_identification_label.setText("No Pump Attached")
 
@@ -122,6 +195,7 @@ class PumpControl(QtWidgets.QWidget):
         self.stop_flow_button.setText("Stop Flow")
         self.stop_flow_button.clicked.connect(self.handleStopFlow)
         
+        self.mainWidgetLayout.addWidget(self.pump_selector)
         self.mainWidgetLayout.addWidget(self.flow_status_display)
         self.mainWidgetLayout.addWidget(self.speed_display)
         self.mainWidgetLayout.addWidget(self.speed_control_label)
@@ -136,6 +210,9 @@ class PumpControl(QtWidgets.QWidget):
     # Display Status
     # ----------------------------------------------------------------------------------------
     def updateStatus(self, status):
+        # Cache the status for queries that should not touch the serial port
+        self.pump_status = status
+
         # Pump identification
         self.pump_identification_label.setText(self.pump.identification)
         
@@ -144,13 +221,15 @@ class PumpControl(QtWidgets.QWidget):
             self.flow_status_display.setText(status[2])
             self.flow_status_display.setStyleSheet("QLabel { color: green}")
             self.stop_flow_button.setEnabled(True)
+            self.start_flow_button.setEnabled(True)
             self.start_flow_button.setText("Change Flow")
         elif status[0] == "Stopped":
             self.flow_status_display.setText(status[0])
             self.flow_status_display.setStyleSheet("QLabel { color: red}")
             self.stop_flow_button.setEnabled(False)
+            self.start_flow_button.setEnabled(True)
             self.start_flow_button.setText("Start Flow")
-        else: # Unknown status
+        else: # Unknown or disconnected status
             self.flow_status_display.setText(status[0])
             self.flow_status_display.setStyleSheet("QLabel { color: red}")
             self.stop_flow_button.setEnabled(False)
@@ -159,39 +238,150 @@ class PumpControl(QtWidgets.QWidget):
         # Speed
         self.speed_display.setText("%0.2f" % status[1] + " " + self.speed_units)
             
+    # ----------------------------------------------------------------------------------------
+    # Return the last polled pump status without touching the serial port
+    # ----------------------------------------------------------------------------------------
+    def getCachedStatus(self):
+        pump_snapshots = []
+        for [pump, status] in zip(self.pumps, self.pump_statuses):
+            if status is None:
+                pump_snapshots.append({"identification": pump.identification,
+                                       "pump_ID": pump.pump_ID,
+                                       "flow_status": "Unknown"})
+            else:
+                pump_snapshots.append({"identification": pump.identification,
+                                       "pump_ID": pump.pump_ID,
+                                       "flow_status": status[0],
+                                       "speed": status[1],
+                                       "speed_units": self.speed_units,
+                                       "direction": status[2],
+                                       "control_status": status[3],
+                                       "error_status": status[5]})
+
+        # The first pump, with all the pumps listed if there is more than one
+        snapshot = dict(pump_snapshots[0])
+        if (len(self.pumps) > 1):
+            snapshot["pumps"] = pump_snapshots
+        return snapshot
+
+    # ----------------------------------------------------------------------------------------
+    # Return a pump by ID, None is the first pump
+    # ----------------------------------------------------------------------------------------
+    def getPump(self, pump_ID):
+        if pump_ID is None:
+            return self.pumps[0]
+        for pump in self.pumps:
+            if (pump.pump_ID == pump_ID):
+                return pump
+        return None
+
     # ----------------------------------------------------------------------------------------
     # Poll Pump Status
     # ----------------------------------------------------------------------------------------
     def pollPumpStatus(self):
-        self.updateStatus(self.pump.getStatus())
+        self.refresh_timer.stop()
+        for [index, pump] in enumerate(self.pumps):
+            try:
+                self.pump_statuses[index] = pump.getStatus(refresh = True)
+            except PumpTimeoutError as error:
+                print("Pump " + str(pump.pump_ID) + " is not answering: " + str(error))
+                self.pump_statuses[index] = disconnected_status
+        self.updateStatus(self.pump_statuses[self.pumps.index(self.pump)])
+
+        # The next periodic poll is a full interval after this read
+        if self.status_timer.isActive():
+            self.status_timer.start()
+
+    # ----------------------------------------------------------------------------------------
+    # Show the status expected after a command and check it with the pump shortly
+    # ----------------------------------------------------------------------------------------
+    def requestStatusRefresh(self):
+        for [index, pump] in enumerate(self.pumps):
+            if (self.pump_statuses[index] != disconnected_status):
+                self.pump_statuses[index] = pump.getStatus(refresh = False)
+        self.updateStatus(self.pump_statuses[self.pumps.index(self.pump)])
+        if not self.refresh_timer.isActive():
+            self.refresh_timer.start(self.refresh_delay)
+
+    # ----------------------------------------------------------------------------------------
+    # Stop a pump that has dispensed its volume
+    # ----------------------------------------------------------------------------------------
+    def handleDispenseComplete(self, pump):
+        if self.verbose:
+            print("Pump " + str(pump.pump_ID) + " dispensed its volume")
+        self.sendPumpCommand(pump, pump.stopFlow)
+        self.requestStatusRefresh()
+
+    # ----------------------------------------------------------------------------------------
+    # Show and control a different pump
+    # ----------------------------------------------------------------------------------------
+    def handleSelectPump(self, index):
+        self.pump = self.pumps[index]
+        if self.pump_statuses[index] is not None:
+            self.updateStatus(self.pump_statuses[index])
 
     # ----------------------------------------------------------------------------------------
     # Handle Change Flow Request
     # ----------------------------------------------------------------------------------------
     def handleStartFlow(self):
-        self.pump.startFlow(float(self.speed_control_entry_box.displayText()),
-                            direction = self.direction_control.currentText())
-        time.sleep(0.1)
-        self.pollPumpStatus()
+        self.sendPumpCommand(self.pump, self.pump.startFlow,
+                             float(self.speed_control_entry_box.displayText()),
+                             self.direction_control.currentText())
+        self.requestStatusRefresh()
         
     # ----------------------------------------------------------------------------------------
     # Handle Change Flow Request
     # ----------------------------------------------------------------------------------------
     def handleStopFlow(self):
-        self.pump.stopFlow()
-        time.sleep(0.1)
-        self.pollPumpStatus()
+        self.sendPumpCommand(self.pump, self.pump.stopFlow)
+        self.requestStatusRefresh()
 
     # ------------------------------------------------------------------------------------
-    # Change pump based on sent command: [direction, speed]
+    # Change pumps based on sent command:
+    #   [direction, speed, [[pump ID, direction, speed, dispense time], ..]]
     # ------------------------------------------------------------------------------------          
     def receiveCommand(self, command):
-        speed = command[1]
-        direction = command[0]
-        if speed < 0.01:
-            self.pump.stopFlow()
+        if (len(command) > 2):
+            pump_configs = command[2]
         else:
-            self.pump.startFlow(speed, direction)
+            pump_configs = [[None, command[0], command[1], None]]
+
+        # Pumps on a shared bus send their commands together
+        buses = [pump.bus for pump in self.pumps if hasattr(pump, "bus")]
+        batch = buses[0].batch() if buses else contextlib.nullcontext()
+        try:
+            with batch:
+                for [pump_ID, direction, speed, dispense_time] in pump_configs:
+                    pump = self.getPump(pump_ID)
+                    if pump is None:
+                        print("No pump with ID " + str(pump_ID))
+                        continue
+
+                    # A new command replaces any volume that is still being dispensed
+                    stop_timer = self.stop_timers[self.pumps.index(pump)]
+                    stop_timer.stop()
+                    if speed < 0.01:
+                        self.sendPumpCommand(pump, pump.stopFlow)
+                    elif self.sendPumpCommand(pump, pump.startFlow, speed, direction):
+                        if dispense_time is not None:
+                            stop_timer.start(int(round(1000.0 * dispense_time)))
+        except PumpTimeoutError as error:
+            # The status refresh finds the pump that is not answering
+            print("Pump command failed: " + str(error))
+        self.requestStatusRefresh()
+
+    # ------------------------------------------------------------------------------------
+    # Call a pump method, a pump that does not answer is shown as disconnected
+    #   until it answers a status poll again
+    # ------------------------------------------------------------------------------------          
+    def sendPumpCommand(self, pump, method, *args):
+        try:
+            method(*args)
+            return True
+        except PumpTimeoutError as error:
+            print("Pump " + str(pump.pump_ID) + " is not answering: " + str(error))
+            self.pump_statuses[self.pumps.index(pump)] = disconnected_status
+            return False
 
     # ------------------------------------------------------------------------------------
     # Determine Enabled State
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# ----------------------------------------------------------------------------------------
+# Deadlines and retries for serial transactions with a pump, so that a
+# pump that stops answering raises PumpTimeoutError instead of hanging
+# the GUI thread.
+# ----------------------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------------------
+# Import
+# ----------------------------------------------------------------------------------------
+import time
+
+# ----------------------------------------------------------------------------------------
+# PumpTimeoutError Class Definition
+# ----------------------------------------------------------------------------------------
+class PumpTimeoutError(Exception):
+    pass
+
+# ----------------------------------------------------------------------------------------
+# Deadline Class Definition
+# ----------------------------------------------------------------------------------------
+class Deadline(object):
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.end_time = time.perf_counter() + timeout
+
+    # ------------------------------------------------------------------------------------
+    # Raise PumpTimeoutError if the deadline has passed
+    # ------------------------------------------------------------------------------------
+    def check(self, description):
+        if self.expired():
+            raise PumpTimeoutError(description + " did not finish within " + str(self.timeout) + " s")
+
+    # ------------------------------------------------------------------------------------
+    # Has the deadline passed?
+    # ------------------------------------------------------------------------------------
+    def expired(self):
+        return (time.perf_counter() > self.end_time)
+
+# ----------------------------------------------------------------------------------------
+# TransactionStats Class Definition
+# ----------------------------------------------------------------------------------------
+class TransactionStats(object):
+    def __init__(self, retries = 1, timeout = 1.0, recover = None, verbose = False):
+        self.recover = recover   # Called before each retry, e.g. to clear the serial buffer
+        self.retries = retries   # Extra attempts after a timeout
+        self.stats = {}
+        self.timeout = timeout   # seconds per attempt
+        self.verbose = verbose
+
+    # ------------------------------------------------------------------------------------
+    # Return the count, failures, retries and time of each kind of transaction
+    # ------------------------------------------------------------------------------------
+    def getStats(self):
+        stats = {}
+        for [name, counts] in self.stats.items():
+            stats[name] = dict(counts)
+            if (counts["count"] > 0):
+                stats[name]["mean_time"] = counts["time"]/counts["count"]
+        return stats
+
+    # ------------------------------------------------------------------------------------
+    # Call function(deadline, *args), retrying after a timeout if retry is True
+    # ------------------------------------------------------------------------------------
+    def run(self, name, function, *args, retry = True):
+        counts = self.stats.setdefault(name, {"count": 0,
+                                              "failures": 0,
+                                              "retries": 0,
+                                              "time": 0.0,
+                                              "max_time": 0.0})
+        start_time = time.perf_counter()
+        attempts = (self.retries + 1) if retry else 1
+        try:
+            for attempt in range(attempts):
+                try:
+                    return function(Deadline(self.timeout), *args)
+                except PumpTimeoutError as error:
+                    if (attempt == attempts - 1):
+                        counts["failures"] += 1
+                        raise
+                    counts["retries"] += 1
+                    if self.verbose:
+                        print(str(error) + ", retrying")
+                    if self.recover is not None:
+                        self.recover()
+        finally:
+            elapsed = time.perf_counter() - start_time
+            counts["count"] += 1
+            counts["time"] += elapsed
+            counts["max_time"] = max(counts["max_time"], elapsed)
@@ -13,19 +13,25 @@
 import sys
 import time
 
+from pumps.pumpTransaction import PumpTimeoutError, TransactionStats
+
 # ----------------------------------------------------------------------------------------
 # RaininRP1 Class Definition
 # ----------------------------------------------------------------------------------------
 class APump(object):
     def __init__(self,
-                 parameters = False):
+                 parameters = False,
+                 pump_ID = None):
 
         # Define attributes
         self.com_port = parameters.get("pump_com_port", 3)
-        self.pump_ID = parameters.get("pump_ID", 30)
+        self.pump_ID = parameters.get("pump_ID", 30) if pump_ID is None else pump_ID
         self.verbose = parameters.get("verbose", True)
         self.simulate = parameters.get("simulate_pump", True)
         self.serial_verbose = parameters.get("serial_verbose", False)
+        self.block_transfer = parameters.get("pump_block_transfer", False) # Send buffered commands in one write?
+        self.transaction_timeout = parameters.get("pump_transaction_timeout", 1.0) # seconds per attempt
+        self.transaction_retries = parameters.get("pump_retries", 1) # Extra attempts after a timeout
         
         # Create serial port
         if not self.simulate:
@@ -56,9 +62,27 @@ class APump(object):
         self.auto_start = "Disabled"
         self.error_status = "No Error"
         self.identification = ""
+
+        # Buffered command timing
+        self.command_stats = {"commands": 0,
+                              "reads": 0,
+                              "retransmissions": 0,
+                              "total_time": 0.0,
+                              "max_time": 0.0}
+
+        # Every serial transaction runs under a deadline with a retry budget
+        self.transactions = TransactionStats(retries = self.transaction_retries,
+                                             timeout = self.transaction_timeout,
+                                             recover = self.clearInput,
+                                             verbose = self.verbose)
         
-        # Configure device
-        self.connectPump()
+        # Configure device, closing the serial port if the pump does not answer
+        try:
+            self.connectPump()
+        except Exception:
+            if not self.simulate:
+                self.serial.close()
+            raise
 
     # ------------------------------------------------------------------------------------
     # Connect Pump
@@ -94,6 +118,13 @@ class APump(object):
             if self.control_status == "Remote": self.enableRemoteControl(False)
             self.write(self.disconnect_signal)
  
+    # ------------------------------------------------------------------------------------
+    # Discard unread characters, e.g. a late reply to a transaction that timed out
+    # ------------------------------------------------------------------------------------ 
+    def clearInput(self):
+        if not self.simulate:
+            self.serial.reset_input_buffer()
+
     # ------------------------------------------------------------------------------------
     # Close Serial Port
     # ------------------------------------------------------------------------------------ 
@@ -138,13 +169,29 @@ class APump(object):
         return self.identification
     
     # ------------------------------------------------------------------------------------
-    # Return the status of the pump
+    # Return buffered command timing statistics
     # ------------------------------------------------------------------------------------ 
-    def getStatus(self):
-        # Update the status from the current display
-        self.readDisplay()
-        # Update the status from a status inquiry
-        self.requestStatus()
+    def getCommandStats(self):
+        stats = dict(self.command_stats)
+        if stats["commands"] > 0:
+            stats["mean_time"] = stats["total_time"]/stats["commands"]
+            stats["reads_per_command"] = stats["reads"]/stats["commands"]
+        stats["transactions"] = self.transactions.getStats()
+        return stats
+
+    # ------------------------------------------------------------------------------------
+    # Return the status of the pump, refresh = False returns the cached status
+    # ------------------------------------------------------------------------------------ 
+    def getStatus(self, refresh = True):
+        if refresh:
+            # Update the status from the current display
+            expected_flow_status = self.flow_status
+            self.readDisplay()
+            
+            # The display has everything except the error status, only ask
+            #   for it if the pump did not do what it was told
+            if (self.flow_status != expected_flow_status) or (self.control_status != "Remote"):
+                self.requestStatus()
 
         return (self.flow_status, self.speed, self.direction,
                 self.control_status, self.auto_start, self.error_status)
@@ -217,7 +264,26 @@ class APump(object):
     # ------------------------------------------------------------------------------------
     # Send Buffered Command
     # ------------------------------------------------------------------------------------ 
-    def sendBufferedCommand(self, command_string):
+    def sendBufferedCommand(self, command_string, refresh_status = False):
+        start_time = time.perf_counter()
+        self.transactions.run("buffered " + command_string[:1], self.bufferedTransaction, command_string)
+
+        # Record command latency
+        command_time = time.perf_counter() - start_time
+        self.command_stats["commands"] += 1
+        self.command_stats["total_time"] += command_time
+        self.command_stats["max_time"] = max(self.command_stats["max_time"], command_time)
+        if self.serial_verbose: print("Buffered command " + command_string + " took " + "{0:.1f}".format(1000.0 * command_time) + " ms")
+
+        # Update the pump status after a buffered command
+        if refresh_status:
+            self.getStatus()
+
+    # ------------------------------------------------------------------------------------
+    # Send a buffered command once, raises PumpTimeoutError if the pump does not
+    #   become ready or echo the command before the deadline
+    # ------------------------------------------------------------------------------------ 
+    def bufferedTransaction(self, deadline, command_string):
         # Compose command message
         command_message = command_string + self.carriage_return;
 
@@ -234,43 +300,66 @@ class APump(object):
             else:
                 attempt_number += 1
                 if self.serial_verbose: print("Received Busy Signal")
-            if attempt_number > self.max_attempt_number:
-                ready = True
-                print("Error in sending buffered command: Pump not ready")
+                if attempt_number > self.max_attempt_number:
+                    raise PumpTimeoutError("Pump not ready for buffered command " + command_string)
+                deadline.check("Waiting to send buffered command " + command_string)
         
-        # Write buffered command
-        attempt_number = 0
+        # Write the whole command and check the echoes together. After a bad echo the
+        #   pump already holds every character, so the transaction fails and is retried
+        #   in full: the line feed of the next ready poll starts a new command buffer
+        if self.block_transfer:
+            self.write(command_message)
+            response = self.read(len(command_message))
+            if (response != command_message):
+                self.command_stats["retransmissions"] += 1
+                if self.verbose: print("Error in block transmission of " + command_string)
+                raise PumpTimeoutError("Bad echo of buffered command " + command_string)
+            return
+
+        # Write buffered command one character at a time
         for character in command_message:
             received = False
+            attempt_number = 0
             while not received:
-                self.write(chr(ord(character)))
+                self.write(character)
                 response = self.read(1)
                 if response == character:
                     received = True
                 else:
                     if self.verbose: print("Error in transmission of " + str((character, '')))
-
-        # Update the pump status after a buffered command
-        self.getStatus()
+                    self.command_stats["retransmissions"] += 1
+                    attempt_number += 1
+                    if attempt_number > self.max_attempt_number:
+                        raise PumpTimeoutError("No echo of buffered command " + command_string)
+                    deadline.check("Buffered command " + command_string)
         
     # ------------------------------------------------------------------------------------
     # Send Immediate Command
     # ------------------------------------------------------------------------------------ 
     def sendImmediateCommand(self, command_letter):
+        return self.transactions.run("immediate " + command_letter, self.immediateTransaction, command_letter)
+
+    # ------------------------------------------------------------------------------------
+    # Send an immediate command once, raises PumpTimeoutError if the pump stops
+    #   answering or the reply does not end before the deadline
+    # ------------------------------------------------------------------------------------ 
+    def immediateTransaction(self, deadline, command_letter):
         # Write single letter command
         self.write(chr(ord(command_letter)))
 
         # Get response
         message = []
         done = False
-        attempt_number = 0
         while not done:
             response = self.read(1)
+            if (response == ""):
+                raise PumpTimeoutError("No reply to immediate command " + command_letter)
             
             if ord(response) > 128:
                 done = True
                 message.append( chr(ord(response)-128))
             else:
+                deadline.check("Immediate command " + command_letter)
                 message.append(response)
                 self.write(chr(ord(self.acknowledge)))
                    
@@ -279,18 +368,19 @@ class APump(object):
     # ------------------------------------------------------------------------------------
     # Set Flow Direction: True = Forward; False = Backward
     # ------------------------------------------------------------------------------------ 
-    def setFlowDirection(self, forward):
+    def setFlowDirection(self, forward, refresh_status = False):
         if not self.simulate:
             if forward: direction_message = "jF"
             else: direction_message = "jB"
 
-            self.sendBufferedCommand(direction_message)
+            self.sendBufferedCommand(direction_message, refresh_status = refresh_status)
 
             # Check status to see if the desired change was made
             ## NEED CODE HERE
             
         if forward: self.direction = "Forward"
         else: self.direction = "Reverse"
+        if self.speed > 0.0: self.flow_status = "Flowing" # Setting the direction starts the pump
         if self.verbose:
             print("   " + "Set Direction: " + str(self.direction))
         return True
@@ -298,14 +388,14 @@ class APump(object):
     # ------------------------------------------------------------------------------------
     # Set Speed in Rotations per Minute
     # ------------------------------------------------------------------------------------ 
-    def setSpeed(self, rotation_speed):
+    def setSpeed(self, rotation_speed, refresh_status = False):
         if not self.simulate:
             # Check bounds
             if rotation_speed >= 0 and rotation_speed <= 48:
                 # Convert rotation speed to the rotation integer that will be sent
                 rotation_int = int(rotation_speed*100)
                 rotation_message = "R" + ("%04d" % rotation_int)
-                self.sendBufferedCommand(rotation_message)
+                self.sendBufferedCommand(rotation_message, refresh_status = refresh_status)
 
                 # Check status to see if the desired change was made
                 ## NEED CODE HERE
@@ -315,6 +405,8 @@ class APump(object):
                 return False
 
         if rotation_speed >= 0 and rotation_speed <= 48:
+            self.speed = float(rotation_speed)
+            if self.speed == 0.0: self.flow_status = "Stopped"
             if self.verbose:
                 print("   " + "Set Speed: " + str(self.speed))
         return True
@@ -356,14 +448,15 @@ class APump(object):
     # Write to Serial Port
     # ------------------------------------------------------------------------------------ 
     def write(self, message):
-        self.serial.write(message)
+        self.serial.write(message.encode("latin-1"))
         if self.serial_verbose: print("Wrote: " + str(("", message)))
 
     # ------------------------------------------------------------------------------------
     # Read from Serial Port
     # ------------------------------------------------------------------------------------ 
     def read(self, num_char):
-        response = self.serial.read(num_char)
+        response = self.serial.read(num_char).decode("latin-1")
+        self.command_stats["reads"] += 1
         if self.serial_verbose: print("Read: " + str(("", response)))
         return response
     
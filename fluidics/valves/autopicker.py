@@ -3,9 +3,40 @@ import sys
 import numpy
 import json
 import math
+import re
 
 import matplotlib.tri
 
+# Terms of the least squares plate models for the x, y and z machine coordinates,
+#   a model that the recorded wells cannot determine falls back to a simpler one
+FIT_TERMS = {"bilinear": [["1", "x", "y", "xy"]] * 3,
+             "affine": [["1", "x", "y"]] * 3,
+             "axes": [["1", "x"], ["1", "y"], ["1", "x", "y"]],
+             "translation": [["1"]] * 3}
+FIT_FALLBACK = {"bilinear": "affine", "affine": "axes"}
+
+def fit_terms(terms, x, y):
+    """Design matrix of the terms at the well locations x, y."""
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+    columns = {"1": numpy.ones_like(x), "x": x, "y": y, "xy": x * y}
+    return numpy.stack([columns[term] for term in terms], axis=-1)
+
+def row_letters(row):
+    """Row name of an A1 style well name, A to Z then AA, AB, .. for plates with more rows."""
+    letters = ""
+    row += 1
+    while row > 0:
+        row, remainder = divmod(row - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return letters
+
+def row_number(letters):
+    row = 0
+    for letter in letters.upper():
+        row = row * 26 + ord(letter) - ord("A") + 1
+    return row - 1
+
 def calculate_distance(start, end):
     dist = 0
     if start[0] is not None and end[0] is not None:
@@ -64,23 +95,25 @@ class MockAutopicker(object):
         print("MockCNC setting position to", position)
         self.position = list(position)
 
-    def move(self, port, direction):
+    def find_well(self, port, direction):
+        """The plate and well index of a port, the port is a well index or (plate name, well index)."""
         if isinstance(port, tuple):
             plate_name, port = port
             named_right = [p for p in self.plates if p.name == plate_name]
             plate = named_right[0]
         else:
             plate = self.plates[direction]
+        return plate, port % plate.well_count()
 
-        plate.move(*map(int, self.wells[port].split()[1:]))
+    def move(self, port, direction):
+        plate, well = self.find_well(port, direction)
+        plate.move_to_well(well)
         self.wait()
-        self.status = ("%s %s" % (plate.name, self.wells[port]), False)
+        self.status = ("%s %s" % (plate.name, plate.well_name(well)), False)
 
     def get_wells(self):
-        self.wells = []
-        for plate in self.plates:
-            for well in plate.locations():
-                self.wells.append("Well %d %d" % (well[0], well[1]))
+        """The wells of the largest plate, a port selects the same well index on any plate."""
+        self.wells = max(self.plates, key=lambda plate: plate.well_count()).well_names()
         return self.wells
 
     def get_plates(self):
@@ -117,11 +150,22 @@ class Plate(object):
         self.name = config["name"] if "name"  in config else ""
         self.height = config["height"] if "height" in config else None
         self.positions = config["positions"] if "positions" in config else []
-        if len(self.positions) > 2:
+        self.fit = config["fit"] if "fit" in config else "triangulation" # or bilinear, affine, axes, translation
+        self.shape = (config["cols"] if "cols" in config else 12,
+                      config["rows"] if "rows" in config else 8)
+        self.naming = config["naming"] if "naming" in config else "well" # or A1, index
+        self.pitch = config["pitch"] if "pitch" in config else None # Machine units per column and row
+        self.safe_height = config["safe_height"] if "safe_height" in config else None # z for moves between wells
+        self.plunge_z = config["plunge_z"] if "plunge_z" in config else None # z in a well
+        if isinstance(self.pitch, (int, float)):
+            self.pitch = [self.pitch, self.pitch]
+        self.table = None # columns x rows x 3 well positions, see build_table()
+        self.triangulation = None
+        self.interpolation = None
+        self.model = None # The least squares model in use, see fit_model()
+        self.residuals = None
+        if len(self.positions) > 1 or (len(self.positions) > 0 and (self.fit != "triangulation" or self.pitch is not None)):
             self.freeze()
-        else:
-            self.triangulation = None
-            self.interpolation = None
 
     def set_cnc(self, cnc):
         self.cnc = cnc
@@ -129,6 +173,10 @@ class Plate(object):
     def record_well(self, x = 0, y = 0):
         """Record the position of a single well for interpolation."""
         self.positions.append((x, y, self.cnc.coords(add_offset=True)))
+        self.table = None
+        self.interpolation = None
+        self.model = None
+        self.residuals = None
 
     def record_height(self):
         """Go up to the current z height from now on when exiting wells."""
@@ -136,7 +184,10 @@ class Plate(object):
 
     def freeze(self):
         """This takes the x, y, and z positions and solves the linear equations for positioning."""
-        if len(self.positions) > 2:
+        if self.fit != "triangulation" or len(self.positions) == 2 or (len(self.positions) == 1 and self.pitch is not None):
+            self.fit_model(self.fit if self.fit != "triangulation" else "affine")
+            self.build_table()
+        elif len(self.positions) > 2:
             point = [p[:2] for p in self.positions]
             point_x, point_y = zip(*point)
 
@@ -145,36 +196,226 @@ class Plate(object):
             self.triangulation = matplotlib.tri.Triangulation(point_x, point_y)
             self.interpolation = [matplotlib.tri.LinearTriInterpolator(self.triangulation, coord) for coord in zip(*coords)]
             #self.interpolation = [matplotlib.tri.CubicTriInterpolator(self.triangulation, coord) for coord in zip(*coords)]
+
+            # Wells outside the recorded wells use a least squares model instead
+            self.fit_model("affine")
+            self.residuals = None
+            self.build_table()
         else:
             raise Exception("Can't freeze positions with two or fewer!")
-        
-    def find_position(self, x=0, y=0):
-        if len(self.positions) == 1:
-            return numpy.array(self.positions[0][2])
-        elif len(self.positions) > 2:
-            if self.interpolation is None:
-                print("Interpolator undefined, attempting to freeze positions matrix...")
-                self.freeze()
-            return numpy.array([interp(x, y) for interp in self.interpolation])
+
+    def fit_model(self, model):
+        """Least squares fit of a plate model to the recorded wells, any number of wells works."""
+        if len(self.positions) == 0:
+            raise Exception("Can't fit a plate without positions!")
+        x, y = numpy.array([p[:2] for p in self.positions], dtype=float).T
+        coords = numpy.array([p[2] for p in self.positions], dtype=float)
+
+        # Wells relative to their center, so the minimum norm solution of a slope
+        #   that the wells do not determine (e.g. all in one column) is zero
+        self.fit_center = (numpy.mean(x), numpy.mean(y))
+        x = x - self.fit_center[0]
+        y = y - self.fit_center[1]
+
+        # Use the most detailed model that the wells determine
+        designs = [fit_terms(terms, x, y) for terms in FIT_TERMS[model]]
+        while model in FIT_FALLBACK and any(numpy.linalg.matrix_rank(d) < d.shape[1] for d in designs[:2]):
+            model = FIT_FALLBACK[model]
+            designs = [fit_terms(terms, x, y) for terms in FIT_TERMS[model]]
+
+        self.coefficients = [numpy.linalg.lstsq(design, coords[:, i], rcond=None)[0] for i, design in enumerate(designs)]
+        self.model = model
+        self.residuals = coords - numpy.stack([design.dot(c) for design, c in zip(designs, self.coefficients)], axis=-1)
+
+        # The plate pitch gives the column and row spacing that the wells do not determine
+        if self.pitch is not None and model == "axes":
+            for axis in range(2):
+                if numpy.linalg.matrix_rank(designs[axis]) < 2:
+                    self.coefficients[axis][1] = self.pitch[axis]
+
+        if len(self.positions) > 1 and self.interpolation is None:
+            print("Plate %s: %s fit to %d wells, rms residual %.3f, max %.3f" % (self.name, model, len(self.positions),
+                                                                                 math.sqrt(numpy.mean(numpy.sum(self.residuals**2, axis=1))),
+                                                                                 numpy.max(numpy.linalg.norm(self.residuals, axis=1))))
+
+    def fit_report(self):
+        """The residual (x, y, z) of each recorded well, or None for a triangulation."""
+        if self.residuals is None:
+            return None
+        return [(p[0], p[1], tuple(r)) for p, r in zip(self.positions, self.residuals)]
+
+    def evaluate_model(self, x, y):
+        """Positions of the least squares model, x and y can be arrays."""
+        x = numpy.asarray(x, dtype=float) - self.fit_center[0]
+        y = numpy.asarray(y, dtype=float) - self.fit_center[1]
+        return numpy.stack([fit_terms(terms, x, y).dot(c) for terms, c in zip(FIT_TERMS[self.model], self.coefficients)], axis=-1)
+
+    def build_table(self):
+        """Compute the position of every well in one pass, with a triangulation wells outside the recorded wells come from the least squares model."""
+        x, y = numpy.meshgrid(numpy.arange(self.shape[0]), numpy.arange(self.shape[1]), indexing="ij")
+        if self.interpolation is not None:
+            self.table = self.interpolate(x, y)
+            outside = numpy.isnan(self.table).any(axis=-1)
+            self.table[outside] = self.evaluate_model(x[outside], y[outside])
+        elif self.model is not None:
+            self.table = self.evaluate_model(x, y)
+        elif len(self.positions) == 1 and self.pitch is None:
+            self.table = numpy.empty(self.shape + (3,))
+            self.table[:, :] = self.positions[0][2]
         else:
-            # In theory you could support interpolation here
-            raise Exception("Can't find position if there are exactly two!")
+            # Builds the table when done
+            self.freeze()
+
+    def find_position(self, x=0, y=0):
+        if self.table is None:
+            self.build_table()
+        if x == int(x) and y == int(y) and 0 <= x < self.shape[0] and 0 <= y < self.shape[1]:
+            return self.table[int(x), int(y)].copy() # callers may change it
+
+        # Positions between or beyond the wells
+        if self.interpolation is not None:
+            position = self.interpolate(x, y)
+            if not numpy.isnan(position).any():
+                return position
+        if self.model is not None:
+            return self.evaluate_model(x, y)
+        return numpy.array(self.positions[0][2])
+
+    def interpolate(self, x, y):
+        """Positions of the triangulation, nan outside the recorded wells."""
+        return numpy.stack([numpy.ma.filled(numpy.ma.asarray(interp(x, y), dtype=float), numpy.nan) for interp in self.interpolation], axis=-1)
+
+    def find_well(self, well):
+        """Position of a well given as an index, a (x, y) tuple or a name like "B3"."""
+        return self.find_position(*self.parse_well(well))
+
+    def well_count(self):
+        return self.shape[0] * self.shape[1]
+
+    def well_index(self, x, y):
+        """Wells are numbered down each column, i.e. in the order of locations()."""
+        return x * self.shape[1] + y
+
+    def well_location(self, index):
+        """The (x, y) location of a well index."""
+        return divmod(index, self.shape[1])
+
+    def well_name(self, index):
+        """Name of a well index in the naming scheme of the plate."""
+        x, y = self.well_location(index)
+        if self.naming == "A1":
+            return "%s%d" % (row_letters(y), x + 1)
+        elif self.naming == "index":
+            return str(index + 1)
+        return "Well %d %d" % (x, y)
+
+    def well_names(self):
+        return WellNames(self)
+
+    def parse_well(self, well):
+        """Convert a well index, (x, y) tuple, "Well x y" label, well number or A1 style name (row letters, column number) to (x, y)."""
+        if isinstance(well, (int, numpy.integer)):
+            return self.well_location(int(well))
+        if isinstance(well, str):
+            if well.startswith("Well "):
+                return tuple(map(int, well.split()[1:]))
+            if well.isdigit():
+                return self.well_location(int(well) - 1)
+            match = re.match(r"([A-Za-z]+)(\d+)$", well)
+            if match is None:
+                raise Exception("Can't parse well name %s!" % well)
+            return (int(match.group(2)) - 1, row_number(match.group(1)))
+        return tuple(well)
 
     def move(self, x=0, y=0):
         target_position = self.find_position(x, y)
         self.cnc.step_through([(None, None, self.height), (target_position[0], target_position[1], self.height), target_position])
 
+    def move_to_well(self, well):
+        self.move(*self.parse_well(well))
+
     def home(self):
         """Home is above the first well."""
         target_position = self.find_position(0, 0)
         self.cnc.step_through([(None, None, self.height), (target_position[0], target_position[1], self.height)])
 
     def save(self):
-        return {"height": self.height, "positions": self.positions, "name": self.name}
+        config = {"height": self.height, "positions": self.positions, "name": self.name, "fit": self.fit,
+                  "cols": self.shape[0], "rows": self.shape[1], "naming": self.naming}
+        for key in ["pitch", "safe_height", "plunge_z"]:
+            if getattr(self, key) is not None:
+                config[key] = getattr(self, key)
+        return config
 
     def locations(self):
-        locations = []
-        for i in range(0, 12):
-            for j in range(0, 8):
-                locations.append((i, j))
-        return locations
+        return [self.well_location(index) for index in range(self.well_count())]
+
+
+class WellNames(object):
+    """The names of the wells of a plate as a read only sequence, each name is made when it is asked for."""
+    def __init__(self, plate):
+        self.plate = plate
+
+    def __len__(self):
+        return self.plate.well_count()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("well index out of range")
+        return self.plate.well_name(index)
+
+
+if __name__ == "__main__":
+    # Self checks of the well position table
+    def machine(x, y):
+        return (100.0 + 9.0 * x + 0.1 * y, 50.0 + 9.0 * y, -10.0 + 0.01 * x * y)
+
+    plate = Plate(config={"name": "check", "cols": 12, "rows": 8,
+                          "positions": [(x, y, machine(x, y)) for x, y in [(0, 0), (11, 0), (0, 7), (11, 7)]]})
+    assert plate.table.shape == (12, 8, 3)
+    assert numpy.allclose(plate.find_position(0, 0), machine(0, 0))
+    position = plate.find_position(11, 7)
+    position[2] = 0.0
+    assert numpy.allclose(plate.find_position(11, 7), machine(11, 7)) # A copy, not the table
+    assert not numpy.isnan(plate.find_position(12.5, 3)).any() # Beyond the recorded wells
+    print("Well position table self checks passed")
+
+    # Self checks of the least squares plate fits
+    wells = [(x, y) for x in range(0, 12, 3) for y in range(0, 8, 3)]
+    plate = Plate(config={"fit": "bilinear", "positions": [(x, y, machine(x, y)) for x, y in wells]})
+    assert plate.model == "bilinear"
+    assert numpy.allclose([r for _, _, r in plate.fit_report()], 0.0)
+    assert numpy.allclose(plate.find_position(5, 5), machine(5, 5))
+
+    # Wells in one column only determine the rows, the plate pitch gives the columns
+    plate = Plate(config={"fit": "affine", "pitch": 9.0, "positions": [(0, y, machine(0, y)) for y in range(3)]})
+    assert plate.model == "axes"
+    assert numpy.allclose(plate.find_position(4, 1)[:2], numpy.array(machine(0, 1))[:2] + [36.0, 0.0])
+
+    # A triangulation reports no residuals
+    plate = Plate(config={"positions": [(x, y, machine(x, y)) for x, y in [(0, 0), (11, 0), (0, 7)]]})
+    assert plate.fit_report() is None
+    print("Plate fit self checks passed")
+
+    # Self checks of the well names
+    plate = Plate(config={"cols": 12, "rows": 8, "naming": "A1", "positions": [(0, 0, machine(0, 0))]})
+    names = plate.well_names()
+    assert len(names) == 96
+    assert (names[0], names[1], names[8], names[-1]) == ("A1", "B1", "A2", "H12")
+    assert names[94:] == ["G12", "H12"]
+    try:
+        names[96]
+    except IndexError:
+        pass
+    else:
+        assert False, "Well 96 of a 96 well plate was named"
+    for index in [0, 9, 95]:
+        assert plate.parse_well(names[index]) == plate.well_location(index)
+    assert plate.parse_well("Well 3 2") == (3, 2)
+    assert plate.parse_well("12") == plate.well_location(11)
+    assert row_number(row_letters(27)) == 27
+    print("Well name self checks passed")
@@ -1,13 +1,16 @@
 import usb
 import crccheck
 from valves.autopicker import MockAutopicker
+from valves.usb_cnc import USBCNCMixin
 import valves.cnc_commands as cnc_commands
 # import autopicker
 
 # class CNC(autopicker.MockAutopicker):
-class CNC(MockAutopicker):
-    def __init__(self, idVendor=0x2121, idProduct=0x2130, configuration=(0,0)):
+class CNC(USBCNCMixin, MockAutopicker):
+    def __init__(self, idVendor=0x2121, idProduct=0x2130, configuration=(0,0),
+                 poll_interval=0.02, read_timeout=100, move_timeout=60.0):
         self.status = ("Initializing", False)
+        self.init_worker(poll_interval, read_timeout, move_timeout)
         # self.dev = usb.core.find(idVendor=idVendor, idProduct=idProduct)
         import usb.backend.libusb0
         backend = usb.backend.libusb0.get_backend(find_library=lambda x: r'./windows_dll/libusb0.dll')
@@ -38,33 +41,6 @@ class CNC(MockAutopicker):
         #output = crccheck.crc.Crc8DvbS2.calc(map(ord, msg[:-1])) == ord(msg[-1])  # python2 version 
         output = crccheck.crc.Crc8DvbS2.calc(list(msg[:-1])) == msg[-1]
         assert output
-        self.endpoint_out.write(msg)
-        return self.receive()
-
-    def receive(self):
-        return cnc_commands.parse_reply(self.endpoint_in.read(64))
-
-    def coords(self, add_offset=True):
-        received = self.receive()
-        return (received["x"], received["y"], received["z"])
-
-    def set(self, position = (0, 0, 0)):  # required
-        current_position = self.coords()
-        
-        if position[0] is None:
-            position = (current_position[0],current_position[1],-180) # changed -60 to -180
-        print(position)
-        self.send(cnc_commands.cmd_set_offset(current_position[0]-position[0], current_position[1]-position[1], current_position[2]-position[2]))
-        self.wait()
-
-        self.send(cnc_commands.cmd_zero())
-        self.wait()
-
-        self.send(cnc_commands.cmd_set_offset(position[0], position[1], position[2]))
-        self.wait()
-
-        return self.coords()
-
-    def wait(self):
-        while self.receive()["busy"]:
-            pass
+        with self.usb_lock:
+            self.endpoint_out.write(msg)
+            return self.receive()
@@ -1,7 +1,46 @@
+import collections
 import ctypes
+import json
+import math
+import os
+import re
 import serial 
+import threading
 import time
 from valves.cnc_talk import MockCNC
+
+RX_BUFFER_SIZE = 128 # bytes in the GRBL serial receive buffer
+POSITION_TOLERANCE = 1e-3 # mm, fitted positions closer than this are the same
+
+# Parse a grbl 0.9 (<Idle,MPos:0.000,0.000,0.000,WPos:...>) or 1.1
+# (<Idle|MPos:0.000,0.000,0.000|FS:0,0|WCO:...>) status report to
+# the state and a dictionary of the fields, e.g. {'MPos': (0.0, 0.0, 0.0)}
+def parseStatus(report):
+    body = report.strip('<>')
+    state = re.split('[|,]', body)[0].split(':')[0]
+    fields = {}
+    for key, values in re.findall(r'([A-Za-z]+):(-?[\d.]+(?:,-?[\d.]+)*)', body[len(state):]):
+        fields[key] = tuple(float(value) for value in values.split(','))
+    return state, fields
+
+# GRBL did not answer in time, e.g. it stopped or the serial link dropped
+class GRBLTimeoutError(Exception):
+    pass
+
+# A line sent to GRBL, reply is "ok" or "error:N" once GRBL has answered it
+class GRBLLine(object):
+    def __init__(self, command):
+        self.command = command
+        self.size = len(command) + 1 # with the newline
+        self.reply = None
+        self.done = threading.Event()
+
+    # The reply, raises GRBLTimeoutError if there is none within timeout seconds
+    def wait(self, timeout = None):
+        if not self.done.wait(timeout):
+            raise GRBLTimeoutError('no reply from grbl to ' + self.command + ' within %.1f s' % timeout)
+        return self.reply
+
 #import cnc_talk
 
 # class XYZ(cnc_talk.MockCNC):
@@ -9,15 +48,55 @@ class GRBL(MockCNC):  # see cnc_talk.MockCNC
     def __init__(self,
                  com_port = "COM4",
                  config=r"./valves/XYZ_layout.json",
-                 parameters = False):
+                 parameters = False,
+                 safe_height = 0.0,     # z for moves between wells, unless the plate sets safe_height
+                 plunge_z = -37.0,      # z in a well, unless the plate sets plunge_z
+                 plunge_feed = 1000.0,  # mm/min into a well
+                 rapid_rate = 2000.0,   # mm/min of G0 moves, for time estimates (see $110-$112)
+                 status_interval = 0.2, # seconds between '?' status queries
+                 reply_timeout = 10.0,  # seconds grbl may take to answer a line, on top of any motion
+                 homing_timeout = 60.0, # seconds for $H
+                 state_file = r"./valves/grbl_state.json"): # the G92 offset of the last homing
 
         # Define attributes
         self.status = ("Initializing", False)
         self.com_port = com_port # COM port (see Device Manager)
         self.restore_config(config) #  plate configuration
         
-        # Create serial port
-        self.serial = serial.Serial(port = self.com_port, baudrate = 115200) # GRBL operates at 115200 baud
+        # Create serial port, the timeout lets the reader thread stop. DTR stays low so
+        # that opening the port does not reset the controller (some USB serial drivers
+        # still pulse it)
+        self.serial = serial.Serial()
+        self.serial.port = self.com_port
+        self.serial.baudrate = 115200 # GRBL operates at 115200 baud
+        self.serial.timeout = 0.1
+        self.serial.dtr = False
+        self.serial.open()
+
+        # Lines GRBL has not answered yet, in the order they were sent
+        self.pending = collections.deque()
+        self.buffer_used = 0 # bytes of the pending lines in the GRBL receive buffer
+        self.buffer_space = threading.Condition()
+        self.messages = collections.deque(maxlen = 100) # other lines from GRBL
+        self.reader_thread = None
+        self.write_lock = threading.Lock()
+
+        # Machine state from the grbl status reports
+        self.status_interval = status_interval
+        self.reply_timeout = reply_timeout
+        self.homing_timeout = homing_timeout
+        self.status_changed = threading.Condition()
+        self.status_count = 0 # number of status reports received
+        self.state = None # e.g. Idle, Run, Hold, Alarm
+        self.machine_position = None
+        self.work_position = None
+        self.work_offset = (0.0, 0.0, 0.0)
+        self.idle = threading.Event() # set while grbl is idle with no unanswered lines
+        self.move_complete_callbacks = [] # called with the work position when a move ends
+        self.poller_thread = None
+        self.banner = None # e.g. "Grbl 1.1h ['$' for help]", only seen after a reset
+        self.coordinate_offsets = {} # from '$#', e.g. {'G92': (0.0, 0.0, 0.0)}
+        self.state_file = state_file
 
         # Define initial valve status
         self.xpos = 'X0'
@@ -25,22 +104,81 @@ class GRBL(MockCNC):  # see cnc_talk.MockCNC
         self.zpos = 'Z0'
         self.position = (self.xpos,self.ypos,self.zpos)
         self.feedspeed = 'F2000'
-        # wake up grbl, homing and set the home position zero
+        self.safe_height = safe_height
+        self.plunge_z = plunge_z
+        self.plunge_feed = plunge_feed
+        self.rapid_rate = rapid_rate
+        self.last_move_estimate = None # seconds
+        # wake up grbl, homing and set the home position zero unless it is already homed
         self.wakeUp()
 
     # Wake up grbl
     def wakeUp(self):
-        self.sendCommand('\r\n\r\n')
-        time.sleep(2)   # Wait for grbl to initialize
-        self.serial.flushInput()  # Flush startup text in serial input
+        start_time = time.time()
+        self.startReader()
+        if not self.waitForStartup():
+            print('MESSAGE -- no answer from GRBL on ' + str(self.com_port))
         print('MESSAGE -- GRBL woke up.')
-        self.sendCommand('$H') # homing
-        self.sendCommand('G92 X0 Y0 Z0') # set current position 0
-        print('MESSAGE -- Homing is done. Ready to send commands.')
+
+        # An idle controller that was not reset still has the position of its last homing
+        saved_offset = self.loadOffset()
+        if (self.banner is None) and (self.state == 'Idle') and (saved_offset is not None) and self.checkOffset(saved_offset):
+            print('MESSAGE -- GRBL was already homed. Ready to send commands after %.2f s.' % (time.time() - start_time))
+        else:
+            self.sendCommand('$H', timeout = self.homing_timeout) # homing
+            self.sendCommand('G92 X0 Y0 Z0') # set current position 0
+            self.sendCommand('$#') # report the new G92 offset
+            self.saveOffset()
+            print('MESSAGE -- Homing is done. Ready to send commands.')
         self.xpos = 'X0'
         self.ypos = 'Y0'
         self.zpos = 'Z0'
         self.position = (0,0,0)
+        if self.waitForIdle(timeout = 5.0):
+            self.position = self.work_position
+            [self.xpos, self.ypos, self.zpos] = [axis + str(value) for axis, value in zip('XYZ', self.position)]
+
+    # Wait for the banner of a controller that was reset, or for the status
+    # report of one that was already running
+    def waitForStartup(self, timeout = 3.0):
+        end_time = time.time() + timeout
+        with self.status_changed:
+            while (self.banner is None) and (self.status_count == 0):
+                if not self.status_changed.wait(max(0.0, end_time - time.time())):
+                    return False
+            # A controller that was just reset reports its state once it is ready
+            while (self.status_count == 0):
+                if not self.status_changed.wait(max(0.0, end_time - time.time())):
+                    return False
+        return True
+
+    # The G92 offset saved after the last homing, or None
+    def loadOffset(self):
+        if not os.path.exists(self.state_file):
+            return None
+        try:
+            with open(self.state_file) as input_file:
+                state = json.load(input_file)
+            return tuple(state['G92'])
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    def saveOffset(self):
+        if not 'G92' in self.coordinate_offsets:
+            print('MESSAGE -- no G92 offset reported, homing state not saved')
+            return
+        with open(self.state_file, 'w') as output_file:
+            json.dump({'G92': self.coordinate_offsets['G92']}, output_file)
+
+    # Does grbl still have the G92 offset of the last homing? If not, the
+    # machine position can not be trusted and it has to be homed again
+    def checkOffset(self, saved_offset):
+        self.sendCommand('$#')
+        current_offset = self.coordinate_offsets.get('G92')
+        if (current_offset is None) or any(abs(c - s) >= 0.001 for c, s in zip(current_offset, saved_offset)):
+            print('MESSAGE -- the G92 offset of grbl does not match the last homing')
+            return False
+        return True
         # may not need this
         # self.current_position = (0,0,0)      
 
@@ -60,36 +198,283 @@ class GRBL(MockCNC):  # see cnc_talk.MockCNC
         self.sendCommand('G01 Z-37')
         self.zpos = 'Z-37'
 
-    def wait(self,waitingtime=1):
-        command = 'G04 P'+str(waitingtime)
-        self.sendCommand(command)
-        return True
+    # G-code lines and estimated seconds to put the needle into a well at x, y,
+    # rapid moves at the safe height and a slower feed only into the well
+    def planMove(self, x, y, safe_z = None, plunge_z = None):
+        safe_z = self.safe_height if safe_z is None else safe_z
+        plunge_z = self.plunge_z if plunge_z is None else plunge_z
+        if not all(math.isfinite(value) for value in (x, y, safe_z, plunge_z)):
+            raise ValueError('No position for the needle at X%s Y%s Z%s' % (x, y, plunge_z))
+        [cx, cy, cz] = [float(value) for value in self.position]
+        commands = []
+        minutes = 0.0
+
+        # Moving to another well, go up (if needed) and over at the safe height
+        if math.hypot(x - cx, y - cy) >= POSITION_TOLERANCE:
+            if abs(cz - safe_z) >= POSITION_TOLERANCE:
+                commands.append('G0 Z%.3f' % safe_z)
+                minutes += abs(cz - safe_z)/self.rapid_rate
+                cz = safe_z
+            commands.append('G0 X%.3f Y%.3f' % (x, y))
+            minutes += math.hypot(x - cx, y - cy)/self.rapid_rate
+
+        # Nothing to do if the needle is already in the well
+        if abs(cz - plunge_z) >= POSITION_TOLERANCE:
+            commands.append('G1 Z%.3f F%.0f' % (plunge_z, self.plunge_feed))
+            minutes += abs(cz - plunge_z)/self.plunge_feed
+        return commands, 60.0 * minutes
+
+    # Move the needle into a well at x, y
+    def moveNeedle(self, x, y, safe_z = None, plunge_z = None):
+        commands, estimate = self.planMove(x, y, safe_z, plunge_z)
+        self.last_move_estimate = estimate
+        if commands:
+            print('Moving needle, estimated %.1f s' % estimate)
+            self.streamCommands(commands, timeout = estimate + self.reply_timeout)
+        self.position = (x, y, self.plunge_z if plunge_z is None else plunge_z)
+        self.xpos = 'X' + str(self.position[0])
+        self.ypos = 'Y' + str(self.position[1])
+        self.zpos = 'Z' + str(self.position[2])
+
+    def move(self, port, direction):
+        plate, well = self.find_well(port, direction)
+        target = plate.find_position(*plate.parse_well(well))
+        self.moveNeedle(float(target[0]), float(target[1]), plate.safe_height, plate.plunge_z)
+        if not self.wait(self.last_move_estimate + self.reply_timeout):
+            raise GRBLTimeoutError('grbl did not finish the move to %s %s' % (plate.name, plate.well_name(well)))
+        self.status = ("%s %s" % (plate.name, plate.well_name(well)), False)
+
+    # Wait until the needle has stopped moving
+    def wait(self, timeout = None):
+        return self.waitForIdle(timeout)
 
-    # Stream g-code to grbl
-    def sendCommand(self,command):
-        line = command+'\n'
+    # Send one line of g-code to grbl and wait for the reply, by default for
+    # reply_timeout seconds
+    def sendCommand(self, command, timeout = None):
         print('Sending: ' + command)
-        self.serial.write(line.encode()) # Send g-code block to grbl
-        res = self.getResponse()
-        return res
+        timeout = self.reply_timeout if timeout is None else timeout
+        end_time = time.time() + timeout
+        return self.queueCommand(command, timeout).wait(max(0.0, end_time - time.time()))
 
-    def getResponse(self):
-        grbl_out = self.serial.readline() # Wait for grbl response with carriage return
-        return grbl_out.strip().decode()
+    # Stream several lines of g-code, keeping the grbl receive buffer full so
+    # that grbl plans them as one continuous motion. All the lines have to be
+    # answered within timeout seconds (by default reply_timeout)
+    def streamCommands(self, commands, wait = True, timeout = None):
+        print('Streaming: ' + ', '.join(commands))
+        timeout = self.reply_timeout if timeout is None else timeout
+        end_time = time.time() + timeout
+        lines = [self.queueCommand(command, max(0.0, end_time - time.time())) for command in commands]
+        if wait:
+            for line in lines:
+                line.wait(max(0.0, end_time - time.time()))
+        return lines
+
+    # Send a line once the grbl receive buffer has room for it (character counting),
+    # raises GRBLTimeoutError if there is no room within timeout seconds
+    def queueCommand(self, command, timeout = None):
+        line = GRBLLine(command)
+        end_time = None if timeout is None else time.time() + timeout
+        with self.buffer_space:
+            while self.pending and (self.buffer_used + line.size > RX_BUFFER_SIZE):
+                if not self.buffer_space.wait(None if end_time is None else max(0.0, end_time - time.time())):
+                    raise GRBLTimeoutError('no room in the grbl receive buffer for ' + command + ' within %.1f s' % timeout)
+            self.pending.append(line)
+            self.buffer_used += line.size
+            self.idle.clear()
+            with self.write_lock:
+                self.serial.write((command + '\n').encode()) # Send g-code block to grbl
+        return line
+
+    # Match each ok/error from grbl to the oldest line it has not answered
+    def readReplies(self):
+        partial = b''
+        while self.reading:
+            partial += self.serial.readline()
+            if not partial.endswith(b'\n'):
+                continue
+            reply = partial.strip().decode(errors = 'replace')
+            partial = b''
+            if not reply:
+                continue
+            if reply == 'ok' or reply.startswith('error'):
+                with self.buffer_space:
+                    if not self.pending:
+                        print('MESSAGE -- unexpected grbl reply ' + reply)
+                        continue
+                    line = self.pending.popleft()
+                    self.buffer_used -= line.size
+                    line.reply = reply
+                    line.done.set()
+                    self.buffer_space.notify_all()
+                if reply != 'ok':
+                    print('MESSAGE -- grbl ' + reply + ' for ' + line.command)
+            elif reply.startswith('<'):
+                self.handleStatus(reply)
+            else:
+                self.handleMessage(reply)
+
+    # Keep the startup banner, coordinate offsets and other messages from grbl
+    def handleMessage(self, message):
+        self.messages.append(message)
+        offset = re.match(r'\[(G5[4-9]|G28|G30|G92):(-?[\d.]+(?:,-?[\d.]+)*)', message)
+        if offset is not None:
+            self.coordinate_offsets[offset.group(1)] = tuple(float(value) for value in offset.group(2).split(',')[:3])
+
+            # grbl 1.1 only reports WCO now and then, until it does the work
+            # offset is that of the G54 coordinates and G92
+            if offset.group(1) in ('G54', 'G92'):
+                with self.status_changed:
+                    self.work_offset = tuple(g + o for g, o in zip(self.coordinate_offsets.get('G54', (0.0, 0.0, 0.0)),
+                                                                   self.coordinate_offsets.get('G92', (0.0, 0.0, 0.0))))
+        elif message.startswith('Grbl '):
+            with self.status_changed:
+                self.banner = message
+                self.status_changed.notify_all()
+        elif message.startswith('ALARM') or message.startswith('[MSG'):
+            print('MESSAGE -- grbl ' + message)
+
+    # Update the machine state from a status report
+    def handleStatus(self, report):
+        state, fields = parseStatus(report)
+        with self.status_changed:
+            self.state = state
+            if 'WCO' in fields:
+                self.work_offset = fields['WCO'] # grbl 1.1 only reports this now and then
+            if 'MPos' in fields:
+                self.machine_position = fields['MPos']
+                if not 'WPos' in fields:
+                    self.work_position = tuple(m - o for m, o in zip(fields['MPos'], self.work_offset))
+            if 'WPos' in fields:
+                self.work_position = fields['WPos']
+                if not 'MPos' in fields:
+                    self.machine_position = tuple(w + o for w, o in zip(fields['WPos'], self.work_offset))
+            self.status_count += 1
+            self.status_changed.notify_all()
+
+        # Replies and reports arrive in order, so an Idle report after the last
+        # line was answered means that its motion has ended
+        with self.buffer_space:
+            move_complete = (state == 'Idle') and not self.pending and not self.idle.is_set()
+            if move_complete:
+                self.idle.set()
+        if move_complete:
+            for callback in self.move_complete_callbacks:
+                callback(self.work_position)
+
+    # Ask grbl for a status report, '?' is a real time command that is not buffered
+    def requestStatus(self):
+        with self.write_lock:
+            self.serial.write(b'?')
+
+    # Query the status at status_interval
+    def pollStatus(self):
+        while self.reading:
+            self.requestStatus()
+            time.sleep(self.status_interval)
+
+    def addMoveCompleteCallback(self, callback):
+        self.move_complete_callbacks.append(callback)
+
+    # Wait until grbl has answered every line and then reports Idle, returns
+    # False on a timeout or alarm
+    def waitForIdle(self, timeout = None):
+        end_time = None if timeout is None else time.time() + timeout
+        with self.buffer_space:
+            while self.pending:
+                if not self.buffer_space.wait(None if end_time is None else max(0.0, end_time - time.time())):
+                    return False
+
+        # Only a report asked for after the last line was answered shows that its motion ended
+        with self.status_changed:
+            count = self.status_count
+            self.requestStatus()
+            while (self.status_count == count) or (self.state != 'Idle'):
+                if self.state == 'Alarm':
+                    print('MESSAGE -- grbl is in an alarm state')
+                    return False
+                if not self.status_changed.wait(None if end_time is None else max(0.0, end_time - time.time())):
+                    return False
+        return True
+
+    def coords(self, add_offset=True):
+        if self.work_position is not None:
+            return self.work_position
+        return self.position
+
+    def startReader(self):
+        self.reading = True
+        self.reader_thread = threading.Thread(target = self.readReplies, daemon = True)
+        self.reader_thread.start()
+        self.poller_thread = threading.Thread(target = self.pollStatus, daemon = True)
+        self.poller_thread.start()
+
+    def close(self):
+        if self.reader_thread is not None:
+            self.reading = False
+            self.reader_thread.join()
+            self.poller_thread.join()
+        self.serial.close()
 
     def set(self, position = (0, 0, 0)):
         if position[0] is not None:
             print('setting position')
             print(position)
-            newX = 'X'+str(position[0])
-            newY = 'Y'+str(position[1])
-            if self.xpos == newX and self.ypos == newY:  # we only stop down anyway
-                pass
-                # print('aready here')
-            else:
-                self.needleUp()  # if we remove this, it doesn't bounce
-                self.moveXY(newX,newY)
-                self.needleDown()
-                # self.position = position
+            self.moveNeedle(float(position[0]), float(position[1]))
         
-        # return position #  self.coords()  # it looks like this keeps track of absolute position  
\ No newline at end of file
+        # return position #  self.coords()  # it looks like this keeps track of absolute position  
+
+if __name__ == "__main__":
+    # Self checks of the status report parsing
+    assert parseStatus('<Idle,MPos:0.000,-1.500,2.000,WPos:1.000,0.000,0.000>') == \
+        ('Idle', {'MPos': (0.0, -1.5, 2.0), 'WPos': (1.0, 0.0, 0.0)})
+    assert parseStatus('<Run|MPos:5.000,6.000,-7.000|FS:500,0|WCO:1.000,1.000,0.000>') == \
+        ('Run', {'MPos': (5.0, 6.0, -7.0), 'FS': (500.0, 0.0), 'WCO': (1.0, 1.0, 0.0)})
+    assert parseStatus('<Hold:0|WPos:1.000,2.000,3.000>') == ('Hold', {'WPos': (1.0, 2.0, 3.0)})
+
+    # A work position comes from the machine position and the last WCO
+    grbl = GRBL.__new__(GRBL)
+    grbl.status_changed = threading.Condition()
+    grbl.buffer_space = threading.Condition()
+    grbl.pending = collections.deque()
+    grbl.idle = threading.Event()
+    grbl.move_complete_callbacks = []
+    grbl.work_offset = (0.0, 0.0, 0.0)
+    grbl.status_count = 0
+    grbl.handleStatus('<Run|MPos:5.000,6.000,-7.000|WCO:1.000,1.000,0.000>')
+    grbl.handleStatus('<Idle|MPos:5.000,6.000,-8.000>')
+    assert grbl.work_position == (4.0, 5.0, -8.0)
+    assert grbl.idle.is_set() and (grbl.status_count == 2)
+    print('GRBL status self checks passed')
+
+    # Self checks of the needle move planning
+    grbl.position = (0.0, 0.0, -37.0)
+    grbl.safe_height = 0.0
+    grbl.plunge_z = -37.0
+    grbl.plunge_feed = 1000.0
+    grbl.rapid_rate = 2000.0
+    commands, estimate = grbl.planMove(30.0, 40.0)
+    assert commands == ['G0 Z0.000', 'G0 X30.000 Y40.000', 'G1 Z-37.000 F1000']
+    assert math.isclose(estimate, 60.0 * (37.0/2000.0 + 50.0/2000.0 + 37.0/1000.0))
+    assert grbl.planMove(0.0, 0.0) == ([], 0.0) # Already in the well
+    assert grbl.planMove(0.0 + 1e-9, 0.0 - 1e-9)[0] == [] # The same well, fitted again
+    assert grbl.planMove(0.0, 0.0, plunge_z = -30.0)[0] == ['G1 Z-30.000 F1000']
+    try:
+        grbl.planMove(float('nan'), 0.0)
+    except ValueError:
+        pass
+    else:
+        assert False, 'A nan position was planned'
+    print('GRBL move planning self checks passed')
+
+    # Self checks of the reply timeout
+    line = GRBLLine('G0 X1')
+    try:
+        line.wait(0.01)
+    except GRBLTimeoutError:
+        pass
+    else:
+        assert False, 'A line without a reply did not time out'
+    line.reply = 'ok'
+    line.done.set()
+    assert line.wait(0.01) == 'ok'
+    print('GRBL timeout self checks passed')
@@ -16,6 +16,7 @@ class XYZ(MockCNC):
     def home(self):
         self.mm._Z4homePc(ctypes.c_char_p(self.device))
         self.current_position = (0,0,0)
+        self.position = self.current_position
         print(self.current_position)
         print(self.device)
 
@@ -23,6 +24,7 @@ class XYZ(MockCNC):
         self.mm._Z3jogPciii(ctypes.c_char_p(self.device), ctypes.c_int(x), ctypes.c_int(y), ctypes.c_int(z))
 
         self.current_position = (self.current_position[0] + x, self.current_position[1] + y, self.current_position[2] + z)
+        self.position = self.current_position
 
     def coords(self, add_offset=True):
         return self.current_position
@@ -20,6 +20,26 @@ import valves.ui_layouts.ui_qt_valve as uiQtValve
 # import storm_control.fluidics.valves.ui_layouts.ui_qt_valve as uiQtValve # 34
 
 
+# ----------------------------------------------------------------------------------------
+# PortNamesModel Class Definition: Serves port names to a combo box as they are
+#   displayed, so a long sequence (e.g. the wells of a 1536 well plate) is not
+#   copied into combo box items
+# ----------------------------------------------------------------------------------------
+class PortNamesModel(QtCore.QAbstractListModel):
+    def __init__(self, port_names, parent = None):
+        QtCore.QAbstractListModel.__init__(self, parent)
+        self.port_names = port_names
+
+    def data(self, index, role = QtCore.Qt.DisplayRole):
+        if index.isValid() and (role == QtCore.Qt.DisplayRole):
+            return self.port_names[index.row()]
+        return None
+
+    def rowCount(self, parent = QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.port_names)
+
 # ----------------------------------------------------------------------------------------
 # QtValveControl Class Definition
 # ----------------------------------------------------------------------------------------
@@ -136,9 +156,15 @@ class QtValveControl(QtWidgets.QWidget):
     # Set port names for display
     # ------------------------------------------------------------------------------------  
     def setPortNames(self, port_names):
-        self.ui.desiredPortComboBox.clear()
-        for name in port_names:
-            self.ui.desiredPortComboBox.addItem(name)
+        self.max_ports = len(port_names)
+        self.port_names_model = PortNamesModel(port_names, self)
+        self.ui.desiredPortComboBox.setModel(self.port_names_model)
+
+        # Do not size the combo box by asking for every name of a long list
+        if (self.max_ports > 100):
+            self.ui.desiredPortComboBox.view().setUniformItemSizes(True)
+            self.ui.desiredPortComboBox.setSizeAdjustPolicy(QtWidgets.QComboBox.AdjustToMinimumContentsLengthWithIcon)
+            self.ui.desiredPortComboBox.setMinimumContentsLength(max(len(port_names[0]), len(port_names[-1])))
 
     # ------------------------------------------------------------------------------------
     # Set possible rotation directions
@@ -0,0 +1,106 @@
+import concurrent.futures
+import errno
+import threading
+import time
+import usb
+import valves.cnc_commands as cnc_commands
+
+
+def is_usb_timeout(error):
+    """A USB transfer that timed out, older pyusb only sets the errno."""
+    return isinstance(error, getattr(usb.core, "USBTimeoutError", ())) or error.errno == errno.ETIMEDOUT
+
+
+class USBCNCMixin(object):
+    """Moves, busy polling and move timing of the USB CNC, shared by cnc_talk.CNC and autopicker_cnc.CNC.
+
+    Moves run on a worker thread, so move_async() and set_async() return a future
+    and leave the calling (GUI) thread free.
+    """
+    def init_worker(self, poll_interval=0.02, read_timeout=100, move_timeout=60.0):
+        self.poll_interval = poll_interval # seconds between busy queries while waiting
+        self.read_timeout = read_timeout # ms, a USB read never blocks longer than this
+        self.move_timeout = move_timeout # seconds
+        self.usb_lock = threading.Lock() # one transaction at a time on the endpoints
+        self.move_lock = threading.Lock() # one offset/zero/offset sequence at a time
+        self.worker = concurrent.futures.ThreadPoolExecutor(max_workers=1) # runs moves in order
+        self.move_stats = {"count": 0, "time": 0.0, "max_time": 0.0, "polls": 0}
+        self.last_move_time = None
+
+    def receive(self):
+        return cnc_commands.parse_reply(self.endpoint_in.read(64, self.read_timeout))
+
+    def coords(self, add_offset=True):
+        with self.usb_lock:
+            received = self.receive()
+        return (received["x"], received["y"], received["z"])
+
+    def move_async(self, port, direction):
+        """Queue a move to a port on the worker thread, the future's result is the new position."""
+        self.status = (self.status[0], True)
+        return self.worker.submit(self.move_and_report, port, direction)
+
+    def move_and_report(self, port, direction):
+        self.move(port, direction)
+        return self.position
+
+    def set_async(self, position = (0, 0, 0)):
+        """Queue a move on the worker thread, the future's result is the new position."""
+        return self.worker.submit(self.set, position)
+
+    def set(self, position = (0, 0, 0)):
+        """Move to position and return the new position once the CNC is idle."""
+        with self.move_lock:
+            start_time = time.perf_counter()
+            result = self.set_now(position)
+            self.last_move_time = time.perf_counter() - start_time
+            self.move_stats["count"] += 1
+            self.move_stats["time"] += self.last_move_time
+            self.move_stats["max_time"] = max(self.move_stats["max_time"], self.last_move_time)
+        return result
+
+    def set_now(self, position):
+        current_position = self.coords()
+
+        if position[0] is None:
+            position = (current_position[0],current_position[1],-180) # changed -60 to -180
+        print(position)
+        self.send(cnc_commands.cmd_set_offset(current_position[0]-position[0], current_position[1]-position[1], current_position[2]-position[2]))
+        self.wait()
+
+        self.send(cnc_commands.cmd_zero())
+        self.wait()
+
+        self.send(cnc_commands.cmd_set_offset(position[0], position[1], position[2]))
+        self.wait()
+
+        self.position = self.coords()
+        return self.position
+
+    def wait(self):
+        """Poll every poll_interval until the CNC is no longer busy."""
+        end_time = time.perf_counter() + self.move_timeout
+        while True:
+            try:
+                with self.usb_lock:
+                    busy = self.receive()["busy"]
+                self.move_stats["polls"] += 1
+            except usb.core.USBError as error:
+                if not is_usb_timeout(error): # e.g. the CNC was disconnected
+                    raise
+                busy = True # read timed out, the device is still working
+            if not busy:
+                return
+            if time.perf_counter() > end_time:
+                raise Exception("CNC move did not finish within %.1f s" % self.move_timeout)
+            time.sleep(self.poll_interval)
+
+    def get_move_stats(self):
+        """Number, total and longest time (s) of the moves, and busy polls while waiting."""
+        stats = dict(self.move_stats)
+        if stats["count"] > 0:
+            stats["mean_time"] = stats["time"] / stats["count"]
+        return stats
+
+    def close(self):
+        self.worker.shutdown(wait=True)
@@ -20,6 +20,7 @@
 # Import
 # ----------------------------------------------------------------------------------------
 import sys
+import time
 from PyQt5 import QtCore, QtGui, QtWidgets
 from valves.qtValveControl import QtValveControl
 from valves.hamilton import HamiltonMVP
@@ -32,6 +33,11 @@ from valves.autopicker_grbl import GRBL     # use GRBL CNC system for robot need
 # ValveChain Class Definition
 # ----------------------------------------------------------------------------------------
 class ValveChain(QtWidgets.QWidget):
+
+    # Define custom signal
+    move_complete_signal = QtCore.pyqtSignal(object) # Dictionary describing the finished move
+    cnc_move_done_signal = QtCore.pyqtSignal(object) # From the USB CNC worker thread to the GUI thread
+
     def __init__(self,
                  parent = None,
                  com_port = "COM2",
@@ -96,6 +102,10 @@ class ValveChain(QtWidgets.QWidget):
         self.num_valves = self.valve_chain.howManyValves()
         self.valve_names = []
         self.valve_widgets = []
+        self.valve_status = [("Unknown", False)] * self.num_valves # Last polled status
+        self.cnc_status = None
+        self.cnc_moves_pending = 0 # USB CNC moves queued on the worker thread
+        self.cnc_move_done_signal.connect(self.handleCNCMoveComplete)
         
         # Create GUI
         self.createGUI() # Widgets created here
@@ -135,12 +145,49 @@ class ValveChain(QtWidgets.QWidget):
             self.valve_chain.changePort(valve_ID = valve_ID,
                                     port_ID = port_ID,
                                     direction = rotation_direction)
+        elif hasattr(self.cnc, "move_async"):
+            # The USB CNC moves on its worker thread, the GUI is updated when it is done
+            start_time = time.time()
+            self.cnc_moves_pending += 1
+            future = self.cnc.move_async(port_ID, direction = rotation_direction)
+            future.add_done_callback(lambda future: self.handleCNCMoveDone(future, port_ID, start_time))
         else:
-            self.cnc.move(port_ID, direction = rotation_direction)
+            start_time = time.time()
+            move = {"device": "cnc", "port_ID": port_ID}
+            try:
+                self.cnc.move(port_ID, direction = rotation_direction)
+            except Exception as error: # e.g. a well without a position, the move is reported as failed
+                move["error"] = str(error)
+            move["move_time"] = time.time() - start_time
+            move["estimated_time"] = getattr(self.cnc, "last_move_estimate", None)
+            self.handleCNCMoveComplete(move)
 
         # Update valve display
         self.pollValveStatus()
 
+    # ------------------------------------------------------------------------------------
+    # Called on the USB CNC worker thread when a move ends, passed on to the GUI thread
+    # ------------------------------------------------------------------------------------
+    def handleCNCMoveDone(self, future, port_ID, start_time):
+        move = {"device": "cnc",
+                "port_ID": port_ID,
+                "move_time": time.time() - start_time,
+                "estimated_time": getattr(self.cnc, "last_move_estimate", None)}
+        if future.exception() is not None:
+            move["error"] = str(future.exception())
+        self.cnc_move_done_signal.emit(move)
+
+    # ------------------------------------------------------------------------------------
+    # Report a finished CNC move
+    # ------------------------------------------------------------------------------------
+    def handleCNCMoveComplete(self, move):
+        self.cnc_moves_pending = max(self.cnc_moves_pending - 1, 0)
+        if "error" in move:
+            print("CNC move to port " + str(move["port_ID"]) + " failed: " + move["error"])
+            self.cnc.status = ("Move failed", False)
+        self.move_complete_signal.emit(move)
+        self.pollValveStatus()
+
     # ------------------------------------------------------------------------------------
     # Close class
     # ------------------------------------------------------------------------------------
@@ -205,6 +252,12 @@ class ValveChain(QtWidgets.QWidget):
         self.menu_names = ["Valve"]
         self.menu_items = [[self.valve_reset_action]]
 
+    # ------------------------------------------------------------------------------------
+    # Is a USB CNC move still running on the worker thread?
+    # ------------------------------------------------------------------------------------
+    def isCNCMoving(self):
+        return self.cnc_moves_pending > 0
+
     # ------------------------------------------------------------------------------------
     # Determine number of valves
     # ------------------------------------------------------------------------------------
@@ -216,9 +269,30 @@ class ValveChain(QtWidgets.QWidget):
     # ------------------------------------------------------------------------------------
     def pollValveStatus(self):
         for valve_ID in range(self.num_valves):
-            self.valve_widgets[valve_ID].setStatus(self.valve_chain.getStatus(valve_ID))
+            was_moving = bool(self.valve_status[valve_ID][1])
+            self.valve_status[valve_ID] = self.valve_chain.getStatus(valve_ID)
+            self.valve_widgets[valve_ID].setStatus(self.valve_status[valve_ID])
+            if was_moving and not self.valve_status[valve_ID][1]:
+                self.move_complete_signal.emit({"device": "valve",
+                                                "valve_ID": valve_ID,
+                                                "port": self.valve_status[valve_ID][0]})
+        if self.cnc is not None:
+            self.cnc_status = self.cnc.get_status()
+            self.valve_widgets[-1].setStatus(self.cnc_status)
+
+    # ------------------------------------------------------------------------------------
+    # Return the last polled valve and CNC status without touching the hardware
+    # ------------------------------------------------------------------------------------
+    def getCachedStatus(self):
+        snapshot = {"valves": [{"port": status[0], "moving": bool(status[1])}
+                               for status in self.valve_status]}
         if self.cnc is not None:
-            self.valve_widgets[-1].setStatus(self.cnc.get_status())
+            cnc_status = self.cnc_status if self.cnc_status is not None else ("Unknown", False)
+            position = getattr(self.cnc, "position", None)
+            snapshot["cnc"] = {"port": cnc_status[0],
+                               "moving": bool(cnc_status[1]),
+                               "position": list(position) if position is not None else None}
+        return snapshot
 
     # ------------------------------------------------------------------------------------
     # Change port status based on external command
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+"""
+An asyncio TCP server that speaks the same JSON-line protocol as
+TCPServer, i.e. one TCPMessage encoded as JSON per line, but that
+does not need a Qt event loop. Unlike TCPServer it accepts any number
+of simultaneous clients.
+
+If unix_path is set the server listens on a unix domain socket at
+this path instead of on a TCP port, this is what TCPClient connects
+to when it is given local_name = unix_path (on Linux).
+
+Received messages are passed to message_handler(message, connection),
+which may be a plain function or a coroutine function. The handler
+replies with connection.sendMessage(message), now or later. See
+fluidics/kilroyHeadless.py for a handler that runs Kilroy protocols.
+"""
+
+import asyncio
+import os
+import sys
+
+from storm_control.sc_library.tcpMessage import TCPMessage
+
+
+class AsyncTCPConnection(object):
+    """
+    A single client connection to an AsyncTCPServer.
+    """
+    def __init__(self, reader = None, writer = None, server = None, **kwds):
+        super().__init__(**kwds)
+        self.reader = reader
+        self.server = server
+        self.writer = writer
+
+        peer = writer.get_extra_info("peername")
+        self.peer_name = str(peer) if peer else "local"
+
+    def close(self):
+        """
+        Close the connection.
+        """
+        if not self.writer.is_closing():
+            self.writer.close()
+
+    def isConnected(self):
+        """
+        Return true if the connection is still open.
+        """
+        return not self.writer.is_closing()
+
+    def sendMessage(self, message):
+        """
+        Send TCP message as JSON string if the connection is open.
+        """
+        if self.isConnected():
+            self.writer.write((message.toJSON() + "\n").encode(self.server.encoding))
+            if self.server.verbose:
+                print("Sent: \n" + str(message))
+            return True
+        else:
+            print(self.server.server_name + " connection to " + self.peer_name + " closed. \nDid not send:")
+            print(message)
+            return False
+
+
+class AsyncTCPServer(object):
+    """
+    An asyncio TCP server for passing TCP messages between programs.
+    """
+    def __init__(self,
+                 address = "127.0.0.1",
+                 encoding = "utf-8",
+                 max_line_length = 2**20,
+                 message_handler = None,
+                 port = 9500,
+                 server_name = "default",
+                 unix_path = None,
+                 verbose = False,
+                 **kwds):
+        super().__init__(**kwds)
+
+        self.address = address
+        self.connections = []
+        self.encoding = encoding
+        self.max_line_length = max_line_length
+        self.message_handler = message_handler
+        self.port = port
+        self.server = None
+        self.server_name = server_name
+        self.unix_path = unix_path
+        self.verbose = verbose
+
+    def broadcast(self, message):
+        """
+        Send a message to all the connected clients.
+        """
+        for connection in self.connections:
+            connection.sendMessage(message)
+
+    def close(self):
+        """
+        Stop listening and close all client connections.
+        """
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            if (self.unix_path is not None) and os.path.exists(self.unix_path):
+                os.remove(self.unix_path)
+        for connection in self.connections:
+            connection.close()
+        if self.verbose:
+            print("Closing TCP communications: " + self.server_name)
+
+    async def handleClientConnection(self, reader, writer):
+        """
+        Read messages from a client until it disconnects.
+        """
+        connection = AsyncTCPConnection(reader = reader,
+                                        writer = writer,
+                                        server = self)
+        self.connections.append(connection)
+        if self.verbose:
+            print("Connected new client: " + connection.peer_name)
+
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError as error: # Line longer than max_line_length.
+                    self.handleMalformedMessage(connection, error)
+                    break
+                if not line:
+                    break
+                message_str = str(line, self.encoding)
+                if not message_str.strip():
+                    continue
+
+                try:
+                    message = TCPMessage.fromJSON(message_str)
+                except ValueError as error:
+                    self.handleMalformedMessage(connection, error)
+                    continue
+
+                if self.verbose:
+                    print("Received: \n" + str(message))
+                if message.isType("Busy"):
+                    continue
+                if message.isType("Heartbeat"):
+                    # Answer heartbeats from TCPClient, see tcpCommunications.py
+                    if not message.getResponse("ack"):
+                        message.addResponse("ack", True)
+                        connection.sendMessage(message)
+                    continue
+                await self.handleMessage(message, connection)
+
+                # Apply back pressure if the client is not reading its replies.
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.connections.remove(connection)
+            connection.close()
+            if self.verbose:
+                print("Client disconnected: " + connection.peer_name)
+
+    def handleMalformedMessage(self, connection, error):
+        """
+        Reply to a line that could not be decoded as a TCP message.
+        """
+        print(self.server_name + " received a malformed message: " + str(error))
+        message = TCPMessage(message_type = "Error")
+        message.setError(True, "Malformed message: " + str(error))
+        connection.sendMessage(message)
+
+    async def handleMessage(self, message, connection):
+        """
+        Pass a message to the message handler.
+        """
+        if self.message_handler is None:
+            message.setError(True, self.server_name + " has no message handler")
+            connection.sendMessage(message)
+            return
+        result = self.message_handler(message, connection)
+        if asyncio.iscoroutine(result):
+            await result
+
+    def isConnected(self):
+        """
+        Return true if at least one client is connected.
+        """
+        return len(self.connections) > 0
+
+    async def serveForever(self):
+        """
+        Start the server (if necessary) and serve until cancelled.
+        """
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def start(self):
+        """
+        Listen for new clients.
+        """
+        if self.verbose:
+            string = "Listening for new clients at: \n"
+            if self.unix_path is not None:
+                string += "    Unix socket: " + self.unix_path
+            else:
+                string += "    Address: " + str(self.address) + "\n"
+                string += "    Port: " + str(self.port)
+            print(string)
+        if self.unix_path is not None:
+            # Remove a stale socket left by a server that crashed.
+            if os.path.exists(self.unix_path):
+                os.remove(self.unix_path)
+            self.server = await asyncio.start_unix_server(self.handleClientConnection,
+                                                          path = self.unix_path,
+                                                          limit = self.max_line_length)
+        else:
+            self.server = await asyncio.start_server(self.handleClientConnection,
+                                                     host = self.address,
+                                                     port = self.port,
+                                                     limit = self.max_line_length)
+
+
+def handleStandAloneMessage(message, connection):
+    """
+    Echo the same messages as the TCPServer stand alone test class so that
+    the tcpClient.py stand alone test can talk to this server.
+    """
+    if message.isType("Stage Position"):
+        print("Stage X: ", message.getData("Stage_X"), "Stage Y: ", message.getData("Stage_Y"))
+    elif message.isType("Movie"):
+        print("Movie: ", "Name: ", message.getData("Name"), "Parameters: ", message.getData("Parameters"))
+    connection.sendMessage(message)
+
+
+def qtClientTest(port = 9501):
+    """
+    Check that the Qt TCPClient can exchange messages with this server.
+    The server runs in its own thread with its own asyncio loop.
+    """
+    import threading
+    from PyQt5 import QtCore
+    from storm_control.sc_library.tcpClient import TCPClient
+
+    loop = asyncio.new_event_loop()
+    server = AsyncTCPServer(message_handler = handleStandAloneMessage, port = port)
+    loop.run_until_complete(server.start())
+    thread = threading.Thread(target = loop.run_forever, daemon = True)
+    thread.start()
+
+    app = QtCore.QCoreApplication(sys.argv)
+    client = TCPClient(port = port, server_name = "Async Test")
+    replies = []
+    client.messageReceived.connect(replies.append)
+    assert client.startCommunication(), "Qt client could not connect"
+
+    sent = [TCPMessage(message_type = "Stage Position", message_data = {"Stage_X": 100.0, "Stage_Y": 0.0}),
+            TCPMessage(message_type = "Movie", message_data = {"Name": "Test_Movie_01", "Parameters": 1})]
+    for message in sent:
+        client.sendMessage(message)
+
+    timer = QtCore.QElapsedTimer()
+    timer.start()
+    while (len(replies) < len(sent)) and (timer.elapsed() < 2000):
+        client.socket.waitForReadyRead(100)
+        app.processEvents()
+
+    assert [m.getID() for m in replies] == [m.getID() for m in sent], "IDs do not match"
+    assert [m.getType() for m in replies] == [m.getType() for m in sent], "Types do not match"
+    assert replies[0].getData("Stage_X") == 100.0, "Data does not match"
+    print("Qt TCPClient and AsyncTCPServer are compatible.")
+
+    client.stopCommunication()
+    loop.call_soon_threadsafe(server.close)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+#
+# Test/Demo of Class
+#
+if (__name__ == "__main__"):
+
+    # Check compatibility with the Qt client.
+    if (len(sys.argv) == 2) and (sys.argv[1] == "--qt-client"):
+        qtClientTest()
+
+    # Stand alone echo server, use the tcpClient.py demo to talk to it.
+    else:
+        server = AsyncTCPServer(message_handler = handleStandAloneMessage,
+                                port = 9500,
+                                verbose = True)
+        try:
+            asyncio.run(server.serveForever())
+        except KeyboardInterrupt:
+            server.close()
+
@@ -0,0 +1,525 @@
+#!/usr/bin/env python
+"""
+A load generator and latency benchmark for the Kilroy TCP control
+protocol.
+
+Clients open one or more connections, send a configurable mix of
+test mode duration queries, protocol starts and malformed messages
+at a configurable rate, and measure the round trip time of each
+reply. By default the clients talk to a simulated Kilroy running on
+an AsyncTCPServer in a separate thread, use --target with --host and
+--port to load a running server instead (the Qt TCPServer only
+accepts one client).
+
+Use --unix to talk over a unix domain socket instead of TCP, or
+--compare-unix to run the same load over TCP loopback and then over a
+unix domain socket and report the difference in latency.
+
+By default the simulated Kilroy runs on the asyncio server, so these
+numbers are for AsyncTCPServer over TCP and over AF_UNIX. Add --qt to
+run it on the Qt TCPServer that Kilroy uses instead (in a separate
+process, one connection only), --compare-unix then compares the
+QTcpServer and QLocalServer (tcp_transport = local) transports.
+
+The results (throughput and p50/p99/p999 round trip latency, per
+message kind and overall) are printed and, with --output, saved as
+JSON so that they can be compared between releases.
+
+Example:
+  python tcpBenchmark.py --connections 4 --rate 200 --duration 10 --output bench.json
+  python tcpBenchmark.py --compare-unix --duration 10
+  python tcpBenchmark.py --compare-unix --qt --duration 10
+  python tcpBenchmark.py --codec
+"""
+
+import argparse
+import asyncio
+import copy
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import storm_control.sc_library.hgit as hgit
+from storm_control.sc_library.tcpAsyncServer import AsyncTCPServer
+from storm_control.sc_library.tcpMessage import TCPMessage
+
+
+class SimulatedKilroy(object):
+    """
+    Answers Kilroy messages the way Kilroy.handleTCPData() does, but
+    with protocols that take protocol_time seconds to 'run'.
+
+    call_later(delay, function, *args) schedules the protocol complete
+    reply, the default uses the running asyncio loop.
+    """
+    def __init__(self, call_later = None, protocol_time = 0.01, **kwds):
+        super().__init__(**kwds)
+        self.call_later = call_later
+        self.protocol_time = protocol_time
+        self.protocols = {"Flow Wash Buffer" : 60.0,
+                          "Hybridize" : 900.0,
+                          "Bleach" : 300.0,
+                          "Image" : 120.0}
+
+    def handleMessage(self, message, connection):
+        if message.isType("Kilroy Status"):
+            message.addResponse("protocol", {"running" : False})
+            connection.sendMessage(message)
+        elif not message.isType("Kilroy Protocol"):
+            message.setError(True, "Wrong message type sent to Kilroy: " + str(message.getType()))
+            connection.sendMessage(message)
+        elif not (message.getData("name") in self.protocols):
+            message.setError(True, "Invalid Kilroy Protocol")
+            connection.sendMessage(message)
+        elif message.isTest():
+            message.addResponse("duration", self.protocols[message.getData("name")])
+            connection.sendMessage(message)
+        elif self.call_later is not None:
+            self.call_later(self.protocol_time, connection.sendMessage, message)
+        else:
+            asyncio.get_running_loop().call_later(self.protocol_time, connection.sendMessage, message)
+
+
+class LoadClient(object):
+    """
+    A single connection sending a mix of messages.
+    """
+    def __init__(self, config = None, results = None, **kwds):
+        super().__init__(**kwds)
+        self.config = config
+        self.malformed_sent = [] # Send times of unparseable lines, replies come back in order.
+        self.pending = {}        # message ID : [kind, send time]
+        self.results = results
+        self.done = None
+
+    def makeMessage(self, kind):
+        """
+        Return the line to send and the message (None if it is not a valid message).
+        """
+        if (kind == "malformed"):
+            return ["{\"message_type\": \"Kilroy Protocol\", \"message_data\": {\n", None]
+        elif (kind == "invalid"):
+            message = TCPMessage(message_type = "Kilroy Protocol",
+                                 message_data = {"name" : "No Such Protocol"},
+                                 test_mode = True)
+        elif (kind == "start"):
+            message = TCPMessage(message_type = "Kilroy Protocol",
+                                 message_data = {"name" : "Flow Wash Buffer"})
+        elif (kind == "status"):
+            message = TCPMessage(message_type = "Kilroy Status")
+        else:
+            message = TCPMessage(message_type = "Kilroy Protocol",
+                                 message_data = {"name" : "Hybridize"},
+                                 test_mode = True)
+        return [message.toJSON() + "\n", message]
+
+    async def readReplies(self, reader):
+        while True:
+            line = await reader.readline()
+            now = time.perf_counter()
+            if not line:
+                break
+            reply = TCPMessage.fromJSON(str(line, "utf-8"))
+            if reply.getID() in self.pending:
+                [kind, sent] = self.pending.pop(reply.getID())
+            elif reply.isType("Error") and (len(self.malformed_sent) > 0):
+                [kind, sent] = ["malformed", self.malformed_sent.pop(0)]
+            else:
+                self.results.unexpected += 1
+                continue
+            self.results.addLatency(kind, now - sent, reply.hasError())
+            if self.done is not None:
+                self.done.set()
+
+    async def run(self, kinds, weights):
+        config = self.config
+        if config.unix is not None:
+            [reader, writer] = await asyncio.open_unix_connection(config.unix, limit = 2**20)
+        else:
+            [reader, writer] = await asyncio.open_connection(config.host, config.port, limit = 2**20)
+        reader_task = asyncio.ensure_future(self.readReplies(reader))
+
+        interval = 1.0/config.rate if (config.rate > 0) else 0.0
+        self.done = asyncio.Event() if (interval == 0.0) else None
+        next_time = time.perf_counter()
+        stop_time = next_time + config.duration
+        while (time.perf_counter() < stop_time):
+            kind = random.choices(kinds, weights)[0]
+            [line, message] = self.makeMessage(kind)
+            sent = time.perf_counter()
+            if message is None:
+                self.malformed_sent.append(sent)
+            else:
+                self.pending[message.getID()] = [kind, sent]
+            writer.write(line.encode("utf-8"))
+            self.results.sent += 1
+
+            # Closed loop, wait for the reply.
+            if self.done is not None:
+                self.done.clear()
+                try:
+                    await asyncio.wait_for(self.done.wait(), config.timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+            # Open loop, send at a fixed rate.
+            else:
+                await writer.drain()
+                next_time += interval
+                delay = next_time - time.perf_counter()
+                if (delay > 0.0):
+                    await asyncio.sleep(delay)
+
+        # Wait for the remaining replies.
+        wait_until = time.perf_counter() + config.timeout
+        while ((len(self.pending) + len(self.malformed_sent)) > 0) and (time.perf_counter() < wait_until):
+            await asyncio.sleep(0.01)
+        self.results.lost += len(self.pending) + len(self.malformed_sent)
+
+        reader_task.cancel()
+        writer.close()
+
+
+class Results(object):
+    """
+    Round trip times and counters for a benchmark run.
+    """
+    def __init__(self, **kwds):
+        super().__init__(**kwds)
+        self.errors = {}
+        self.latencies = {}
+        self.lost = 0
+        self.sent = 0
+        self.unexpected = 0
+
+    def addLatency(self, kind, latency, error):
+        self.latencies.setdefault(kind, []).append(latency)
+        if error:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def summary(self, elapsed):
+        all_latencies = []
+        kinds = {}
+        for [kind, latencies] in sorted(self.latencies.items()):
+            all_latencies.extend(latencies)
+            kinds[kind] = summarizeLatencies(latencies)
+            kinds[kind]["errors"] = self.errors.get(kind, 0)
+        received = len(all_latencies)
+        return {"sent" : self.sent,
+                "received" : received,
+                "lost" : self.lost,
+                "unexpected" : self.unexpected,
+                "elapsed_s" : elapsed,
+                "throughput_per_s" : received/elapsed if (elapsed > 0.0) else 0.0,
+                "latency" : summarizeLatencies(all_latencies),
+                "kinds" : kinds}
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest rank percentile of an already sorted list.
+    """
+    if (len(sorted_values) == 0):
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def summarizeLatencies(latencies):
+    """
+    Return the latency statistics in milliseconds.
+    """
+    values = sorted(latencies)
+    stats = {"count" : len(values)}
+    if (len(values) > 0):
+        stats["mean_ms"] = 1000.0 * sum(values)/len(values)
+        stats["max_ms"] = 1000.0 * values[-1]
+        for [name, fraction] in [["p50_ms", 0.5], ["p99_ms", 0.99], ["p999_ms", 0.999]]:
+            stats[name] = 1000.0 * percentile(values, fraction)
+    return stats
+
+def parseMix(mix_string):
+    """
+    Parse a message mix like "test=80,start=5,malformed=10,invalid=5".
+    """
+    kinds = []
+    weights = []
+    for item in mix_string.split(","):
+        [kind, weight] = item.split("=")
+        if not kind.strip() in ["test", "start", "status", "malformed", "invalid"]:
+            raise ValueError("Unknown message kind " + kind)
+        kinds.append(kind.strip())
+        weights.append(float(weight))
+    return [kinds, weights]
+
+def startSimulatedKilroy(config):
+    """
+    Run a simulated Kilroy on its own event loop in a separate thread.
+    """
+    loop = asyncio.new_event_loop()
+    kilroy = SimulatedKilroy(protocol_time = config.protocol_time)
+    server = AsyncTCPServer(address = config.host,
+                            message_handler = kilroy.handleMessage,
+                            port = config.port,
+                            server_name = "Simulated Kilroy",
+                            unix_path = config.unix)
+    loop.run_until_complete(server.start())
+    thread = threading.Thread(target = loop.run_forever, daemon = True)
+    thread.start()
+
+    def stop():
+        loop.call_soon_threadsafe(server.close)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+    return stop
+
+def serveQt(config):
+    """
+    Run a simulated Kilroy on the Qt TCPServer, over TCP or (if
+    config.unix is set) over a QLocalServer. startQtKilroy() runs this
+    in a separate process.
+    """
+    from PyQt5 import QtCore
+    from storm_control.sc_library.tcpServer import TCPServer
+
+    def callLater(delay, function, *args):
+        QtCore.QTimer.singleShot(int(1000 * delay), lambda: function(*args))
+
+    app = QtCore.QCoreApplication(sys.argv)
+    server = TCPServer(local_name = config.unix,
+                       port = config.port,
+                       server_name = "Simulated Kilroy")
+    kilroy = SimulatedKilroy(call_later = callLater, protocol_time = config.protocol_time)
+    server.messageReceived.connect(lambda message: kilroy.handleMessage(message, server))
+    print("Listening", flush = True)
+    app.exec_()
+
+def startQtKilroy(config):
+    """
+    Start serveQt() in a separate process so that the Qt server does not
+    share an interpreter with the load clients.
+    """
+    args = [sys.executable, "-m", "storm_control.sc_library.tcpBenchmark", "--serve-qt",
+            "--port", str(config.port),
+            "--protocol-time", str(config.protocol_time)]
+    if config.unix is not None:
+        args += ["--unix", config.unix]
+    process = subprocess.Popen(args, stdout = subprocess.PIPE)
+    process.stdout.readline() # Wait until the server is listening.
+
+    def stop():
+        process.terminate()
+        process.wait()
+    return stop
+
+async def runClients(config):
+    [kinds, weights] = parseMix(config.mix)
+    results = Results()
+    clients = [LoadClient(config = config, results = results) for i in range(config.connections)]
+    start_time = time.perf_counter()
+    await asyncio.gather(*[client.run(kinds, weights) for client in clients])
+    return results.summary(time.perf_counter() - start_time)
+
+def runBenchmark(config):
+    """
+    Run a benchmark and return the results dictionary.
+    """
+    random.seed(config.seed)
+    stop_server = None
+    if config.simulate and config.qt:
+        stop_server = startQtKilroy(config)
+    elif config.simulate:
+        stop_server = startSimulatedKilroy(config)
+    try:
+        summary = asyncio.run(runClients(config))
+    finally:
+        if stop_server is not None:
+            stop_server()
+
+    summary["config"] = {"connections" : config.connections,
+                         "rate_per_connection" : config.rate,
+                         "duration_s" : config.duration,
+                         "mix" : config.mix,
+                         "simulated" : config.simulate,
+                         "server" : "qt" if config.qt else "asyncio",
+                         "transport" : "unix" if (config.unix is not None) else "tcp"}
+    summary["version"] = hgit.getVersion()
+    summary["timestamp"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    return summary
+
+def printSummary(summary):
+    print("Sent {0:d}, received {1:d}, lost {2:d} in {3:.2f}s, {4:.0f} messages/s".format(summary["sent"],
+                                                                                        summary["received"],
+                                                                                        summary["lost"],
+                                                                                        summary["elapsed_s"],
+                                                                                        summary["throughput_per_s"]))
+    rows = [["all", summary["latency"]]] + sorted(summary["kinds"].items())
+    for [kind, stats] in rows:
+        if (stats["count"] > 0):
+            print("  {0:10s} n={1:<7d} p50 {2:7.3f}ms  p99 {3:7.3f}ms  p999 {4:7.3f}ms  max {5:7.3f}ms".format(kind,
+                                                                                                            stats["count"],
+                                                                                                            stats["p50_ms"],
+                                                                                                            stats["p99_ms"],
+                                                                                                            stats["p999_ms"],
+                                                                                                            stats["max_ms"]))
+
+def codecBenchmark(n_messages = 100000, repeats = 5):
+    """
+    Measure the per message allocation and serialization cost of TCPMessage
+    against the previous __dict__ based implementation.
+
+    DictMessage is the previous TCPMessage, except that it uses the same
+    message IDs as TCPMessage so that only the representation and the
+    codec differ.
+    """
+    import timeit
+    import tracemalloc
+
+    class DictMessage(object):
+
+        def __init__(self,
+                     message_type = None,
+                     message_data = {},
+                     test_mode = False,
+                     **kwds):
+            super().__init__(**kwds)
+
+            assert message_type is not None
+
+            self.error = False
+            self.error_message = None
+            self.message_data = copy.copy(message_data)
+            self.message_type = message_type
+            self.response = {}
+            self.test_mode = test_mode
+
+            self.message_id = TCPMessage.newID()
+
+        @staticmethod
+        def fromJSON(json_string):
+            message = DictMessage(message_type = True)
+            message.__dict__.update(json.loads(json_string))
+            return message
+
+        def toJSON(self):
+            return json.dumps(self.__dict__)
+
+    data = {"name" : "Hyb 1", "find_sum" : 200}
+    baseline = None
+    for [label, cls, kwds] in [["__dict__", DictMessage, {}],
+                               ["__slots__", TCPMessage, {}],
+                               ["__slots__, no copy", TCPMessage, {"copy_data" : False}]]:
+
+        # Memory held by live messages.
+        tracemalloc.start()
+        snapshot = tracemalloc.take_snapshot()
+        messages = [cls(message_type = "Kilroy Protocol", message_data = data, **kwds) for i in range(10000)]
+        stats = tracemalloc.take_snapshot().compare_to(snapshot, "filename")
+        tracemalloc.stop()
+        size = sum(stat.size_diff for stat in stats)/len(messages)
+        del messages
+
+        # Construction, encoding and decoding times, the best of several runs.
+        message = cls(message_type = "Kilroy Protocol", message_data = data, **kwds)
+        json_string = message.toJSON()
+        t_create = min(timeit.repeat(lambda: cls(message_type = "Kilroy Protocol", message_data = data, **kwds), number = n_messages, repeat = repeats))
+        t_encode = min(timeit.repeat(message.toJSON, number = n_messages, repeat = repeats))
+        t_decode = min(timeit.repeat(lambda: cls.fromJSON(json_string), number = n_messages, repeat = repeats))
+
+        print("{0:20s} {1:7.0f} bytes  create {2:5.2f}us  toJSON {3:5.2f}us  fromJSON {4:5.2f}us".format(label,
+                                                                                                        size,
+                                                                                                        1.0e6 * t_create/n_messages,
+                                                                                                        1.0e6 * t_encode/n_messages,
+                                                                                                        1.0e6 * t_decode/n_messages))
+
+        # Change relative to the previous implementation, negative is better.
+        results = [size, t_create, t_encode, t_decode]
+        if baseline is None:
+            baseline = results
+        else:
+            print("{0:20s} {1:+6.0f}%         {2:+6.0f}%        {3:+6.0f}%          {4:+6.0f}%".format("",
+                                                                                               *[100.0 * (new/old - 1.0) for [new, old] in zip(results, baseline)]))
+
+def compareTransports(config):
+    """
+    Run the same benchmark over TCP loopback and over a unix domain
+    socket, return both results and the change in latency.
+    """
+    tcp_config = argparse.Namespace(**vars(config))
+    tcp_config.unix = None
+    unix_config = argparse.Namespace(**vars(config))
+    temp_dir = None
+    if unix_config.unix is None:
+        temp_dir = tempfile.mkdtemp()
+        unix_config.unix = os.path.join(temp_dir, "kilroy_benchmark.sock")
+
+    summaries = {"tcp" : runBenchmark(tcp_config),
+                 "unix" : runBenchmark(unix_config)}
+    if temp_dir is not None:
+        shutil.rmtree(temp_dir) # A terminated Qt server leaves its socket behind.
+    speedup = {}
+    for name in ["p50_ms", "p99_ms", "p999_ms", "mean_ms"]:
+        tcp_value = summaries["tcp"]["latency"].get(name)
+        unix_value = summaries["unix"]["latency"].get(name)
+        if tcp_value and unix_value:
+            speedup[name] = tcp_value/unix_value
+    summaries["tcp_over_unix_latency"] = speedup
+    return summaries
+
+
+if (__name__ == "__main__"):
+    parser = argparse.ArgumentParser(description = "Kilroy TCP load generator and latency benchmark.")
+    parser.add_argument("--host", default = "127.0.0.1", help = "Server address.")
+    parser.add_argument("--port", type = int, default = 9600, help = "Server port.")
+    parser.add_argument("--unix", default = None,
+                        help = "Use the unix domain socket at this path instead of TCP.")
+    parser.add_argument("--compare-unix", dest = "compare_unix", action = "store_true",
+                        help = "Run over TCP loopback and then over a unix domain socket.")
+    parser.add_argument("--target", action = "store_true",
+                        help = "Load an already running server instead of a simulated Kilroy.")
+    parser.add_argument("--connections", type = int, default = 1, help = "Number of client connections.")
+    parser.add_argument("--rate", type = float, default = 0.0,
+                        help = "Messages per second per connection, 0 waits for each reply (closed loop).")
+    parser.add_argument("--duration", type = float, default = 5.0, help = "Length of the run in seconds.")
+    parser.add_argument("--mix", default = "test=80,start=5,status=5,malformed=5,invalid=5",
+                        help = "Relative weights of test, start, status, malformed and invalid messages.")
+    parser.add_argument("--protocol-time", dest = "protocol_time", type = float, default = 0.01,
+                        help = "How long a simulated protocol runs in seconds.")
+    parser.add_argument("--timeout", type = float, default = 5.0, help = "Reply timeout in seconds.")
+    parser.add_argument("--seed", type = int, default = 0, help = "Random seed for the message mix.")
+    parser.add_argument("--output", default = None, help = "Save the results to this JSON file.")
+    parser.add_argument("--codec", action = "store_true",
+                        help = "Only measure the TCPMessage allocation and JSON encoding cost.")
+    parser.add_argument("--qt", action = "store_true",
+                        help = "Simulate Kilroy on the Qt TCPServer (QTcpServer or QLocalServer).")
+    parser.add_argument("--serve-qt", dest = "serve_qt", action = "store_true",
+                        help = argparse.SUPPRESS) # Used by startQtKilroy().
+    config = parser.parse_args()
+    config.simulate = not config.target
+    if config.qt and (config.connections != 1):
+        parser.error("the Qt TCPServer only accepts one connection")
+
+    if config.serve_qt:
+        serveQt(config)
+    elif config.codec:
+        codecBenchmark()
+    else:
+        if config.compare_unix:
+            summary = compareTransports(config)
+            for transport in ["tcp", "unix"]:
+                print(transport.upper() + ":")
+                printSummary(summary[transport])
+            label = "QTcpServer / QLocalServer" if config.qt else "asyncio TCP / AF_UNIX"
+            print(label + " latency: " + ", ".join(["{0:s} {1:.2f}x".format(name, value)
+                                                      for [name, value] in summary["tcp_over_unix_latency"].items()]))
+        else:
+            summary = runBenchmark(config)
+            printSummary(summary)
+        if config.output is not None:
+            with open(config.output, "w") as fp:
+                json.dump(summary, fp, indent = 2)
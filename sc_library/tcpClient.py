@@ -22,6 +22,9 @@ import storm_control.sc_library.tcpCommunications as tcpCommunications
 class TCPClient(QtCore.QObject, tcpCommunications.TCPCommunicationsMixin):
     """
     A TCP client class used to transfer TCP messages from one program to another
+
+    If local_name is set the client connects to a server listening on a
+    local socket with this name instead of on a TCP port.
     """
     comLostConnection = QtCore.pyqtSignal()
     messageReceived = QtCore.pyqtSignal(object)
@@ -29,8 +32,11 @@ class TCPClient(QtCore.QObject, tcpCommunications.TCPCommunicationsMixin):
     def __init__(self, **kwds):
         super().__init__(**kwds)
         
-        # Create instance of TCP socket
-        self.socket = QtNetwork.QTcpSocket()
+        # Create instance of TCP (or local) socket
+        if self.local_name is not None:
+            self.socket = QtNetwork.QLocalSocket()
+        else:
+            self.socket = QtNetwork.QTcpSocket()
         self.socket.disconnected.connect(self.handleDisconnect)
         self.socket.readyRead.connect(self.handleReadyRead)
 
@@ -41,22 +47,37 @@ class TCPClient(QtCore.QObject, tcpCommunications.TCPCommunicationsMixin):
         if self.verbose:
             print("-"*50)
             string = "Looking for " + self.server_name + " server at: \n"
-            string += "    Address: " + self.address.toString() + "\n"
-            string += "    Port: " + str(self.port)
+            if self.local_name is not None:
+                string += "    Local socket: " + self.local_name
+            else:
+                string += "    Address: " + self.address.toString() + "\n"
+                string += "    Port: " + str(self.port)
             print(string)
 
         # Attempt to connect to host.
-        self.socket.connectToHost(self.address, self.port)
+        if self.local_name is not None:
+            self.socket.connectToServer(self.local_name)
+        else:
+            self.socket.connectToHost(self.address, self.port)
 
         if not self.socket.waitForConnected(1000):
             print(self.server_name + " server not found")
+        else:
+            self.startHeartbeat()
 
     def handleDisconnect(self):
         """
         Handles the disconnect from the socket.
         """
+        self.stopHeartbeat()
         self.comLostConnection.emit()
 
+    def handleDeadPeer(self):
+        """
+        Give up on a server that has stopped responding.
+        """
+        self.socket.abort()
+
     def startCommunication(self):
         """
         Start communications with server
@@ -70,7 +91,7 @@ class TCPClient(QtCore.QObject, tcpCommunications.TCPCommunicationsMixin):
         Stop communications with server.
         """
         if self.isConnected():
-            self.socket.disconnectFromHost()
+            self.disconnectSocket(self.socket)
 
 
 class StandAlone(QtWidgets.QMainWindow):
@@ -21,10 +21,26 @@ class TCPCommunicationsMixin(object):
 
     They will should also include the following signal:
     messageReceived = QtCore.pyqtSignal(object)
+
+    If local_name is set the messages are exchanged over a local
+    socket (a unix domain socket on Linux, a named pipe on Windows)
+    with this name instead of over TCP, both programs must then run
+    on the same computer. tcpBenchmark.py --compare-unix --qt measures
+    the latency of both transports.
+
+    If heartbeat_interval (seconds) is not zero a "Heartbeat" message
+    is sent whenever nothing has been sent for this long. The peer
+    answers it with the "ack" response set. If idle_timeout (seconds)
+    is not zero and nothing has been received for this long the peer
+    is assumed to be dead and handleDeadPeer() is called. Both are
+    off by default as older peers do not answer heartbeats.
     """
     def __init__(self,
                  address = QtNetwork.QHostAddress(QtNetwork.QHostAddress.LocalHost),
                  encoding = 'utf-8',
+                 heartbeat_interval = 0,
+                 idle_timeout = 0,
+                 local_name = None,
                  port = 9500,
                  server_name = "default",
                  verbose = False,
@@ -34,6 +50,12 @@ class TCPCommunicationsMixin(object):
         # Initialize internal attributes
         self.address = address
         self.encoding = encoding
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timer = None
+        self.idle_timeout = idle_timeout
+        self.last_received = QtCore.QElapsedTimer()
+        self.last_sent = QtCore.QElapsedTimer()
+        self.local_name = local_name
         self.port = port 
         self.server_name = server_name
         self.socket = None
@@ -48,48 +70,107 @@ class TCPCommunicationsMixin(object):
             if self.verbose:
                 print("Closing TCP communications: " + self.server_name)
             
+    def disconnectSocket(self, socket):
+        """
+        Disconnect a TCP or a local socket.
+        """
+        if isinstance(socket, QtNetwork.QLocalSocket):
+            socket.disconnectFromServer()
+        else:
+            socket.disconnectFromHost()
+
     def handleBusy(self):
         """
         Handle a busy message. Reserved for future use.
         """
         pass
 
+    def handleDeadPeer(self):
+        """
+        Called when nothing has been received for idle_timeout seconds.
+        """
+        pass
+
+    def handleHeartbeat(self, message):
+        """
+        Answer a heartbeat from the peer, answers to our heartbeats need
+        no further handling.
+        """
+        if not message.getResponse("ack"):
+            message.addResponse("ack", True)
+            self.writeMessage(message)
+
+    def handleHeartbeatTimer(self):
+        """
+        Check that the peer is alive and send a heartbeat if the link
+        has been quiet.
+        """
+        if not self.isConnected():
+            self.stopHeartbeat()
+        elif (self.idle_timeout > 0) and self.last_received.hasExpired(int(1000 * self.idle_timeout)):
+            print(self.server_name + " received nothing for " + str(self.idle_timeout) + " seconds, closing the connection")
+            self.stopHeartbeat()
+            self.handleDeadPeer()
+        elif (self.heartbeat_interval > 0) and self.last_sent.hasExpired(int(1000 * self.heartbeat_interval)):
+            self.writeMessage(TCPMessage(message_type = "Heartbeat"))
+
+    def handleMalformedMessage(self, message_str, error):
+        """
+        Reply to a line that could not be decoded as a TCP message.
+        """
+        print(self.server_name + " received a malformed message: " + str(error))
+        message = TCPMessage(message_type = "Error")
+        message.setError(True, "Malformed message: " + str(error))
+        if self.isConnected():
+            self.writeMessage(message)
+
     def handleReadyRead(self):
         """
         Create TCP message class from JSON message and forward as appropriate
         """
-        message_str = ""
+        # Any data shows that the peer is still alive.
+        self.last_received.start()
+
+        # Each line is one message, several may arrive together.
         while self.socket.canReadLine():
-            # Read data line
-            message_str += str(self.socket.readLine(), self.encoding)
+            message_str = str(self.socket.readLine(), self.encoding)
+            if not message_str.strip():
+                continue
 
-        # Create message.
-        message = TCPMessage.fromJSON(message_str)
-        if self.verbose:
-            print("Received: \n" + str(message))
+            # Create message.
+            try:
+                message = TCPMessage.fromJSON(message_str)
+            except ValueError as error:
+                self.handleMalformedMessage(message_str, error)
+                continue
 
-        if (message.getType() == "Busy"):
-            self.handleBusy()
-        else:
-            self.messageReceived.emit(message)
+            if self.verbose:
+                print("Received: \n" + str(message))
+
+            if message.isType("Busy"):
+                self.handleBusy()
+            elif message.isType("Heartbeat"):
+                self.handleHeartbeat(message)
+            else:
+                self.messageReceived.emit(message)
     
     def isConnected(self):
         """
         Return true if the socket is connected and active.
         """
-        if self.socket and (self.socket.state() == QtNetwork.QAbstractSocket.ConnectedState):
-            return True
-        else:
+        if self.socket is None:
             return False
+        elif isinstance(self.socket, QtNetwork.QLocalSocket):
+            return (self.socket.state() == QtNetwork.QLocalSocket.ConnectedState)
+        else:
+            return (self.socket.state() == QtNetwork.QAbstractSocket.ConnectedState)
 
     def sendMessage(self, message):
         """
         Send TCP message as JSON string if the socket is connected.
         """
         if self.isConnected():
-            message_str = message.toJSON() + "\n"
-            self.socket.write(message_str.encode(self.encoding))
-            self.socket.flush()
+            self.writeMessage(message)
             if self.verbose:
                 print("Sent: \n" + str(message))
         else:
@@ -98,6 +179,42 @@ class TCPCommunicationsMixin(object):
             print(message)
             self.messageReceived.emit(message) # Return message with error
 
+    def startHeartbeat(self):
+        """
+        Start checking the connection, call this when a connection is made.
+        """
+        self.last_received.start()
+        self.last_sent.start()
+        intervals = [interval for interval in [self.heartbeat_interval, self.idle_timeout] if (interval > 0)]
+        if (len(intervals) == 0):
+            return
+
+        # Also ask the operating system to detect dead TCP connections.
+        if isinstance(self.socket, QtNetwork.QAbstractSocket):
+            self.socket.setSocketOption(QtNetwork.QAbstractSocket.KeepAliveOption, 1)
+
+        if self.heartbeat_timer is None:
+            self.heartbeat_timer = QtCore.QTimer()
+            self.heartbeat_timer.timeout.connect(self.handleHeartbeatTimer)
+        # Check several times per interval so that a dead peer is found promptly.
+        self.heartbeat_timer.setInterval(max(100, int(1000 * min(intervals) / 4)))
+        self.heartbeat_timer.start()
+
+    def stopHeartbeat(self):
+        """
+        Stop checking the connection.
+        """
+        if self.heartbeat_timer is not None:
+            self.heartbeat_timer.stop()
+
+    def writeMessage(self, message):
+        """
+        Write a message to the socket.
+        """
+        self.socket.write((message.toJSON() + "\n").encode(self.encoding))
+        self.socket.flush()
+        self.last_sent.start()
+
 
 #
 # The MIT License
@@ -122,4 +239,3 @@ class TCPCommunicationsMixin(object):
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 #
-
@@ -9,21 +9,42 @@ jeffmoffitt@gmail.com
 Hazen 05/14
 """
 
-import copy
+import itertools
 import json
+import re
+import uuid
 
 
 class TCPMessage(object):
     """
     Contains the contents and status of a TCP message.
+
+    The message fields are fixed (see __slots__), which keeps each
+    message small and means that exactly these fields, and nothing
+    else, are sent over the wire.
     """
-    _COUNTER = 0 # Track number of created instances of this class.
+    __slots__ = ("error",
+                 "error_message",
+                 "message_data",
+                 "message_type",
+                 "response",
+                 "test_mode",
+                 "message_id")
+    
+    _COUNTER = itertools.count() # Track number of created instances of this class.
+    _ID_PREFIX = uuid.uuid4().hex + "-" # Unique to this process, so IDs do not collide across restarts.
+    _ID_FORMAT = re.compile(r"^[0-9a-f]{32}-[0-9]+$")
 
     def __init__(self,
                  message_type = None,
-                 message_data = {},
+                 message_data = None,
                  test_mode = False,
+                 copy_data = True,
                  **kwds):
+        """
+        If copy_data is False the message takes ownership of message_data
+        instead of making a copy of it.
+        """
         super().__init__(**kwds)
 
         assert message_type is not None
@@ -31,13 +52,17 @@ class TCPMessage(object):
         #self.complete = False
         self.error = False
         self.error_message = None
-        self.message_data = copy.copy(message_data)
+        if message_data is None:
+            self.message_data = {}
+        elif copy_data:
+            self.message_data = dict(message_data)
+        else:
+            self.message_data = message_data
         self.message_type = message_type
         self.response = {}
         self.test_mode = test_mode
 
-        self.message_id = TCPMessage._COUNTER # Record instance number.
-        TCPMessage._COUNTER += 1 # Increment the instance counter.
+        self.message_id = TCPMessage.newID()
 
     def addData(self, key_name, value):
         """
@@ -51,14 +76,66 @@ class TCPMessage(object):
         """
         self.response[key_name] = value
 
+    @staticmethod
+    def fromDict(message_dict):
+        """
+        Creates a Message from a dictionary (i.e. a decoded JSON object).
+
+        Raises ValueError if the dictionary is not a valid message. Keys
+        that are not message fields are ignored.
+        """
+        if not isinstance(message_dict, dict):
+            raise ValueError("TCPMessage must be a JSON object, got " + type(message_dict).__name__)
+
+        message_type = message_dict.get("message_type")
+        if message_type is None:
+            raise ValueError("TCPMessage has no message_type")
+
+        message_data = message_dict.get("message_data", {})
+        response = message_dict.get("response", {})
+        if not isinstance(message_data, dict):
+            raise ValueError("TCPMessage message_data must be a JSON object")
+        if not isinstance(response, dict):
+            raise ValueError("TCPMessage response must be a JSON object")
+
+        # Skip __init__(), the data dictionaries are already our own.
+        message = TCPMessage.__new__(TCPMessage)
+        message.error = bool(message_dict.get("error", False))
+        message.error_message = message_dict.get("error_message")
+        message.message_data = message_data
+        message.message_type = message_type
+        message.response = response
+        message.test_mode = bool(message_dict.get("test_mode", False))
+        if "message_id" in message_dict:
+            message.message_id = message_dict["message_id"]
+        else:
+            message.message_id = TCPMessage.newID()
+        return message
+
     @staticmethod
     def fromJSON(json_string):
         """
         Creates a Message from a JSON string.
+
+        Raises ValueError if the string is not a valid JSON message.
         """
-        message = TCPMessage(message_type = True)
-        message.__dict__.update(json.loads(json_string))
-        return message
+        return TCPMessage.fromDict(json.loads(json_string))
+
+    @staticmethod
+    def isUniqueID(message_id):
+        """
+        Return true if message_id was made by newID(). Older clients send
+        integer IDs that start again at 0 when they are restarted.
+        """
+        return isinstance(message_id, str) and (TCPMessage._ID_FORMAT.match(message_id) is not None)
+
+    @staticmethod
+    def newID():
+        """
+        Return a new globally unique message ID. This is the process
+        prefix plus the instance number.
+        """
+        return TCPMessage._ID_PREFIX + str(next(TCPMessage._COUNTER))
 
     def getData(self, key_name, default = None):
         """
@@ -74,7 +151,8 @@ class TCPMessage(object):
 
     def getID(self):
         """
-        Return a unique ID for each message object.
+        Return a unique ID for each message object. Copies of a message,
+        e.g. a retry sent after a network error, have the same ID.
         """
         return self.message_id
 
@@ -136,11 +214,24 @@ class TCPMessage(object):
         """
         self.test_mode = test_boolean
 
+    def toDict(self):
+        """
+        Return the message fields as a dictionary. The data dictionaries
+        are not copied.
+        """
+        return {"error" : self.error,
+                "error_message" : self.error_message,
+                "message_data" : self.message_data,
+                "message_type" : self.message_type,
+                "response" : self.response,
+                "test_mode" : self.test_mode,
+                "message_id" : self.message_id}
+
     def toJSON(self):
         """
         Serialize using JSON.
         """
-        return json.dumps(self.__dict__)
+        return json.dumps(self.toDict())
 
     ## markAsComplete
     #
@@ -154,7 +245,7 @@ class TCPMessage(object):
         Generate a string representation of the message.
         """
         string_rep = "\tMessage Type: " + str(self.message_type)
-        for attribute in sorted(vars(self).keys()):
+        for attribute in sorted(self.__slots__):
             if not (attribute == "message_type"):
                 string_rep += "\n\t" + attribute + ": " + str(getattr(self, attribute))
         return string_rep
@@ -197,6 +288,35 @@ if (__name__ == "__main__"):
         #message = TCPMessage.fromJSON(message.toJSON())
         #print message
 
+    # Self checks of the JSON codec.
+    if True:
+        message = TCPMessage(message_type="findSum",
+                             message_data={"find_sum":200})
+        message.addResponse("found_sum", 100)
+        copy = TCPMessage.fromJSON(message.toJSON())
+        assert (copy.toDict() == message.toDict())
+        assert TCPMessage.isUniqueID(copy.getID())
+        assert not TCPMessage.isUniqueID(12)
+        assert (TCPMessage(message_type="findSum").getID() != message.getID())
+
+        # Extra keys are ignored, a missing message ID gets a new one.
+        copy = TCPMessage.fromDict({"message_type" : "findSum", "unknown" : 1})
+        assert not hasattr(copy, "unknown")
+        assert TCPMessage.isUniqueID(copy.getID())
+
+        for bad in ["[]",
+                    "{}",
+                    '{"message_type" : "findSum", "message_data" : []}',
+                    '{"message_type" : "findSum", "response" : 1}',
+                    "not json"]:
+            try:
+                TCPMessage.fromJSON(bad)
+            except ValueError:
+                pass
+            else:
+                assert False, "fromJSON accepted " + bad
+        print("TCPMessage self checks passed")
+
 #
 # The MIT License
 #
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+A bounded cache of recently received request IDs and their replies.
+
+This lets a server recognize a request that a client sent again, for
+example after a network error, and answer it with the result of the
+original request instead of running it a second time.
+"""
+
+import collections
+
+
+class TCPReplayCache(object):
+    """
+    Tracks the state of the last max_size requests by message ID.
+    """
+    IN_FLIGHT = "in flight"
+    COMPLETE = "complete"
+
+    def __init__(self, max_size = 256, **kwds):
+        super().__init__(**kwds)
+        self.max_size = max_size
+        self.requests = collections.OrderedDict() # message ID : [state, reply]
+
+    def add(self, message):
+        """
+        Record a new request as in flight. Returns False if the request
+        is already known, i.e. it is a duplicate.
+        """
+        message_id = message.getID()
+        if message_id in self.requests:
+            return False
+        self.requests[message_id] = [self.IN_FLIGHT, None]
+        while (len(self.requests) > self.max_size):
+            self.requests.popitem(last = False)
+        return True
+
+    def complete(self, message):
+        """
+        Record the reply to a request. Replies to requests that are not
+        in the cache are ignored.
+        """
+        if message.getID() in self.requests:
+            self.requests[message.getID()] = [self.COMPLETE, message]
+
+    def get(self, message):
+        """
+        Return [state, reply] for a request, state is None if the request
+        is not in the cache and reply is None until it is complete.
+        """
+        return self.requests.get(message.getID(), [None, None])
+
+
+
+#
+# Self checks.
+#
+if (__name__ == "__main__"):
+    from storm_control.sc_library.tcpMessage import TCPMessage
+
+    cache = TCPReplayCache(max_size = 2)
+    first = TCPMessage(message_type = "Kilroy Protocol")
+    assert cache.add(first)
+    assert not cache.add(first)
+    assert (cache.get(first) == [TCPReplayCache.IN_FLIGHT, None])
+
+    first.addResponse("done", True)
+    cache.complete(first)
+    assert (cache.get(first) == [TCPReplayCache.COMPLETE, first])
+
+    # A retry is a copy with the same ID.
+    retry = TCPMessage.fromJSON(first.toJSON())
+    assert not cache.add(retry)
+    assert (cache.get(retry)[1] is first)
+
+    # The oldest requests are dropped, and replies to them are ignored.
+    for i in range(2):
+        assert cache.add(TCPMessage(message_type = "Kilroy Protocol"))
+    assert (cache.get(first) == [None, None])
+    cache.complete(first)
+    assert (cache.get(first) == [None, None])
+    print("TCPReplayCache self checks passed")
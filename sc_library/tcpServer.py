@@ -20,6 +20,9 @@ import storm_control.sc_library.tcpCommunications as tcpCommunications
 class TCPServer(QtNetwork.QTcpServer, tcpCommunications.TCPCommunicationsMixin):
     """
     A TCP server for passing TCP messages between programs.
+
+    If local_name is set the server listens on a local socket with
+    this name instead of on a TCP port.
     """
     comGotConnection = QtCore.pyqtSignal()
     comLostConnection = QtCore.pyqtSignal()
@@ -29,7 +32,12 @@ class TCPServer(QtNetwork.QTcpServer, tcpCommunications.TCPCommunicationsMixin):
         super().__init__(**kwds)
 
         # Connect new connection signal
-        self.newConnection.connect(self.handleClientConnection)
+        self.local_server = None
+        if self.local_name is not None:
+            self.local_server = QtNetwork.QLocalServer(self)
+            self.local_server.newConnection.connect(self.handleClientConnection)
+        else:
+            self.newConnection.connect(self.handleClientConnection)
         
         # Listen for new connections
         self.connectToNewClients()
@@ -40,10 +48,19 @@ class TCPServer(QtNetwork.QTcpServer, tcpCommunications.TCPCommunicationsMixin):
         """
         if self.verbose:
             string = "Listening for new clients at: \n"
-            string += "    Address: " + self.address.toString() + "\n"
-            string += "    Port: " + str(self.port)
+            if self.local_server is not None:
+                string += "    Local socket: " + self.local_name
+            else:
+                string += "    Address: " + self.address.toString() + "\n"
+                string += "    Port: " + str(self.port)
             print(string)
-        self.listen(self.address, self.port)
+        if self.local_server is not None:
+            if not self.local_server.isListening():
+                # Remove a stale socket left by a server that crashed.
+                QtNetwork.QLocalServer.removeServer(self.local_name)
+                self.local_server.listen(self.local_name)
+        else:
+            self.listen(self.address, self.port)
         self.comGotConnection.emit()
  
     def disconnectFromClients(self):
@@ -53,8 +70,8 @@ class TCPServer(QtNetwork.QTcpServer, tcpCommunications.TCPCommunicationsMixin):
         if self.verbose:
             print("Force disconnect from clients")
         if self.isConnected():
-            self.socket.disconnectFromHost()
-            self.socket.waitForDisconnect()
+            self.disconnectSocket(self.socket)
+            self.socket.waitForDisconnected()
             self.socket.close()
             self.socket = None
             self.comLostConnection.emit()
@@ -64,12 +81,20 @@ class TCPServer(QtNetwork.QTcpServer, tcpCommunications.TCPCommunicationsMixin):
         """
         Handle connection from a new client.
         """
-        socket = self.nextPendingConnection()
+        if self.local_server is not None:
+            socket = self.local_server.nextPendingConnection()
+        else:
+            socket = self.nextPendingConnection()
+
+        # Replace a client that has stopped talking to us.
+        if self.isConnected() and (self.idle_timeout > 0) and self.last_received.hasExpired(int(1000 * self.idle_timeout)):
+            self.handleDeadPeer()
 
         if not self.isConnected():
             self.socket = socket
             self.socket.readyRead.connect(self.handleReadyRead)
             self.socket.disconnected.connect(self.handleClientDisconnect)
+            self.startHeartbeat()
             self.comGotConnection.emit()
             if self.verbose:
                 print("Connected new client")
@@ -78,19 +103,41 @@ class TCPServer(QtNetwork.QTcpServer, tcpCommunications.TCPCommunicationsMixin):
             if self.verbose:
                 print("Sent: \n" + str(message))
             socket.write(bytes(message.toJSON() + "\n", "utf-8"))
-            socket.disconnectFromHost()
+            self.disconnectSocket(socket)
             socket.close()
 
+    def handleDeadPeer(self):
+        """
+        Drop a client that has stopped responding so that a new client
+        can connect.
+        """
+        if self.verbose:
+            print("Dropping unresponsive client")
+        self.socket.disconnected.disconnect(self.handleClientDisconnect)
+        self.socket.abort()
+        self.socket = None
+        self.stopHeartbeat()
+        self.comLostConnection.emit()
+
     def handleClientDisconnect(self):
         """
         Handle disconnection of client.
         """
-        self.socket.disconnectFromHost()
+        self.stopHeartbeat()
+        self.disconnectSocket(self.socket)
         self.socket.close()
         self.socket = None
         self.comLostConnection.emit()
         if self.verbose:
             print("Client disconnected")
+
+    def close(self):
+        """
+        Stop listening, this also removes the local socket.
+        """
+        if self.local_server is not None:
+            self.local_server.close()
+        super().close()
             
         
 class StandAlone(QtWidgets.QMainWindow):